@@ -0,0 +1,136 @@
+"""
+Бенчмарк хэндлеров BongoCity.
+
+Собирает Dispatcher/router из main.py, подменяет HTTP-сессию Bot (запросы к Telegram
+не уходят в сеть) и прогоняет тысячи синтетических апдейтов по основным сценариям
+на локальной SQLite (или на БД из --db-url). Для каждого сценария выводит
+p50/p99 задержки апдейта, пропускную способность и число SQL-запросов на апдейт.
+
+    python bench/bench_handlers.py --users 200 --updates 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from sqlalchemy import event
+
+from common import UpdateFactory, load_main, make_bot, percentile
+
+RICH_BALANCE = 10 ** 12
+
+
+def seed_users(main, uids: list[int]):
+    """Создает игроков с большим балансом и одним готовым к сбору бизнесом."""
+    with main.SessionLocal() as s:
+        for uid in uids:
+            s.add(main.User(telegram_id=uid, username=f"bench{uid}", balance=RICH_BALANCE))
+            s.add(main.OwnedBusiness(user_id=uid, business_id=101, production_state="READY", resource_units=10))
+        s.commit()
+
+
+def reset_collect(main):
+    with main.SessionLocal() as s:
+        s.query(main.OwnedBusiness).update({"production_state": "READY", "resource_units": 10})
+        s.commit()
+
+
+def reset_crime(main):
+    with main.SessionLocal() as s:
+        s.query(main.User).update({"last_crime_time": main.datetime(2023, 1, 1), "arrest_expires": None,
+                                   "balance": RICH_BALANCE})
+        s.commit()
+    main.user_cache.clear()
+
+
+def build_scenarios(main, f: UpdateFactory):
+    """Сценарий: (название, апдейты одного пользователя за раунд, сброс состояния перед раундом)."""
+    return [
+        ("start", lambda uid: [f.message(uid, "/start")], None),
+        ("bank_deposit", lambda uid: [f.callback(uid, "bank_deposit_start"), f.message(uid, "100")], None),
+        ("biz_collect", lambda uid: [f.callback(uid, "biz_collect")], reset_collect),
+        ("casino", lambda uid: [f.message(uid, "🎰 Казино"), f.message(uid, str(main.CASINO_MIN_BET))], None),
+        ("crime", lambda uid: [f.message(uid, main.BTN_CRIME)], reset_crime),
+    ]
+
+
+async def run_scenario(main, bot, uids, build_updates, reset, total_updates, concurrency, counter):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def play(uid):
+        async with semaphore:
+            for update in build_updates(uid):
+                started = time.perf_counter()
+                await main.dp.feed_update(bot, update)
+                latencies.append(time.perf_counter() - started)
+
+    per_round = len(uids) * len(build_updates(uids[0]))
+    rounds = max(1, -(-total_updates // per_round))
+    elapsed = 0.0
+    queries = 0
+    for _ in range(rounds):
+        if reset:
+            await main.run_db(reset, main)
+        queries_before = counter[0]
+        started = time.perf_counter()
+        await asyncio.gather(*(play(uid) for uid in uids))
+        # Сброс журнала балансов входит в стоимость раунда
+        await main.balance_ledger.flush()
+        elapsed += time.perf_counter() - started
+        queries += counter[0] - queries_before
+
+    return {
+        "updates": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "queries_per_update": queries / len(latencies) if latencies else 0.0,
+    }
+
+
+async def main_async(args):
+    main = load_main(args.db_url)
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+    counter = [0]
+
+    @event.listens_for(main.engine, "before_cursor_execute")
+    def _count_queries(*_):
+        counter[0] += 1
+
+    bot = make_bot(main)
+    if not await main.run_db(main.init_db):
+        raise SystemExit("Не удалось инициализировать БД")
+
+    uids = list(range(1_000_000, 1_000_000 + args.users))
+    await main.run_db(seed_users, main, uids)
+
+    scenarios = build_scenarios(main, UpdateFactory())
+    selected = set(args.scenario or [name for name, _, _ in scenarios])
+
+    print(f"{'scenario':<14}{'updates':>9}{'p50 ms':>10}{'p99 ms':>10}{'upd/s':>10}{'SQL/upd':>10}")
+    for name, build_updates, reset in scenarios:
+        if name not in selected:
+            continue
+        result = await run_scenario(main, bot, uids, build_updates, reset, args.updates, args.concurrency, counter)
+        print(f"{name:<14}{result['updates']:>9}{result['p50_ms']:>10.2f}{result['p99_ms']:>10.2f}"
+              f"{result['throughput']:>10.0f}{result['queries_per_update']:>10.2f}")
+
+    await bot.session.close()
+    main.db_executor.shutdown(wait=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200, help="количество синтетических игроков")
+    parser.add_argument("--updates", type=int, default=2000, help="минимум апдейтов на сценарий")
+    parser.add_argument("--concurrency", type=int, default=50, help="игроков, обрабатываемых одновременно")
+    parser.add_argument("--db-url", default=None, help="URL БД (по умолчанию временная SQLite)")
+    parser.add_argument("--scenario", action="append", help="запустить только указанный сценарий (можно несколько)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main_async(parse_args()))
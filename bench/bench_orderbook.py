@@ -0,0 +1,111 @@
+"""
+Бенчмарк биржевого стакана.
+
+Гонит синтетический поток лимитных заявок и отмен через orderbook.Exchange и выводит
+пропускную способность в заявках в секунду. С --db дополнительно прогоняет тот же поток
+через ExchangeService (загрузка пачки, сведение, сохранение сделок) на локальной SQLite
+или на БД из --db-url.
+
+    python bench/bench_orderbook.py --orders 200000 --cancel-ratio 0.2
+    python bench/bench_orderbook.py --orders 20000 --db
+"""
+import argparse
+import asyncio
+import logging
+import random
+import sys
+import time
+
+from common import ROOT, load_main
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from game_rules import MARKET_ITEMS  # noqa: E402
+from orderbook import BUY, SELL, Exchange, Order  # noqa: E402
+
+ITEMS = {item_id: info['base_price'] for item_id, info in MARKET_ITEMS.items()}
+
+
+def make_flow(orders: int, cancel_ratio: float, users: int, seed: int) -> list[tuple]:
+    """Поток событий: ("order", поля Order) или ("cancel", item_id, id заявки)."""
+    rng = random.Random(seed)
+    flow = []
+    placed = []
+    for oid in range(1, orders + 1):
+        if placed and rng.random() < cancel_ratio:
+            item_id, target = placed[rng.randrange(len(placed))]
+            flow.append(("cancel", item_id, target))
+        item_id = rng.choice(list(ITEMS))
+        side = rng.choice((BUY, SELL))
+        # Цены вокруг base_price: часть заявок пересекает стакан и исполняется
+        price = max(1, round(ITEMS[item_id] * rng.gauss(1.0, 0.02)))
+        flow.append(("order", (oid, rng.randrange(1, users + 1), item_id, side, price, rng.randint(1, 50))))
+        placed.append((item_id, oid))
+    return flow
+
+
+def bench_engine(flow: list[tuple]) -> tuple[float, int, int]:
+    exchange = Exchange(ITEMS)
+    fills = 0
+    started = time.perf_counter()
+    for event in flow:
+        if event[0] == "order":
+            fills += len(exchange.submit(Order(*event[1])))
+        else:
+            exchange.cancel(event[1], event[2])
+    return time.perf_counter() - started, fills, exchange.open_orders()
+
+
+async def bench_service(args, flow: list[tuple]) -> tuple[float, int, int]:
+    """Заявки пишутся в market_orders пачками по EXCHANGE_BATCH_SIZE и сводятся ExchangeService."""
+    main = load_main(args.db_url)
+    main.init_db()
+    service = main.ExchangeService(ITEMS)
+    orders = [Order(*e[1]) for e in flow if e[0] == "order"]
+    cancels = {e[2] for e in flow if e[0] == "cancel"}
+
+    elapsed = 0.0
+    batch_size = main.EXCHANGE_BATCH_SIZE
+    for start in range(0, len(orders), batch_size):
+        chunk = orders[start:start + batch_size]
+        with main.SessionLocal() as s:
+            s.execute(main.MarketOrder.__table__.insert(), [
+                {'id': o.id, 'user_id': o.user_id, 'item_id': o.item_id, 'side': o.side, 'price': o.price,
+                 'quantity': o.remaining, 'remaining': o.remaining, 'status': "NEW",
+                 'cancel_requested': o.id in cancels, 'payout': 0}
+                for o in chunk
+            ])
+            s.commit()
+        started = time.perf_counter()
+        await service.process()
+        elapsed += time.perf_counter() - started
+    return elapsed, service.fills, service.exchange.open_orders()
+
+
+def report(name: str, events: int, elapsed: float, fills: int, open_orders: int):
+    print(f"{name:<10} {events:>9} событий за {elapsed:7.3f}с  {events / elapsed:>12,.0f} заявок/с  "
+          f"сделок {fills:,}, в стакане {open_orders:,}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=200000, help="число заявок")
+    parser.add_argument("--cancel-ratio", type=float, default=0.2, help="доля отмен на заявку")
+    parser.add_argument("--users", type=int, default=1000, help="число синтетических игроков")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--db", action="store_true", help="прогнать поток через ExchangeService и БД")
+    parser.add_argument("--db-url", default=None, help="БД для --db (по умолчанию временная SQLite)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    flow = make_flow(args.orders, args.cancel_ratio, args.users, args.seed)
+    report("engine", len(flow), *bench_engine(flow))
+    if args.db:
+        # Отменяемые заявки попадают в БД сразу с флагом отмены: событий столько же, сколько заявок
+        elapsed, fills, open_orders = asyncio.run(bench_service(args, flow))
+        report("service", args.orders, elapsed, fills, open_orders)
+
+
+if __name__ == "__main__":
+    main_cli()
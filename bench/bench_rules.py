@@ -0,0 +1,59 @@
+"""
+Микробенчмарк правил игры (game_rules) без БД и Telegram.
+
+Сравнивает расчеты по таблицам game_rules с прежними формулами в хэндлерах
+(возведение в степень на каждый вызов) и выводит время одного вызова.
+
+    python bench/bench_rules.py --number 1000000
+"""
+import argparse
+import random
+import sys
+import timeit
+
+from common import ROOT
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import game_rules  # noqa: E402
+
+
+def formula_income(bid: int, level: int, units: int) -> int:
+    info = game_rules.BUSINESSES[bid]
+    return int(info['base_payout'] * (info['payout_mult'] ** (level - 1)) * units)
+
+
+def formula_upgrade_cost(bid: int, level: int) -> int:
+    info = game_rules.BUSINESSES[bid]
+    return int(info['cost'] * (info['upgrade_cost_mult'] ** level))
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=1000000, help="вызовов на случай")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    cases = [(bid, rng.randint(1, info['max_level'] - 1), rng.randint(1, 100))
+             for bid, info in game_rules.BUSINESSES.items() for _ in range(100)]
+    for bid, level, units in cases:
+        assert game_rules.production_income(bid, level, units) == formula_income(bid, level, units)
+        assert game_rules.upgrade_cost(bid, level) == formula_upgrade_cost(bid, level)
+
+    benchmarks = [
+        ("production_income", lambda: [game_rules.production_income(*c) for c in cases]),
+        ("  формула", lambda: [formula_income(*c) for c in cases]),
+        ("upgrade_cost", lambda: [game_rules.upgrade_cost(b, lv) for b, lv, _ in cases]),
+        ("  формула", lambda: [formula_upgrade_cost(b, lv) for b, lv, _ in cases]),
+        ("casino_delta", lambda: [game_rules.casino_delta(1000 * units, 1.5) for _, _, units in cases]),
+        ("crime_delta", lambda: [game_rules.crime_delta(units * 1000, level, 0.4, 3.0) for _, level, units in cases]),
+    ]
+    repeat = max(1, args.number // len(cases))
+    for name, func in benchmarks:
+        seconds = timeit.timeit(func, number=repeat)
+        print(f"{name:<20} {seconds / (repeat * len(cases)) * 1e9:8.1f} нс/вызов")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,101 @@
+"""
+Общие заготовки для бенчмарков: подключение main.py к локальной SQLite,
+бот с подмененной HTTP-сессией и фабрики синтетических апдейтов.
+"""
+import itertools
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_main(db_url: str | None = None):
+    """Импортирует main.py с тестовым токеном и отдельной БД (по умолчанию - временная SQLite)."""
+    work_dir = tempfile.mkdtemp(prefix="bongo_bench_")
+    if db_url is None:
+        db_url = f"sqlite:///{os.path.join(work_dir, 'bench.db')}"
+    os.environ["LEDGER_WAL_PATH"] = os.path.join(work_dir, "balance_ledger.wal")
+    os.environ.setdefault("BOT_TOKEN", "123456:BENCHMARK")
+    os.environ["MYSQL_URL"] = db_url
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import main
+    return main
+
+
+def make_bot(main):
+    """Bot, чьи запросы к Telegram не уходят в сеть, а сразу получают успешный ответ."""
+    from aiogram import Bot
+    from aiogram.client.session.base import BaseSession
+    from aiogram.types import Message
+
+    class FakeSession(BaseSession):
+        """Отвечает на любой метод Bot API без сетевых запросов."""
+
+        def __init__(self):
+            super().__init__()
+            self.requests = 0
+
+        async def close(self):
+            pass
+
+        async def stream_content(self, *args, **kwargs):
+            yield b""
+
+        async def make_request(self, bot, method, timeout=None):
+            self.requests += 1
+            if "Message" in str(method.__returning__):
+                chat_id = getattr(method, "chat_id", 0) or 0
+                return Message.model_validate(
+                    {"message_id": self.requests, "date": int(time.time()),
+                     "chat": {"id": chat_id, "type": "private"}, "text": getattr(method, "text", None)},
+                    context={"bot": bot},
+                )
+            return True
+
+    bot = Bot(os.environ["BOT_TOKEN"], session=FakeSession())
+    main.bot = bot
+    return bot
+
+
+class UpdateFactory:
+    """Синтетические Message/CallbackQuery апдейты от заданного пользователя."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"Bench{uid}", "username": f"bench{uid}"}
+
+    def message(self, uid: int, text: str, chat_id: int | None = None, chat_type: str = "private"):
+        from aiogram.types import Update
+        return Update.model_validate({
+            "update_id": next(self._ids),
+            "message": {
+                "message_id": next(self._ids), "date": int(time.time()),
+                "chat": {"id": chat_id or uid, "type": chat_type},
+                "from": self._user(uid), "text": text,
+            },
+        })
+
+    def callback(self, uid: int, data: str):
+        from aiogram.types import Update
+        return Update.model_validate({
+            "update_id": next(self._ids),
+            "callback_query": {
+                "id": str(next(self._ids)), "chat_instance": "bench", "data": data,
+                "from": self._user(uid),
+                "message": {"message_id": 1, "date": int(time.time()),
+                            "chat": {"id": uid, "type": "private"}, "text": "menu"},
+            },
+        })
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[k]
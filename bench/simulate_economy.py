@@ -0,0 +1,262 @@
+"""
+Офлайн-симулятор экономики BongoCity.
+
+Прогоняет игроков по дням векторно (NumPy): ежедневный бонус, казино, ограбления,
+производство и сбор продукции, покупка и улучшение бизнесов, кредиты и штрафы за просрочку,
+часовой тик цен сырья. Денежные правила и таблицы бизнесов - из game_rules.py, расписание
+и модель цен - из main.py. Поведение игроков задается
+параметрами командной строки. Игроков можно разбить на части и считать в нескольких
+процессах (--workers).
+
+Выводит рост денежной массы (наличные + банк), поступления в Госбюджет и ожидаемую
+нагрузку на БД в пересчете на 1000 игроков: записи журнала балансов, транзакции и строки в секунду.
+
+    python bench/simulate_economy.py --players 10000 --days 365
+    python bench/simulate_economy.py --players 200000 --days 90 --workers 4 --casino-bets 5
+"""
+import argparse
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from common import ROOT, load_main
+
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import game_rules  # noqa: E402
+
+SECONDS_PER_DAY = 86400
+
+# Счетчики за день: деньги (сумма по игрокам) и события, порождающие запись в БД
+MONEY_FLOWS = ("bonus", "casino", "crime", "production_gross", "tax", "resources", "businesses",
+               "loans_issued", "loans_repaid", "fines")
+EVENTS = ("ledger_entries", "direct_tx", "direct_rows", "scheduler_rows")
+
+
+def load_rules():
+    """
+    Расписание из main.py (словарь, который можно передать в процессы пула) и MarketEngine.
+    Денежные правила и таблицы бизнесов берутся из game_rules.
+    """
+    main = load_main()
+    return {
+        'crime_attempts': 24 // main.CRIME_COOLDOWN_HOURS,
+        'production_cycles': 24 // main.PRODUCTION_CYCLE_HOURS,
+        'loan_cycle_days': main.LOAN_CYCLE_DAYS,
+        'ledger_flush_seconds': main.LEDGER_FLUSH_SECONDS,
+    }, main.MarketEngine(game_rules.MARKET_ITEMS, 1, main.MARKET_MEAN_REVERSION, main.MARKET_SHOCK_CORRELATION)
+
+
+def price_path(market, days: int, seed: int) -> dict[int, np.ndarray]:
+    """Средняя за день цена каждого товара по часовым тикам MarketEngine."""
+    market._rng = np.random.default_rng(seed)
+    prices = market.base.astype(np.int64)
+    daily = np.zeros((days, len(market.item_ids)))
+    for day in range(days):
+        for _ in range(24):
+            prices = market.step(prices)
+            daily[day] += prices
+    daily /= 24
+    return {item_id: daily[:, i] for i, item_id in enumerate(market.item_ids)}
+
+
+def simulate_shard(rules: dict, params: dict, players: int, days: int, seed: int,
+                   prices: dict[int, np.ndarray]) -> dict[str, np.ndarray]:
+    """Считает players игроков на days дней. Возвращает дневные суммы по MONEY_FLOWS, EVENTS и денежной массе."""
+    rng = np.random.default_rng(seed)
+    out = {name: np.zeros(days) for name in MONEY_FLOWS + EVENTS + ("money_supply",)}
+
+    cash = np.full(players, game_rules.START_BALANCE, dtype=np.int64)
+    bank = np.zeros(players, dtype=np.int64)
+    job_level = np.ones(players, dtype=np.int64)
+    # Одна строка owned_businesses на тип: уровень 0 - бизнеса нет
+    biz_ids = sorted(game_rules.BUSINESSES, key=lambda bid: game_rules.BUSINESSES[bid]['cost'])
+    levels = {bid: np.zeros(players, dtype=np.int64) for bid in biz_ids}
+    # Таблицы game_rules в виде массивов по уровню (0 - нет бизнеса или улучшения)
+    payout = {}
+    upgrade_cost = {}
+    for bid in biz_ids:
+        levels_range = range(game_rules.BUSINESSES[bid]['max_level'] + 1)
+        payout[bid] = np.array([game_rules.PAYOUT_PER_UNIT.get((bid, lv), 0) for lv in levels_range])
+        upgrade_cost[bid] = np.array([game_rules.UPGRADE_COST.get((bid, lv), 0) for lv in levels_range], dtype=np.int64)
+
+    loan_amount = np.zeros(players, dtype=np.int64)
+    loan_due = np.zeros(players, dtype=np.int64) # День погашения
+    loan_days = np.zeros(players, dtype=np.int64)
+
+    def ledger(day, name, delta, mask):
+        out[name][day] += delta[mask].sum()
+        out['ledger_entries'][day] += mask.sum()
+
+    def direct(day, mask, rows):
+        out['direct_tx'][day] += mask.sum()
+        out['direct_rows'][day] += mask.sum() * rows
+
+    for day in range(days):
+        # Бонус
+        mask = rng.random(players) < params['bonus_prob']
+        cash[mask] += game_rules.DAILY_BONUS_AMOUNT
+        ledger(day, 'bonus', np.full(players, game_rules.DAILY_BONUS_AMOUNT), mask)
+
+        # Казино
+        bets = rng.poisson(params['casino_bets'], players)
+        for k in range(bets.max(initial=0)):
+            bet = np.maximum(game_rules.CASINO_MIN_BET, (cash * params['casino_bet_share']).astype(np.int64))
+            mask = (bets > k) & (cash >= bet)
+            m = rng.choice(game_rules.CASINO_MULTIPLIERS, players)
+            delta = np.where(m == 0, -bet, np.where(m == 0.5, -(bet * 0.5).astype(np.int64), (bet * m).astype(np.int64)))
+            cash[mask] += delta[mask]
+            ledger(day, 'casino', delta, mask)
+
+        # Ограбления (не чаще кулдауна)
+        attempts = np.minimum(rng.poisson(params['crime_attempts'], players), rules['crime_attempts'])
+        for k in range(attempts.max(initial=0)):
+            mask = (attempts > k) & (cash >= game_rules.CASINO_MIN_BET)
+            bet = np.maximum(cash * game_rules.CRIME_BET_SHARE, game_rules.CASINO_MIN_BET)
+            success = rng.random(players) < game_rules.crime_chance(job_level)
+            win = (bet * rng.uniform(*game_rules.CRIME_WIN_RANGE, players)).astype(np.int64)
+            fine = np.minimum((bet * game_rules.CRIME_FINE_MULTIPLIER).astype(np.int64), cash)
+            delta = np.where(success, win, -fine)
+            cash[mask] += delta[mask]
+            ledger(day, 'crime', delta, mask)
+
+        # Производство: цикл = запуск (покупка сырья), завершение планировщиком, сбор
+        cycles = min(params['production_cycles'], rules['production_cycles'])
+        for _ in range(cycles):
+            for bid in biz_ids:
+                price = prices[game_rules.BUSINESSES[bid]['req_resource_id']][day]
+                units = np.minimum(params['units'], (cash // price).astype(np.int64))
+                mask = (levels[bid] > 0) & (units > 0)
+                cost = (units * price).astype(np.int64)
+                gross = (payout[bid][levels[bid]] * units).astype(np.int64)
+                tax = (gross * game_rules.DEFAULT_TAX_RATE).astype(np.int64)
+                cash[mask] += gross[mask] - tax[mask] - cost[mask]
+                out['resources'][day] += cost[mask].sum()
+                out['production_gross'][day] += gross[mask].sum()
+                out['tax'][day] += tax[mask].sum()
+                direct(day, mask, 2) # Запуск: users, owned_businesses
+                direct(day, mask, 3) # Сбор: users, owned_businesses, presidential_budget
+                out['scheduler_rows'][day] += mask.sum() # Завершение: owned_businesses
+
+        # Покупка и улучшение бизнесов
+        for bid in biz_ids:
+            cost = game_rules.BUSINESSES[bid]['cost']
+            mask = (levels[bid] == 0) & (cash >= cost * params['buy_reserve'])
+            cash[mask] -= cost
+            levels[bid][mask] = 1
+            out['businesses'][day] += mask.sum() * cost
+            direct(day, mask, 2)
+
+            up = upgrade_cost[bid][levels[bid]]
+            mask = (levels[bid] > 0) & (up > 0) & (cash >= up * params['upgrade_reserve'])
+            cash[mask] -= up[mask]
+            levels[bid][mask] += 1
+            out['businesses'][day] += up[mask].sum()
+            direct(day, mask, 2)
+
+        # Депозит части наличных
+        if params['deposit_share']:
+            amount = (cash * params['deposit_share']).astype(np.int64)
+            mask = amount > 0
+            cash -= amount
+            bank += amount
+            out['ledger_entries'][day] += mask.sum()
+
+        # Кредиты: выдача, погашение в срок или после, штрафы за просрочку с банковского счета
+        mask = (loan_amount == 0) & (rng.random(players) < params['loan_prob'])
+        amount = rng.integers(10001, params['loan_max'] + 1, players)
+        term = rng.integers(7, 31, players)
+        loan_amount[mask], loan_due[mask], loan_days[mask] = amount[mask], day + term[mask], term[mask]
+        cash[mask] += amount[mask]
+        out['loans_issued'][day] += amount[mask].sum()
+        direct(day, mask, 2)
+
+        total_due = game_rules.loan_total_due(loan_amount, game_rules.DEFAULT_LOAN_RATE, np.maximum(day - loan_due + loan_days, 0))
+        mask = (loan_amount > 0) & (day >= loan_due) & (cash >= total_due)
+        cash[mask] -= total_due[mask]
+        out['loans_repaid'][day] += total_due[mask].sum()
+        loan_amount[mask] = 0
+        direct(day, mask, 3)
+
+        overdue = day - loan_due
+        fine = game_rules.loan_overdue_fine(loan_amount, game_rules.DEFAULT_LOAN_RATE)
+        mask = (loan_amount > 0) & (overdue > 0) & (overdue % rules['loan_cycle_days'] == 0) & (bank >= fine)
+        bank[mask] -= fine[mask]
+        out['fines'][day] += fine[mask].sum()
+        out['scheduler_rows'][day] += mask.sum() * 2
+
+        out['money_supply'][day] = cash.sum() + bank.sum()
+    return out
+
+
+def simulate(rules: dict, market, params: dict, players: int, days: int, workers: int, seed: int) -> dict[str, np.ndarray]:
+    prices = price_path(market, days, seed)
+    shards = [players // workers + (i < players % workers) for i in range(workers)]
+    if workers == 1:
+        results = [simulate_shard(rules, params, players, days, seed, prices)]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(simulate_shard, [rules] * workers, [params] * workers, shards, [days] * workers,
+                                    [seed + 1 + i for i in range(workers)], [prices] * workers))
+    total = {name: sum(r[name] for r in results) for name in results[0]}
+    total['prices'] = prices
+    return total
+
+
+def report(result: dict, rules: dict, players: int, days: int, every: int):
+    start = players * game_rules.START_BALANCE
+    budget = result['tax'] + result['loans_repaid'] + result['fines']
+    print(f"{'день':>5} {'денежная масса':>18} {'рост':>9} {'в бюджет за день':>18}")
+    for day in range(every - 1, days, every):
+        supply = result['money_supply'][day]
+        print(f"{day + 1:>5} {supply:>18,.0f} {supply / start - 1:>+9.1%} {budget[day]:>18,.0f}")
+
+    supply = result['money_supply']
+    daily_growth = (supply[-1] / start) ** (1 / days) - 1
+    print(f"\nСредний рост денежной массы: {daily_growth:+.2%} в день; на игрока: {supply[-1] / players:,.0f}$")
+    print("Потоки денег за период (сумма, на игрока в день):")
+    for name in MONEY_FLOWS:
+        print(f"  {name:<17} {result[name].sum():>20,.0f} {result[name].sum() / players / days:>12,.0f}")
+    print(f"  {'budget_inflow':<17} {budget.sum():>20,.0f} {budget.sum() / players / days:>12,.0f}")
+
+    per_k = 1000 / players / SECONDS_PER_DAY / days
+    ledger = result['ledger_entries'].sum() * per_k
+    print("\nНагрузка на БД на 1000 игроков (в среднем за сутки):")
+    print(f"  записи журнала балансов: {ledger:.3f}/с (строк users + аудит: {ledger * 2:.3f}/с)")
+    print(f"  сброс журнала: до {1 / rules['ledger_flush_seconds']:.2f} транзакций/с на процесс")
+    print(f"  прямые транзакции хэндлеров: {result['direct_tx'].sum() * per_k:.3f}/с, "
+          f"строк: {result['direct_rows'].sum() * per_k:.3f}/с")
+    print(f"  строки фоновых задач: {result['scheduler_rows'].sum() * per_k:.3f}/с")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--players", type=int, default=10000)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--workers", type=int, default=1, help="процессов (игроки делятся между ними)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--report-every", type=int, default=30, help="шаг таблицы в днях")
+    behaviour = parser.add_argument_group("поведение игроков")
+    behaviour.add_argument("--bonus-prob", type=float, default=0.7, help="доля игроков, забирающих бонус за день")
+    behaviour.add_argument("--casino-bets", type=float, default=2.0, help="ставок в день (среднее)")
+    behaviour.add_argument("--casino-bet-share", type=float, default=0.0, help="ставка - доля наличных (0 - минимальная)")
+    behaviour.add_argument("--crime-attempts", type=float, default=1.0, help="ограблений в день (среднее)")
+    behaviour.add_argument("--production-cycles", type=int, default=3, help="циклов производства на бизнес в день")
+    behaviour.add_argument("--units", type=int, default=10, help="единиц сырья на цикл")
+    behaviour.add_argument("--buy-reserve", type=float, default=1.5, help="покупка бизнеса, когда наличных >= цена * X")
+    behaviour.add_argument("--upgrade-reserve", type=float, default=2.0, help="улучшение, когда наличных >= цена * X")
+    behaviour.add_argument("--deposit-share", type=float, default=0.05, help="доля наличных, уходящая в банк за день")
+    behaviour.add_argument("--loan-prob", type=float, default=0.02, help="вероятность взять кредит за день")
+    behaviour.add_argument("--loan-max", type=int, default=50000, help="максимальная сумма кредита")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    rules, market = load_rules()
+    params = {key: value for key, value in vars(args).items()
+              if key not in ("players", "days", "workers", "seed", "report_every")}
+    result = simulate(rules, market, params, args.players, args.days, args.workers, args.seed)
+    report(result, rules, args.players, args.days, args.report_every)
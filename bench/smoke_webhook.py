@@ -0,0 +1,160 @@
+"""
+Локальная проверка webhook-режима.
+
+Поднимает фейковый Bot API сервер, запускает `python main.py webhook` с несколькими
+воркерами на временной SQLite и шлет балансировщику апдейты от разных игроков.
+Проверяет, что каждый игрок получил ответы, ровно один воркер держит аренду
+планировщика, а бонусы из журнала балансов сброшены в БД.
+
+    python bench/smoke_webhook.py --workers 3 --users 12
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+
+from aiohttp import web, ClientSession, ClientError
+
+from common import ROOT
+
+SECRET = "smoke-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class FakeTelegram:
+    """Bot API, отвечающий успехом на любой метод и запоминающий отправленные сообщения."""
+
+    def __init__(self):
+        self.calls: list[tuple[str, dict]] = []
+        self.message_ids = itertools.count(1)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = dict(await request.post())
+        self.calls.append((method.lower(), data))
+        if method.lower() == "sendmessage":
+            chat_id = int(data["chat_id"])
+            result = {"message_id": next(self.message_ids), "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", "")}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def messages(self, chat_id: int) -> list[str]:
+        return [d.get("text", "") for m, d in self.calls if m == "sendmessage" and int(d["chat_id"]) == chat_id]
+
+    def called(self, method: str) -> bool:
+        return any(m == method.lower() for m, _ in self.calls)
+
+
+def message_update(update_id: int, uid: int, text: str) -> dict:
+    return {"update_id": update_id, "message": {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "first_name": f"smoke{uid}"},
+    }}
+
+
+async def wait_for(condition, timeout: float, what: str):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise SystemExit(f"FAIL: не дождались: {what}")
+        await asyncio.sleep(0.2)
+
+
+async def post_update(http: ClientSession, url: str, update: dict, timeout: float = 30):
+    """Доставляет апдейт как Telegram: повторяет, пока балансировщик не ответит 200."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with http.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": SECRET}) as resp:
+                if resp.status == 200:
+                    return
+        except ClientError:
+            pass
+        if time.monotonic() > deadline:
+            raise SystemExit(f"FAIL: апдейт {update['update_id']} не принят")
+        await asyncio.sleep(0.3)
+
+
+async def run(args):
+    telegram = FakeTelegram()
+    app = web.Application()
+    app.router.add_post("/bot{token}/{method}", telegram.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    telegram_port = free_port()
+    await web.TCPSite(runner, "127.0.0.1", telegram_port).start()
+
+    work_dir = tempfile.mkdtemp(prefix="bongo_webhook_")
+    db_path = os.path.join(work_dir, "smoke.db")
+    web_port = free_port()
+    env = dict(
+        os.environ,
+        BOT_TOKEN="123456:SMOKE",
+        MYSQL_URL=f"sqlite:///{db_path}",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{telegram_port}",
+        WEBHOOK_URL="https://bongo.invalid",
+        WEBHOOK_SECRET=SECRET,
+        PORT=str(web_port),
+        WEB_WORKERS=str(args.workers),
+        WORKER_BASE_PORT=str(free_port()),
+        LEDGER_WAL_PATH=os.path.join(work_dir, "balance_ledger.wal"),
+    )
+    proc = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, "main.py"), "webhook", env=env)
+
+    try:
+        await wait_for(lambda: telegram.called("setWebhook"), 30, "setWebhook от балансировщика")
+        url = f"http://127.0.0.1:{web_port}/webhook"
+        uids = list(range(1, args.users + 1))
+        update_ids = itertools.count(1)
+        async with ClientSession() as http:
+            for text in ("/start", "🎁 Бонус"):
+                await asyncio.gather(*(post_update(http, url, message_update(next(update_ids), uid, text)) for uid in uids))
+                await wait_for(lambda: all(len(telegram.messages(uid)) >= (1 if text == "/start" else 2) for uid in uids),
+                               30, f"ответы на {text}")
+
+        for uid in uids:
+            replies = telegram.messages(uid)
+            assert "Добро пожаловать" in replies[0], replies
+            assert "Ежедневный Бонус" in replies[1], replies
+
+        def db_rows(query):
+            with sqlite3.connect(db_path) as conn:
+                return conn.execute(query).fetchall()
+
+        # Журнал балансов сбрасывается раз в LEDGER_FLUSH_SECONDS
+        await wait_for(lambda: db_rows("SELECT COUNT(*) FROM users WHERE balance = 20000")[0][0] == len(uids),
+                       30, "сброс журнала балансов в БД")
+        await wait_for(lambda: db_rows("SELECT COUNT(*) FROM scheduler_lease")[0][0] == 1, 30, "выбор ведущего")
+        holders = db_rows("SELECT holder FROM scheduler_lease WHERE name = 'scheduler'")
+        print(f"OK: {len(uids)} игроков, {args.workers} воркеров, ведущий {holders[0][0]}, "
+              f"запросов к Bot API: {len(telegram.calls)}")
+    finally:
+        if proc.returncode is None:
+            proc.send_signal(signal.SIGTERM)
+            await asyncio.wait_for(proc.wait(), 30)
+        await runner.cleanup()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=3, help="число процессов-воркеров")
+    parser.add_argument("--users", type=int, default=12, help="число синтетических игроков")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -0,0 +1,124 @@
+"""
+Правила экономики BongoCity: данные бизнесов и сырья, денежные константы и расчеты.
+
+Чистый модуль без БД, Telegram и случайности: случайные числа передает вызывающий код.
+Его используют хэндлеры и планировщик main.py и симулятор bench/simulate_economy.py.
+Выход продукции и цены улучшений считаются один раз при импорте в таблицы
+по (business_id, уровень), так что расчеты в хэндлерах - поиск в словаре.
+"""
+
+START_BALANCE = 10000 # Наличные нового игрока
+DAILY_BONUS_AMOUNT = 10000
+CASINO_MIN_BET = 1000
+CASINO_MULTIPLIERS = (0, 0, 0, 0, 0, 0.5, 1.5, 2.0, 3.0) # Равновероятные исходы ставки: 6/9 проигрыш или меньший выигрыш
+CRIME_BASE_CHANCE = 0.35 # Шанс успеха ограбления на 0 уровне работы
+CRIME_CHANCE_PER_JOB_LEVEL = 0.02 # Прибавка к шансу за уровень работы
+CRIME_BET_SHARE = 0.1 # Ставка ограбления - доля наличных (не меньше CASINO_MIN_BET)
+CRIME_WIN_RANGE = (2.5, 4.0) # Выигрыш - ставка, умноженная на случайное число из диапазона
+CRIME_FINE_MULTIPLIER = 1.5 # Множитель штрафа за провал ограбления
+DEFAULT_TAX_RATE = 0.10 # Налог на доход от бизнеса до решения президента
+DEFAULT_LOAN_RATE = 0.01 # Ежедневный процент по кредитам до решения президента
+LOAN_OVERDUE_FINE_MULT = 2 # Штраф за просрочку - ставка кредита, умноженная на это число
+ELECTION_CANDIDATE_FEE = 50000 # Взнос кандидата в президенты (идет в Госбюджет)
+
+# Ресурсы/Сырье (для биржи и производства)
+MARKET_ITEMS = {
+    1: {'name': "Древесина", 'base_price': 500, 'volatility': 0.15},
+    2: {'name': "Железо", 'base_price': 1200, 'volatility': 0.20},
+    3: {'name': "Нефть", 'base_price': 3000, 'volatility': 0.30},
+}
+
+# Бизнесы
+BUSINESSES = {
+    101: {
+        'name': "Лесопилка",
+        'cost': 15000,
+        'req_resource_id': 1, # Древесина
+        'base_payout': 1000, # Базовый доход (единиц продукции)
+        'max_level': 10,
+        'upgrade_cost_mult': 1.5, # Мультипликатор стоимости улучшения
+        'payout_mult': 1.25, # Мультипликатор дохода при улучшении
+        'payout_per_unit': 10, # Стоимость 1 ед. продукции (используется как базовая)
+    },
+    102: {
+        'name': "Шахта",
+        'cost': 50000,
+        'req_resource_id': 2, # Железо
+        'base_payout': 3500,
+        'max_level': 15,
+        'upgrade_cost_mult': 1.6,
+        'payout_mult': 1.3,
+        'payout_per_unit': 15,
+    },
+}
+
+
+def _build_tables(businesses: dict) -> tuple[dict, dict]:
+    payout, upgrade = {}, {}
+    for bid, info in businesses.items():
+        for level in range(1, info['max_level'] + 1):
+            # Выход = Базовый_Выход * (Мультипликатор)^(Уровень-1)
+            payout[(bid, level)] = info['base_payout'] * info['payout_mult'] ** (level - 1)
+            if level < info['max_level']:
+                # Стоимость следующего уровня = Базовая стоимость * (Мультипликатор)^текущий_уровень
+                upgrade[(bid, level)] = int(info['cost'] * info['upgrade_cost_mult'] ** level)
+    return payout, upgrade
+
+# Выход за единицу сырья и цена улучшения на следующий уровень по (business_id, уровень)
+PAYOUT_PER_UNIT, UPGRADE_COST = _build_tables(BUSINESSES)
+
+
+# --- Бизнес ---
+def production_income(bid: int, level: int, units: int) -> int:
+    """Доход с цикла производства: выход уровня на каждую вложенную единицу сырья."""
+    return int(PAYOUT_PER_UNIT[(bid, level)] * units)
+
+def level_payout(bid: int, level: int) -> int:
+    """Выход за единицу сырья на уровне (для меню)."""
+    return int(PAYOUT_PER_UNIT[(bid, level)])
+
+def upgrade_cost(bid: int, level: int) -> int | None:
+    """Цена улучшения с уровня level. None - уровень максимальный."""
+    return UPGRADE_COST.get((bid, level))
+
+def split_tax(gross: int, tax_rate: float) -> tuple[int, int]:
+    """(налог, чистый доход)"""
+    tax = int(gross * tax_rate)
+    return tax, gross - tax
+
+
+# --- Казино и ограбления ---
+def casino_delta(bet: int, multiplier: float) -> int:
+    """Изменение наличных по исходу из CASINO_MULTIPLIERS: 0 - ставка сгорает, 0.5 - минус половина, иначе выигрыш."""
+    if multiplier == 0:
+        return -bet
+    if multiplier == 0.5:
+        return -int(bet * 0.5)
+    return int(bet * multiplier)
+
+def crime_chance(job_level: int) -> float:
+    return CRIME_BASE_CHANCE + job_level * CRIME_CHANCE_PER_JOB_LEVEL
+
+def crime_delta(balance: int, job_level: int, roll: float, win_mult: float) -> int:
+    """
+    Изменение наличных после ограбления: выигрыш (> 0) или штраф (<= 0, не больше наличных).
+    roll - равномерное число из [0, 1), win_mult - из CRIME_WIN_RANGE.
+    """
+    bet = max(balance * CRIME_BET_SHARE, CASINO_MIN_BET)
+    if roll < crime_chance(job_level):
+        return int(bet * win_mult)
+    return -min(int(bet * CRIME_FINE_MULTIPLIER), balance)
+
+
+# --- Кредиты ---
+# Формулы кредитов принимают и массивы numpy (симулятор считает всех игроков разом)
+def _truncate(value):
+    """int() для числа, поэлементное отбрасывание дробной части для массива."""
+    return value.astype("int64") if hasattr(value, "astype") else int(value)
+
+def loan_total_due(amount: int, rate: float, days: int) -> int:
+    """Долг по кредиту через days дней: сумма плюс простые ежедневные проценты."""
+    return amount + _truncate(amount * rate * days)
+
+def loan_overdue_fine(amount: int, rate: float) -> int:
+    return _truncate(amount * rate * LOAN_OVERDUE_FINE_MULT)
@@ -0,0 +1,103 @@
+"""
+Рейтинг игроков BongoCity по чистому капиталу (наличные + банк).
+
+Чистый модуль без БД и Telegram: main.py обновляет капитал игрока после каждой записи
+баланса и перестраивает рейтинг потоковым проходом по users при старте и по расписанию.
+Ключи (-капитал, id игрока) лежат в SortedList: обновление и место игрока - O(log n),
+топ-N - срез с начала списка.
+"""
+import threading
+from typing import Iterable, NamedTuple
+
+from sortedcontainers import SortedList
+
+
+class Entry(NamedTuple):
+    user_id: int
+    net_worth: int
+    name: str | None
+
+
+class Leaderboard:
+    """
+    Рейтинг в памяти процесса. Обновляется из потоков db_executor (UserCache.put)
+    и из event loop, поэтому все операции - под блокировкой.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ranks = SortedList()
+        self._keys: dict[int, tuple[int, int]] = {}
+        self._names: dict[int, str | None] = {}
+        # Игроки, обновленные во время перестройки: их значения новее прочитанных из БД
+        self._touched: set[int] | None = None
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _set(self, uid: int, net_worth: int):
+        key = (-net_worth, uid)
+        old = self._keys.get(uid)
+        if old == key:
+            return
+        if old is not None:
+            self._ranks.remove(old)
+        self._ranks.add(key)
+        self._keys[uid] = key
+
+    def update(self, uid: int, net_worth: int, name: str | None):
+        with self._lock:
+            self._set(uid, net_worth)
+            self._names[uid] = name
+            if self._touched is not None:
+                self._touched.add(uid)
+
+    def adjust(self, uid: int, delta: int):
+        """Сдвигает капитал игрока на delta (фоновые списания и зачисления без свежей строки)."""
+        with self._lock:
+            key = self._keys.get(uid)
+            if key is None:
+                return
+            self._set(uid, -key[0] + delta)
+            if self._touched is not None:
+                self._touched.add(uid)
+
+    def rank(self, uid: int) -> int | None:
+        """Место игрока (с 1) или None, если его нет в рейтинге."""
+        with self._lock:
+            key = self._keys.get(uid)
+            return None if key is None else self._ranks.bisect_left(key) + 1
+
+    def top(self, n: int) -> list[Entry]:
+        with self._lock:
+            return [Entry(uid, -neg, self._names.get(uid)) for neg, uid in self._ranks.islice(0, n)]
+
+    def rebuild(self, rows: Iterable[tuple[int, int, str | None]]) -> int:
+        """
+        Заменяет рейтинг строками (id, капитал, имя). rows читается без блокировки
+        (потоковый запрос к БД); обновления, пришедшие за это время, сохраняются.
+        """
+        with self._lock:
+            self._touched = set()
+        try:
+            keys, names = {}, {}
+            for uid, net_worth, name in rows:
+                keys[uid] = (-int(net_worth), uid)
+                names[uid] = name
+            ranks = SortedList(keys.values())
+        except BaseException:
+            with self._lock:
+                self._touched = None
+            raise
+
+        with self._lock:
+            for uid in self._touched:
+                new, current = keys.get(uid), self._keys[uid]
+                if new is not None:
+                    ranks.remove(new)
+                ranks.add(current)
+                keys[uid] = current
+                names[uid] = self._names.get(uid)
+            self._ranks, self._keys, self._names = ranks, keys, names
+            self._touched = None
+            return len(keys)
@@ -2,30 +2,72 @@
 # === BongoCity Telegram Bot: Полный Код (Python/aiogram) ===
 # =========================================================
 import os
+import sys
+import glob
+import signal
+import socket
 import logging
 import random
 import asyncio
+import contextvars
+import heapq
+import json
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from datetime import datetime, timedelta
+from functools import partial, lru_cache
+from typing import NamedTuple
+
+import numpy as np
 
 # --- Aiogram Imports ---
 from aiogram.client.default import DefaultBotProperties
-from aiogram import Bot, Dispatcher, Router, types, F
+from aiogram import Bot, Dispatcher, Router, BaseMiddleware, types, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType, DefaultKeyBuilder
 from aiogram.types import (
     InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton,
     ReplyKeyboardMarkup, BotCommand, BotCommandScopeDefault
 )
-from aiogram.exceptions import TelegramAPIError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web, ClientSession, ClientError
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest, TelegramNotFound,
+    TelegramMigrateToChat, TelegramNetworkError, TelegramServerError
+)
 
 # --- SQLAlchemy Imports ---
-from sqlalchemy import create_engine, Column, Integer, String, BigInteger, Float, DateTime, Boolean
+from sqlalchemy import (
+    event, create_engine, Column, Integer, String, Text, BigInteger, Float, Date, DateTime, Boolean, Enum, Index,
+    update, select, delete, bindparam, inspect, text, func, or_, and_
+)
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
+# --- Правила игры и биржевой стакан ---
+from game_rules import (
+    START_BALANCE, DAILY_BONUS_AMOUNT, CASINO_MIN_BET, CASINO_MULTIPLIERS, CRIME_WIN_RANGE,
+    DEFAULT_TAX_RATE, DEFAULT_LOAN_RATE, LOAN_OVERDUE_FINE_MULT, ELECTION_CANDIDATE_FEE, MARKET_ITEMS, BUSINESSES,
+    production_income, level_payout, upgrade_cost, split_tax, casino_delta, crime_delta,
+    loan_total_due, loan_overdue_fine,
+)
+from orderbook import Exchange, Order
+from leaderboard import Leaderboard
+
 # =========================================================
 # === 1. КОНФИГУРАЦИЯ И ИНИЦИАЛИЗАЦИЯ ===
 # =========================================================
@@ -33,21 +75,28 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 # Установите свой токен бота и URL базы данных
 TOKEN = os.getenv("BOT_TOKEN")
 MYSQL_URL = os.getenv("MYSQL_URL") # Можно использовать PostgreSQL/MySQL для продакшна
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL") # Свой Bot API сервер (по умолчанию api.telegram.org)
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Новая, правильная строка:
-bot = Bot(TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN))
-dp = Dispatcher()
+bot = Bot(
+    TOKEN,
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None,
+    default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN),
+)
 router = Router()
-dp.include_router(router)
 scheduler = AsyncIOScheduler()
 
 # Инициализация БД
-engine = create_engine(MYSQL_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Все обращения к БД выполняются в отдельном пуле потоков (см. run_db),
+# размер пула соединений совпадает с количеством потоков.
+DB_WORKERS = int(os.getenv("DB_WORKERS", "8"))
+engine = create_engine(MYSQL_URL, pool_size=DB_WORKERS, max_overflow=0, pool_pre_ping=True)
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="db")
 
 # =========================================================
 # === 2. КОНСТАНТЫ И ДАННЫЕ ИГРЫ ===
@@ -60,45 +109,91 @@ BTN_MARKET = "📈 Биржа Ресурсов"
 BTN_CRIME = "🔫 Ограбить Банк"
 BTN_GOV_OFFICE = "🦅 Офис Президента"
 
-# Экономические константы
-DAILY_BONUS_AMOUNT = 10000
-CASINO_MIN_BET = 1000
+# Экономические константы (денежные правила, бизнесы и сырье - в game_rules.py)
 PRODUCTION_CYCLE_HOURS = 2 # Время производства одного цикла (в часах)
 LOAN_CYCLE_DAYS = 7 # Периодичность начисления штрафа за просрочку кредита (в днях)
-CRIME_FINE_MULTIPLIER = 1.5 # Множитель штрафа за провал ограбления
+LOAN_FINE_HOUR = 12 # Час ежедневного начисления штрафов (пропущенные дни начисляются при следующем запуске)
+CRIME_COOLDOWN_HOURS = 6
 CRIME_JAIL_TIME_MINUTES = 60 # Время тюрьмы в минутах
 TAX_MAX_RATE = 0.50 # Максимальный налог 50%
+PRODUCTION_STATES = ("IDLE", "PRODUCING", "READY") # Состояния производства бизнеса
+BUDGET_SHARDS = 16 # Число строк Госбюджета (см. credit_budget)
+
+# Исходящие уведомления (см. NotificationQueue). Лимиты Telegram: ~30 сообщений/с всего,
+# 1 сообщение/с в личный чат, 20 сообщений/мин в группу.
+NOTIFY_WORKERS = 8
+NOTIFY_GLOBAL_RATE = 25 # сообщений в секунду (с запасом до лимита)
+NOTIFY_PRIVATE_INTERVAL = 1.0 # секунд между сообщениями в один личный чат
+NOTIFY_GROUP_INTERVAL = 3.0 # секунд между сообщениями в одну группу
+NOTIFY_MAX_RETRIES = 3
+
+# Рассылка по групповым чатам (см. BroadcastService)
+BROADCAST_STATES = ("RUNNING", "DONE")
+BROADCAST_PAGE_SIZE = 200 # Чатов за выборку (по chat_id); после каждой страницы сохраняется прогресс
+BROADCAST_MAX_FAILURES = 3 # Чат удаляется после стольких рассылок подряд с ошибкой
+
+# Метрики хэндлеров (см. HandlerMetricsMiddleware)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # 0 - HTTP-эндпоинт /metrics выключен
+METRICS_LOG_MINUTES = 15 # Периодическая сводка в лог
+
+# Кэш пользователей (см. UserCache)
+USER_CACHE_MAX_SIZE = 10000
+USER_CACHE_TTL_SECONDS = 60
+MARKET_SCREEN_TTL_SECONDS = 60 # Кэш экрана биржи (сбрасывается и при изменении цен)
+
+# Рейтинг по чистому капиталу (см. Leaderboard)
+LEADERBOARD_SIZE = 10 # Игроков в /top
+LEADERBOARD_REBUILD_MINUTES = 10 # Сверка с БД (фоновые списания, игроки других воркеров)
+LEADERBOARD_SCAN_BATCH = 1000 # Строк users за одну выборку при перестройке
+
+# Блокировки игроков (см. UserLockRegistry)
+USER_LOCK_SHARDS = 64
+
+# Webhook-режим: балансировщик и несколько процессов-воркеров (см. run_webhook)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") # Публичный адрес бота, например https://bongo.example.com
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEB_PORT = int(os.getenv("PORT", "8080"))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "4"))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "8100")) # Воркер i слушает 127.0.0.1:WORKER_BASE_PORT+i
+LEADER_LEASE_SECONDS = 30 # Аренда роли ведущего (фоновые задачи выполняет один процесс)
+ECONOMY_SYNC_SECONDS = 5 # Сверка снимка экономики с election_state (изменения из других процессов)
+
+# Хранилище FSM (см. create_fsm_storage): memory - в процессе; sql - таблица fsm_states,
+# общая для процессов и переживающая перезапуск (+1 запрос к БД на апдейт); redis - REDIS_URL
+FSM_STORAGE = os.getenv("FSM_STORAGE", "memory")
+FSM_STATE_TTL_MINUTES = 30 # Брошенные диалоги (кредит, сырье, выдача бюджета) забываются
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Журнал балансов с отложенной записью (см. BalanceLedger)
+LEDGER_WAL_PATH = os.getenv("LEDGER_WAL_PATH", "data/balance_ledger.wal")
+LEDGER_FLUSH_SECONDS = 2 # Периодичность сброса изменений балансов в БД
+LEDGER_FLUSH_THRESHOLD = 500 # Внеочередной сброс при таком числе несохраненных записей
+LEDGER_FIELDS = ("last_daily_bonus", "last_crime_time", "arrest_expires") # Поля users, которые пишет журнал
 
-# Ресурсы/Сырье (для биржи и производства)
-MARKET_ITEMS = {
-    1: {'name': "Древесина", 'base_price': 500, 'volatility': 0.15},
-    2: {'name': "Железо", 'base_price': 1200, 'volatility': 0.20},
-    3: {'name': "Нефть", 'base_price': 3000, 'volatility': 0.30},
-}
-
-# Бизнесы
-BUSINESSES = {
-    101: {
-        'name': "Лесопилка",
-        'cost': 15000,
-        'req_resource_id': 1, # Древесина
-        'base_payout': 1000, # Базовый доход (единиц продукции)
-        'max_level': 10,
-        'upgrade_cost_mult': 1.5, # Мультипликатор стоимости улучшения
-        'payout_mult': 1.25, # Мультипликатор дохода при улучшении
-        'payout_per_unit': 10, # Стоимость 1 ед. продукции (используется как базовая)
-    },
-    102: {
-        'name': "Шахта",
-        'cost': 50000,
-        'req_resource_id': 2, # Железо
-        'base_payout': 3500,
-        'max_level': 15,
-        'upgrade_cost_mult': 1.6,
-        'payout_mult': 1.3,
-        'payout_per_unit': 15,
-    },
-}
+# Рынок (см. MarketEngine)
+MARKET_MEAN_REVERSION = 0.05 # Доля отклонения от base_price (в логарифме), возвращаемая за тик
+MARKET_SHOCK_CORRELATION = 0.3 # Корреляция ценовых шоков между товарами
+MARKET_HISTORY_TICKS = 24 # Тиков истории в памяти (тик - раз в час)
+
+# Биржевой стакан (заявки игроков, см. ExchangeService)
+ORDER_STATES = ("NEW", "OPEN", "FILLED", "CANCELLED")
+ORDER_SIDES = ("BUY", "SELL")
+EXCHANGE_POLL_SECONDS = 1.0 # Как часто ведущий забирает новые заявки и отмены
+EXCHANGE_BATCH_SIZE = 500 # Заявок за одну транзакцию сведения
+EXCHANGE_MAX_OPEN_ORDERS = 20 # Открытых заявок на игрока
+EXCHANGE_DEPTH_LEVELS = 5 # Уровней цены на экране стакана
+EXCHANGE_PRICE_LIMIT_MULT = 10 # Цена заявки - не выше base_price * множитель
+
+# Выборы президента (см. ElectionService)
+ELECTION_STATES = ("REGISTRATION", "VOTING", "CLOSED")
+ELECTION_INTERVAL_DAYS = 7 # От конца прошлых выборов до объявления следующих
+ELECTION_REGISTRATION_HOURS = 24
+ELECTION_VOTING_HOURS = 24
+ELECTION_MAX_CANDIDATES = 10
+ELECTION_TALLY_SECONDS = 5 # Как часто ведущий досчитывает новые голоса и сохраняет итог
+ELECTION_TALLY_BATCH = 5000 # Голосов за одну транзакцию подсчета
+ELECTION_CLOSE_GRACE_SECONDS = 10 # Ожидание голосов, принятых перед самым концом голосования
 
 
 # =========================================================
@@ -110,7 +205,7 @@ class User(Base):
     __tablename__ = "users"
     telegram_id = Column(BigInteger, primary_key=True, index=True)
     username = Column(String, default="Неизвестный")
-    balance = Column(BigInteger, default=10000)
+    balance = Column(BigInteger, default=START_BALANCE)
     bank_balance = Column(BigInteger, default=0)
     job_level = Column(Integer, default=1)
     last_daily_bonus = Column(DateTime, default=datetime(2023, 1, 1))
@@ -119,45 +214,106 @@ class User(Base):
     is_admin = Column(Boolean, default=False)
     is_president = Column(Boolean, default=False)
 
+    __table_args__ = (
+        # Освобождение из тюрьмы: частичный индекс там, где диалект это поддерживает
+        Index("ix_users_arrest_expires", "arrest_expires",
+              postgresql_where=arrest_expires.isnot(None), sqlite_where=arrest_expires.isnot(None)),
+    )
+
 class OwnedBusiness(Base):
     """Модель владения бизнесом"""
     __tablename__ = "owned_businesses"
     id = Column(Integer, primary_key=True)
-    user_id = Column(BigInteger, index=True)
+    user_id = Column(BigInteger)
     business_id = Column(Integer) # ID из словаря BUSINESSES
     count = Column(Integer, default=1) # Количество одинаковых бизнесов
     upgrade_level = Column(Integer, default=1)
     
     # Состояние производства
-    production_state = Column(String, default="IDLE") # IDLE, PRODUCING, READY
+    production_state = Column(Enum(*PRODUCTION_STATES, name="production_state"), nullable=False, default="IDLE")
     production_start_time = Column(DateTime, nullable=True)
     resource_units = Column(Integer, default=0) # Единицы сырья, вложенные в производство
 
+    __table_args__ = (
+        # biz_production_start / biz_collect / восстановление очереди производства
+        Index("ix_owned_businesses_user_state", "user_id", "production_state"),
+        # biz_res_input_finish / biz_buy
+        Index("ix_owned_businesses_user_biz_state", "user_id", "business_id", "production_state"),
+    )
+
 class BankLoan(Base):
     """Модель кредитов"""
     __tablename__ = "bank_loans"
     id = Column(Integer, primary_key=True)
-    user_id = Column(BigInteger, index=True)
+    user_id = Column(BigInteger)
     amount = Column(BigInteger)
     interest_rate = Column(Float)
     issue_date = Column(DateTime, default=datetime.now)
     due_date = Column(DateTime)
     paid = Column(Boolean, default=False)
 
+    __table_args__ = (
+        # Меню банка, профиль, погашение
+        Index("ix_bank_loans_user_paid", "user_id", "paid"),
+        # Штрафы за просрочку
+        Index("ix_bank_loans_paid_due", "paid", "due_date"),
+    )
+
 class PresidentialBudget(Base):
-    """Модель Госбюджета"""
+    """Модель Госбюджета: BUDGET_SHARDS строк, бюджет - сумма по всем строкам"""
     __tablename__ = "presidential_budget"
     id = Column(Integer, primary_key=True)
     budget = Column(BigInteger, default=0)
+    shard = Column(Integer)
+
+    __table_args__ = (
+        Index("ix_presidential_budget_shard", "shard", unique=True),
+    )
 
 class ElectionState(Base):
     """Модель состояния выборов и экономики"""
     __tablename__ = "election_state"
     id = Column(Integer, primary_key=True)
     current_president_id = Column(BigInteger, nullable=True)
-    tax_rate = Column(Float, default=0.10) # 10% налог на доход от бизнеса
-    loan_interest_rate = Column(Float, default=0.01) # 1% ежедневный процент по кредитам
+    tax_rate = Column(Float, default=DEFAULT_TAX_RATE) # Налог на доход от бизнеса
+    loan_interest_rate = Column(Float, default=DEFAULT_LOAN_RATE) # Ежедневный процент по кредитам
     last_election_time = Column(DateTime, default=datetime(2023, 1, 1))
+    version = Column(Integer, nullable=False, default=0) # Растет при каждом изменении (по нему процессы сверяют снимок)
+
+class Election(Base):
+    """Выборы президента: регистрация кандидатов, затем голосование (ведет ElectionService)"""
+    __tablename__ = "elections"
+    id = Column(Integer, primary_key=True)
+    status = Column(Enum(*ELECTION_STATES, name="election_status"), nullable=False, default="REGISTRATION", index=True)
+    registration_ends = Column(DateTime, nullable=False)
+    voting_ends = Column(DateTime, nullable=False)
+    winner_id = Column(BigInteger, nullable=True)
+    total_votes = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+
+class ElectionCandidate(Base):
+    """Кандидат выборов. votes - сохраненный итог подсчета (досчитывается пачками, без GROUP BY)"""
+    __tablename__ = "election_candidates"
+    election_id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    votes = Column(Integer, nullable=False, default=0)
+    registered_at = Column(DateTime, default=datetime.now)
+
+class ElectionVote(Base):
+    """Голос игрока (один на выборы). counted - голос уже учтен в ElectionCandidate.votes"""
+    __tablename__ = "election_votes"
+    id = Column(Integer, primary_key=True)
+    election_id = Column(Integer, nullable=False)
+    voter_id = Column(BigInteger, nullable=False)
+    candidate_id = Column(BigInteger, nullable=False)
+    counted = Column(Boolean, nullable=False, default=False)
+    created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        Index("ix_election_votes_voter", "election_id", "voter_id", unique=True),
+        # Неучтенные голоса для ElectionService
+        Index("ix_election_votes_uncounted", "counted", "id"),
+    )
 
 class MarketItemPrice(Base):
     """Модель динамических цен на сырье"""
@@ -165,27 +321,228 @@ class MarketItemPrice(Base):
     item_id = Column(Integer, primary_key=True, index=True) # ID из MARKET_ITEMS
     current_price = Column(BigInteger)
 
+class MarketPriceTick(Base):
+    """История цен: строка на товар за тик (только добавление)"""
+    __tablename__ = "market_price_ticks"
+    tick_time = Column(DateTime, primary_key=True)
+    item_id = Column(Integer, primary_key=True, autoincrement=False)
+    price = Column(BigInteger)
+
+class InventoryItem(Base):
+    """Склад сырья игрока. Пишется только относительными UPDATE (сделки сводит другой процесс)."""
+    __tablename__ = "inventory"
+    user_id = Column(BigInteger, primary_key=True)
+    item_id = Column(Integer, primary_key=True, autoincrement=False)
+    quantity = Column(BigInteger, default=0, nullable=False)
+
+class MarketOrder(Base):
+    """
+    Лимитная заявка игрока. Средства (покупка) или сырье (продажа) списываются при подаче.
+    payout - деньги к зачислению владельцу (выручка, разница цены, возврат), их забирает
+    claim_market_payouts в процессе игрока.
+    """
+    __tablename__ = "market_orders"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(BigInteger, nullable=False)
+    item_id = Column(Integer, nullable=False)
+    side = Column(Enum(*ORDER_SIDES, name="order_side"), nullable=False)
+    price = Column(BigInteger, nullable=False)
+    quantity = Column(BigInteger, nullable=False)
+    remaining = Column(BigInteger, nullable=False)
+    status = Column(Enum(*ORDER_STATES, name="order_status"), nullable=False, default="NEW")
+    cancel_requested = Column(Boolean, nullable=False, default=False)
+    payout = Column(BigInteger, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        # Новые заявки и отмены для ExchangeService
+        Index("ix_market_orders_status_cancel", "status", "cancel_requested"),
+        # Стакан на экране товара
+        Index("ix_market_orders_book", "item_id", "status", "side", "price"),
+        # Заявки игрока и его невыплаченная выручка
+        Index("ix_market_orders_user_status", "user_id", "status"),
+        Index("ix_market_orders_user_payout", "user_id", "payout"),
+    )
+
+class MarketFill(Base):
+    """Сделки биржевого стакана (только добавление)"""
+    __tablename__ = "market_fills"
+    id = Column(Integer, primary_key=True)
+    item_id = Column(Integer)
+    buy_order_id = Column(Integer)
+    sell_order_id = Column(Integer)
+    buyer_id = Column(BigInteger)
+    seller_id = Column(BigInteger)
+    price = Column(BigInteger)
+    quantity = Column(BigInteger)
+    created_at = Column(DateTime, default=datetime.now)
+
 class Chat(Base):
     """Модель для хранения ID чатов для рассылки"""
     __tablename__ = "chats"
     chat_id = Column(BigInteger, primary_key=True)
+    failures = Column(Integer, nullable=False, default=0) # Рассылки подряд, не доставленные в чат
+
+class Broadcast(Base):
+    """Рассылка по чатам. last_chat_id - чаты до него включительно обработаны (продолжение после перезапуска)"""
+    __tablename__ = "broadcasts"
+    id = Column(Integer, primary_key=True)
+    text = Column(Text, nullable=False)
+    status = Column(Enum(*BROADCAST_STATES, name="broadcast_status"), nullable=False, default="RUNNING", index=True)
+    last_chat_id = Column(BigInteger, nullable=True)
+    sent = Column(Integer, nullable=False, default=0)
+    dead = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+
+class BalanceLedgerEntry(Base):
+    """Журнал изменений балансов (аудит). Пишется в одной транзакции с применением изменений к users."""
+    __tablename__ = "balance_ledger"
+    id = Column(Integer, primary_key=True)
+    entry_id = Column(String(32), unique=True, nullable=False)
+    user_id = Column(BigInteger, index=True)
+    balance_delta = Column(BigInteger, default=0)
+    bank_delta = Column(BigInteger, default=0)
+    reason = Column(String(32))
+    created_at = Column(DateTime, default=datetime.now)
+
+class SchedulerLease(Base):
+    """Аренда роли ведущего процесса (см. LeaderElection)"""
+    __tablename__ = "scheduler_lease"
+    name = Column(String(32), primary_key=True)
+    holder = Column(String(64))
+    expires_at = Column(DateTime)
+
+class StageCheckpoint(Base):
+    """Последний обработанный день фоновых этапов с суточным циклом (штрафы по кредитам)"""
+    __tablename__ = "stage_checkpoints"
+    name = Column(String(32), primary_key=True)
+    processed_through = Column(Date, nullable=False)
+
+class FsmState(Base):
+    """Состояния FSM игроков (SqlFsmStorage)"""
+    __tablename__ = "fsm_states"
+    key = Column(String(255), primary_key=True)
+    state = Column(String(100))
+    data = Column(Text)
+    expires_at = Column(DateTime, index=True)
+
+class SchemaVersion(Base):
+    """Примененные миграции схемы"""
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True)
+    description = Column(String(255))
+    applied_at = Column(DateTime, default=datetime.now)
+
+
+# --- Миграции схемы ---
+# create_all создает только отсутствующие таблицы, поэтому изменения существующих таблиц
+# оформляются миграциями. Каждая миграция идемпотентна: на новой БД она ничего не меняет.
+
+def _create_missing_indexes(conn, table):
+    existing = {ix['name'] for ix in inspect(conn).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(conn)
+
+def _drop_index_if_exists(conn, table_name: str, index_name: str):
+    if index_name not in {ix['name'] for ix in inspect(conn).get_indexes(table_name)}:
+        return
+    if conn.dialect.name == "mysql":
+        conn.execute(text(f"DROP INDEX {index_name} ON {table_name}"))
+    else:
+        conn.execute(text(f"DROP INDEX {index_name}"))
+
+def _migration_composite_indexes(conn):
+    for table in (User.__table__, OwnedBusiness.__table__, BankLoan.__table__):
+        _create_missing_indexes(conn, table)
+    # Одиночные индексы по user_id покрываются составными (префикс)
+    _drop_index_if_exists(conn, "owned_businesses", "ix_owned_businesses_user_id")
+    _drop_index_if_exists(conn, "bank_loans", "ix_bank_loans_user_id")
+
+def _migration_compact_production_state(conn):
+    conn.execute(text("UPDATE owned_businesses SET production_state = 'IDLE' WHERE production_state IS NULL"))
+    values = ", ".join(f"'{state}'" for state in PRODUCTION_STATES)
+    if conn.dialect.name == "mysql":
+        # VARCHAR -> ENUM (1 байт на строку)
+        conn.execute(text(
+            f"ALTER TABLE owned_businesses MODIFY production_state ENUM({values}) NOT NULL DEFAULT 'IDLE'"
+        ))
+    elif conn.dialect.name == "postgresql":
+        conn.execute(text(
+            f"DO $$ BEGIN CREATE TYPE production_state AS ENUM ({values}); "
+            f"EXCEPTION WHEN duplicate_object THEN NULL; END $$"
+        ))
+        conn.execute(text(
+            "ALTER TABLE owned_businesses ALTER COLUMN production_state TYPE production_state "
+            "USING production_state::production_state"
+        ))
+    # SQLite хранит значения как есть, менять нечего
+
+def _migration_shard_budget(conn):
+    columns = {c['name'] for c in inspect(conn).get_columns("presidential_budget")}
+    if "shard" not in columns:
+        conn.execute(text("ALTER TABLE presidential_budget ADD COLUMN shard INTEGER"))
+        ids = conn.execute(text("SELECT id FROM presidential_budget ORDER BY id")).scalars().all()
+        for shard, row_id in enumerate(ids):
+            conn.execute(text("UPDATE presidential_budget SET shard = :shard WHERE id = :id"), {"shard": shard, "id": row_id})
+    _create_missing_indexes(conn, PresidentialBudget.__table__)
+    # Недостающие строки-шарды создает init_db
+
+def _migration_chat_failures(conn):
+    columns = {c['name'] for c in inspect(conn).get_columns("chats")}
+    if "failures" not in columns:
+        conn.execute(text("ALTER TABLE chats ADD COLUMN failures INTEGER NOT NULL DEFAULT 0"))
+
+def _migration_economy_version(conn):
+    columns = {c['name'] for c in inspect(conn).get_columns("election_state")}
+    if "version" not in columns:
+        conn.execute(text("ALTER TABLE election_state ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+MIGRATIONS = [
+    (1, "Составные индексы под запросы планировщика и бизнес-центра", _migration_composite_indexes),
+    (2, "production_state: VARCHAR -> ENUM", _migration_compact_production_state),
+    (3, "Госбюджет: строки-шарды", _migration_shard_budget),
+    (4, "Чаты: счетчик недоставленных рассылок", _migration_chat_failures),
+    (5, "Версия состояния экономики", _migration_economy_version),
+]
+
+def run_migrations():
+    """Применяет миграции, которых еще нет в schema_version (каждая в своей транзакции)."""
+    with engine.connect() as conn:
+        applied = set(conn.execute(select(SchemaVersion.version)).scalars())
+
+    for version, description, migrate in MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as conn:
+            migrate(conn)
+            conn.execute(SchemaVersion.__table__.insert().values(
+                version=version, description=description, applied_at=datetime.now()
+            ))
+        logging.info(f"Миграция {version} применена: {description}")
 
 
 def init_db():
     """Инициализация БД и базовых записей"""
     try:
         Base.metadata.create_all(bind=engine)
+        run_migrations()
         
         with SessionLocal() as s:
-            # 1. Инициализация Госбюджета
-            if not s.query(PresidentialBudget).first():
-                s.add(PresidentialBudget(budget=1000000))
-                s.commit()
+            # 1. Инициализация Госбюджета (стартовая сумма - в шарде 0)
+            existing_shards = {shard for (shard,) in s.query(PresidentialBudget.shard)}
+            for shard in range(BUDGET_SHARDS):
+                if shard not in existing_shards:
+                    s.add(PresidentialBudget(shard=shard, budget=0 if existing_shards or shard else 1000000))
+            s.commit()
             
             # 2. Инициализация Состояния Выборов/Экономики
             if not s.query(ElectionState).first():
                 s.add(ElectionState())
                 s.commit()
+            refresh_economy(s.query(ElectionState).first())
 
             # 3. Инициализация цен на рынке
             for item_id, item_info in MARKET_ITEMS.items():
@@ -214,15 +571,681 @@ class GameStates(StatesGroup):
     pres_tax_input = State()
     pres_loan_rate_input = State()
     pres_give_budget = State()
+    market_city_qty = State() # Покупка сырья у города на склад
+    market_order_input = State() # Цена и количество лимитной заявки
+
+def _state_name(state: StateType) -> str | None:
+    return state.state if isinstance(state, State) else state
+
+class TTLMemoryStorage(BaseStorage):
+    """FSM в памяти процесса. Записи, которые не менялись дольше ttl, удаляются."""
+
+    def __init__(self, ttl: timedelta):
+        self.ttl = ttl.total_seconds()
+        self._records: dict[StorageKey, tuple[float, str | None, dict]] = {}
+
+    def _get(self, key: StorageKey) -> tuple[float, str | None, dict] | None:
+        record = self._records.get(key)
+        if record and record[0] < time.monotonic():
+            del self._records[key]
+            return None
+        return record
+
+    def _put(self, key: StorageKey, state: str | None, data: dict):
+        if state is None and not data:
+            self._records.pop(key, None)
+        else:
+            self._records[key] = (time.monotonic() + self.ttl, state, data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get(key)
+        self._put(key, _state_name(state), record[2] if record else {})
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        record = self._get(key)
+        return record[1] if record else None
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        record = self._get(key)
+        self._put(key, record[1] if record else None, dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        record = self._get(key)
+        return dict(record[2]) if record else {}
+
+    async def expire(self):
+        now = time.monotonic()
+        for key in [k for k, (expires, _, _) in self._records.items() if expires < now]:
+            del self._records[key]
+
+    async def close(self) -> None:
+        self._records.clear()
+
+def _load_fsm_record(key: str) -> tuple[str | None, dict]:
+    with SessionLocal() as s:
+        row = s.query(FsmState).filter(FsmState.key == key, FsmState.expires_at > datetime.now()).first()
+    if row is None:
+        return None, {}
+    return row.state, json.loads(row.data or "{}")
+
+def _save_fsm_record(key: str, ttl: timedelta, **values):
+    """Меняет state и/или data записи (истекшая запись считается пустой)."""
+    now = datetime.now()
+    for attempt in range(2):
+        with SessionLocal() as s:
+            row = s.get(FsmState, key)
+            if row is None:
+                row = FsmState(key=key)
+                s.add(row)
+            elif row.expires_at <= now:
+                row.state, row.data = None, None
+            if 'state' in values:
+                row.state = values['state']
+            if 'data' in values:
+                row.data = json.dumps(values['data']) if values['data'] else None
+            if row.state is None and row.data is None:
+                if inspect(row).persistent:
+                    s.delete(row)
+                else:
+                    s.expunge(row)
+            else:
+                row.expires_at = now + ttl
+            try:
+                s.commit()
+                return
+            except IntegrityError:
+                # Запись одновременно создал другой процесс - повторяем поверх нее
+                if attempt:
+                    raise
+
+def _expire_fsm_records() -> int:
+    with SessionLocal() as s:
+        deleted = s.execute(delete(FsmState).where(FsmState.expires_at <= datetime.now())).rowcount
+        s.commit()
+        return deleted
+
+class SqlFsmStorage(BaseStorage):
+    """FSM в таблице fsm_states: общая для воркеров и переживает перезапуск. Записи живут ttl после изменения."""
+
+    def __init__(self, ttl: timedelta):
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await run_db(_save_fsm_record, self.key_builder.build(key), self.ttl, state=_state_name(state))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await run_db(_load_fsm_record, self.key_builder.build(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        await run_db(_save_fsm_record, self.key_builder.build(key), self.ttl, data=dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        _, data = await run_db(_load_fsm_record, self.key_builder.build(key))
+        return data
+
+    async def expire(self):
+        await run_db(_expire_fsm_records)
+
+    async def close(self) -> None:
+        pass
+
+def create_fsm_storage(kind: str) -> BaseStorage:
+    ttl = timedelta(minutes=FSM_STATE_TTL_MINUTES)
+    if kind == "sql":
+        return SqlFsmStorage(ttl)
+    if kind == "redis":
+        # Требует пакет redis (pip install redis)
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(REDIS_URL, state_ttl=ttl, data_ttl=ttl)
+    return TTLMemoryStorage(ttl)
+
+fsm_storage = create_fsm_storage(FSM_STORAGE)
+dp = Dispatcher(storage=fsm_storage)
+dp.include_router(router)
     
 # =========================================================
 # === 5. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 # =========================================================
 
-def get_user(uid: int) -> User | None:
-    """Получает пользователя из БД или None, если не найден."""
+async def run_db(func, *args, **kwargs):
+    """
+    Выполняет синхронную функцию работы с БД в пуле db_executor.
+    Блокировки строк (with_for_update) ждут в потоке пула и не останавливают event loop.
+    """
+    loop = asyncio.get_running_loop()
+    # Контекст копируется в поток, чтобы SQL-запросы засчитывались текущему хэндлеру
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(db_executor, partial(ctx.run, func, *args, **kwargs))
+
+# --- Метрики хэндлеров ---
+class RequestMetrics:
+    """Счетчики одного апдейта: SQL-запросы, ожидание блокировок, время в Bot API."""
+    __slots__ = ("sql", "lock_wait", "telegram_seconds")
+
+    def __init__(self):
+        self.sql = 0
+        self.lock_wait = 0.0
+        self.telegram_seconds = 0.0
+
+class HandlerStats:
+    """Накопленные метрики одного хэндлера."""
+    __slots__ = ("calls", "errors", "seconds", "max_seconds", "sql", "lock_wait", "telegram_seconds")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.sql = 0
+        self.lock_wait = 0.0
+        self.telegram_seconds = 0.0
+
+_request_metrics: contextvars.ContextVar[RequestMetrics | None] = contextvars.ContextVar("request_metrics", default=None)
+handler_stats: dict[str, HandlerStats] = {}
+
+@event.listens_for(engine, "before_cursor_execute")
+def _sql_started(conn, cursor, statement, parameters, context, executemany):
+    # На контексте выполнения, а не в conn.info: при ошибке запроса after_cursor_execute
+    # не вызывается, и значение исчезает вместе с контекстом
+    context._query_start = time.perf_counter()
+
+@event.listens_for(engine, "after_cursor_execute")
+def _sql_finished(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_start
+    m = _request_metrics.get()
+    if m is None:
+        return
+    m.sql += 1
+    # Время SELECT ... FOR UPDATE - в основном ожидание блокировки строки
+    if "FOR UPDATE" in statement:
+        m.lock_wait += elapsed
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    """Считает время запросов к Bot API (send_message, answer и т.д.) для текущего хэндлера."""
+
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            m = _request_metrics.get()
+            if m is not None:
+                m.telegram_seconds += time.perf_counter() - started
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Время, число SQL-запросов, ожидание блокировок и время в Bot API для каждого хэндлера.
+    Подключается как inner-middleware: только на этом этапе известен выбранный хэндлер.
+    """
+
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        name = handler_obj.callback.__name__ if handler_obj else "unknown"
+        m = RequestMetrics()
+        token = _request_metrics.set(m)
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            _request_metrics.reset(token)
+            stats = handler_stats.setdefault(name, HandlerStats())
+            stats.calls += 1
+            stats.errors += failed
+            stats.seconds += elapsed
+            stats.max_seconds = max(stats.max_seconds, elapsed)
+            stats.sql += m.sql
+            stats.lock_wait += m.lock_wait
+            stats.telegram_seconds += m.telegram_seconds
+
+router.message.middleware(HandlerMetricsMiddleware())
+router.callback_query.middleware(HandlerMetricsMiddleware())
+bot.session.middleware(TelegramTimingMiddleware())
+
+class UserCache:
+    """
+    LRU-кэш строк User с TTL (in-process).
+    Закэшированные объекты отсоединены от сессии и используются только для чтения:
+    меню, права (is_admin/is_president), балансы и кулдауны.
+    Пишущие транзакции после коммита кладут свежую строку через put(),
+    фоновые задачи сбрасывают затронутых игроков через invalidate().
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._data: OrderedDict[int, tuple[float, User]] = OrderedDict()
+        # Счетчики изменений хранятся, только пока игрок в кэше или его строка загружается
+        self._generation: dict[int, int] = {}
+        self._loading: dict[int, int] = {}
+        # put() вызывается из потоков db_executor
+        self._lock = threading.Lock()
+
+    def get(self, uid: int) -> User | None:
+        with self._lock:
+            entry = self._data.get(uid)
+            if entry is None:
+                return None
+            stored_at, u = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._data[uid]
+                self._forget(uid)
+                return None
+            self._data.move_to_end(uid)
+            return u
+
+    @contextmanager
+    def loading(self, uid: int):
+        """Загрузка строки из БД: отдает счетчик изменений игрока для put(u, generation)."""
+        with self._lock:
+            self._loading[uid] = self._loading.get(uid, 0) + 1
+            generation = self._generation.get(uid, 0)
+        try:
+            yield generation
+        finally:
+            with self._lock:
+                if self._loading[uid] > 1:
+                    self._loading[uid] -= 1
+                else:
+                    del self._loading[uid]
+                    self._forget(uid)
+
+    def _forget(self, uid: int):
+        """Удаляет счетчик игрока, которого нет в кэше и чью строку никто не загружает (под блокировкой)."""
+        if uid not in self._data and uid not in self._loading:
+            self._generation.pop(uid, None)
+
+    def put(self, u: User, generation: int | None = None):
+        """Кладет строку в кэш. С generation запись пропускается, если игрока успели изменить."""
+        with self._lock:
+            if generation is not None and generation != self._generation.get(u.telegram_id, 0):
+                return
+            self._generation[u.telegram_id] = self._generation.get(u.telegram_id, 0) + 1
+            self._data[u.telegram_id] = (time.monotonic(), u)
+            self._data.move_to_end(u.telegram_id)
+            while len(self._data) > self.max_size:
+                evicted, _ = self._data.popitem(last=False)
+                self._forget(evicted)
+        # Свежая строка обновляет рейтинг, если у игрока нет копии в журнале балансов (она новее)
+        if balance_ledger.peek(u.telegram_id) is None:
+            leaderboard.update(u.telegram_id, u.balance + u.bank_balance, u.username)
+
+    def invalidate(self, uid: int):
+        with self._lock:
+            self._data.pop(uid, None)
+            if uid in self._loading:
+                # Загрузка, начатая до изменения, не должна положить в кэш старую строку
+                self._generation[uid] = self._generation.get(uid, 0) + 1
+            else:
+                self._generation.pop(uid, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._generation = {uid: self._generation.get(uid, 0) + 1 for uid in self._loading}
+
+user_cache = UserCache(max_size=USER_CACHE_MAX_SIZE, ttl_seconds=USER_CACHE_TTL_SECONDS)
+leaderboard = Leaderboard()
+
+def _load_user(uid: int) -> User | None:
+    with user_cache.loading(uid) as generation:
+        with SessionLocal() as s:
+            u = s.query(User).filter_by(telegram_id=uid).first()
+        if u:
+            user_cache.put(u, generation)
+    return u
+
+async def get_user(uid: int) -> User | None:
+    """Получает пользователя из журнала балансов или кэша, затем из БД. None, если не найден."""
+    u = balance_ledger.peek(uid) or user_cache.get(uid)
+    if u is not None:
+        return u
+    return await run_db(_load_user, uid)
+
+class UserLockRegistry:
+    """
+    Блокировки игроков (asyncio.Lock): действия одного игрока выполняются по очереди
+    в процессе, без SELECT ... FOR UPDATE на его строках. Реестр хранит слабые ссылки -
+    блокировка живет, пока ее держат или ждут, и исчезает вместе с активностью игрока.
+    Шарды по uid держат словари небольшими (перестройка большого dict - пауза event loop).
+    Строки, общие для нескольких игроков (бюджет, цели переводов), по-прежнему блокируются в БД.
+    """
+
+    def __init__(self, shards: int):
+        self._shards = [weakref.WeakValueDictionary() for _ in range(shards)]
+
+    def get(self, uid: int) -> asyncio.Lock:
+        shard = self._shards[uid % len(self._shards)]
+        lock = shard.get(uid)
+        if lock is None:
+            lock = shard[uid] = asyncio.Lock()
+        return lock
+
+    def locked(self, uid: int) -> bool:
+        lock = self._shards[uid % len(self._shards)].get(uid)
+        return lock is not None and lock.locked()
+
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self._shards)
+
+user_locks = UserLockRegistry(USER_LOCK_SHARDS)
+
+class PlayerSummary(NamedTuple):
+    """Сводка игрока для профиля и банка: строка User и агрегаты по кредитам и бизнесам."""
+    user: User
+    loan_count: int
+    total_debt: int
+    biz_count: int
+
+def load_player_summary(uid: int) -> PlayerSummary | None:
+    """Загружает сводку игрока одним запросом (агрегаты - коррелированные подзапросы по индексам)."""
+    unpaid = (BankLoan.user_id == User.telegram_id) & (BankLoan.paid == False)
+    loan_count = select(func.count(BankLoan.id)).where(unpaid).scalar_subquery()
+    total_debt = select(func.coalesce(func.sum(BankLoan.amount), 0)).where(unpaid).scalar_subquery()
+    biz_count = select(func.count(OwnedBusiness.id)).where(OwnedBusiness.user_id == User.telegram_id).scalar_subquery()
+
+    with user_cache.loading(uid) as generation:
+        with SessionLocal() as s:
+            row = s.execute(
+                select(User, loan_count, total_debt, biz_count).where(User.telegram_id == uid)
+            ).first()
+        if not row:
+            return None
+        user_cache.put(row[0], generation)
+    return PlayerSummary(row[0], row[1], int(row[2]), row[3])
+
+class LedgerEntry(NamedTuple):
+    """Изменение баланса игрока: дельты наличных/банка и новые значения полей из LEDGER_FIELDS."""
+    entry_id: str
+    user_id: int
+    balance_delta: int
+    bank_delta: int
+    fields: dict
+    reason: str
+    created_at: datetime
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'entry_id': self.entry_id, 'user_id': self.user_id,
+            'balance_delta': self.balance_delta, 'bank_delta': self.bank_delta,
+            'fields': {k: v.isoformat() if v else None for k, v in self.fields.items()},
+            'reason': self.reason, 'created_at': self.created_at.isoformat(),
+        })
+
+    @classmethod
+    def from_json(cls, line: str) -> "LedgerEntry":
+        d = json.loads(line)
+        return cls(
+            d['entry_id'], d['user_id'], d['balance_delta'], d['bank_delta'],
+            {k: datetime.fromisoformat(v) if v else None for k, v in d['fields'].items()},
+            d['reason'], datetime.fromisoformat(d['created_at']),
+        )
+
+def _apply_ledger_entries(entries: list[LedgerEntry]):
+    """Применяет записи журнала одной транзакцией: относительные UPDATE users и строки аудита."""
+    per_user: dict[int, dict] = {}
+    for e in entries:
+        row = per_user.setdefault(e.user_id, {'uid': e.user_id, 'd_balance': 0, 'd_bank': 0})
+        row['d_balance'] += e.balance_delta
+        row['d_bank'] += e.bank_delta
+        row.update({f"v_{k}": v for k, v in e.fields.items()})
+
+    # executemany требует одинаковый набор параметров - группируем игроков по изменяемым полям
+    groups: dict[tuple, list[dict]] = {}
+    for uid in sorted(per_user): # единый порядок блокировок строк
+        row = per_user[uid]
+        fields = tuple(f for f in LEDGER_FIELDS if f"v_{f}" in row)
+        groups.setdefault(fields, []).append(row)
+
+    users = User.__table__
     with SessionLocal() as s:
-        return s.query(User).filter_by(telegram_id=uid).first()
+        for fields, rows in groups.items():
+            s.execute(
+                update(users)
+                .where(users.c.telegram_id == bindparam("uid"))
+                .values(
+                    balance=users.c.balance + bindparam("d_balance"),
+                    bank_balance=users.c.bank_balance + bindparam("d_bank"),
+                    **{f: bindparam(f"v_{f}") for f in fields},
+                ),
+                rows,
+            )
+        s.execute(BalanceLedgerEntry.__table__.insert(), [
+            {'entry_id': e.entry_id, 'user_id': e.user_id, 'balance_delta': e.balance_delta,
+             'bank_delta': e.bank_delta, 'reason': e.reason, 'created_at': e.created_at}
+            for e in entries
+        ])
+        s.commit()
+
+class LedgerFlushError(SQLAlchemyError):
+    """Записи игрока не удалось сохранить перед прямой записью: хэндлеры отвечают как на ошибку БД."""
+
+class BalanceLedger:
+    """
+    Журнал балансов с отложенной записью (write-behind).
+    Частые операции (казино, бонус, ограбление, депозит) не блокируют строку users:
+    под блокировкой игрока (user_locks) они проверяют баланс по копии строки в памяти,
+    меняют ее через record(), а запись дописывается в WAL-файл. flush() применяет
+    накопленные записи одной транзакцией и выгружает копии простаивающих игроков.
+    Остальные действия игрока выполняются внутри exclusive(uid).
+    Используется только из event loop.
+
+    Копия строки не видит штрафы по кредитам (они списываются с банковского счета в БД)
+    до ближайшего сброса. Журнал с банковского счета не списывает, так что это влияет
+    только на отображение.
+    """
+
+    def __init__(self, wal_path: str, flush_threshold: int):
+        self.wal_path = wal_path
+        self.flush_threshold = flush_threshold
+        self._accounts: dict[int, User] = {}
+        self._pending: list[LedgerEntry] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        # Игроки из пачки, которую сейчас применяет flush()
+        self._flushing: set[int] = set()
+        # В WAL остались записи, уже сохраненные сбросом одного игрока
+        self._wal_stale = False
+        self._wal = None
+        # Метрики
+        self.flushes = 0
+        self.flushed_entries = 0
+        self.flush_failures = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def lock(self, uid: int) -> asyncio.Lock:
+        """Блокировка игрока: проверка баланса и запись изменения выполняются под ней."""
+        return user_locks.get(uid)
+
+    def peek(self, uid: int) -> User | None:
+        return self._accounts.get(uid)
+
+    def accounts(self) -> list[User]:
+        return list(self._accounts.values())
+
+    async def account(self, uid: int) -> User | None:
+        """Копия строки игрока с учетом несохраненных изменений. Вызывать под lock(uid)."""
+        acct = self._accounts.get(uid)
+        if acct is None:
+            u = await get_user(uid)
+            if u is None:
+                return None
+            acct = User(**{attr.key: getattr(u, attr.key) for attr in inspect(User).column_attrs})
+            self._accounts[uid] = acct
+        return acct
+
+    def record(self, u: User, reason: str, balance: int = 0, bank: int = 0, **fields):
+        """Применяет изменение к копии строки (из account()) и дописывает его в WAL. Вызывать под lock(uid)."""
+        if u.balance + balance < 0 or u.bank_balance + bank < 0:
+            raise ValueError(f"Ledger: отрицательный баланс игрока {u.telegram_id} ({reason})")
+        unknown = set(fields) - set(LEDGER_FIELDS)
+        if unknown:
+            raise ValueError(f"Ledger: поля {sorted(unknown)} не пишутся журналом")
+
+        entry = LedgerEntry(uuid.uuid4().hex, u.telegram_id, balance, bank, fields, reason, datetime.now())
+        self._append_wal(entry)
+        u.balance += balance
+        u.bank_balance += bank
+        for key, value in fields.items():
+            setattr(u, key, value)
+        self._accounts[u.telegram_id] = u
+        self._pending.append(entry)
+        leaderboard.update(u.telegram_id, u.balance + u.bank_balance, u.username)
+
+        if len(self._pending) >= self.flush_threshold and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.ensure_future(self.flush())
+
+    async def flush(self) -> bool:
+        """Сбрасывает накопленные записи в БД. При ошибке записи остаются в очереди и в WAL."""
+        try:
+            await self._flush()
+            return True
+        except Exception as e:
+            self.flush_failures += 1
+            logging.error(f"Ledger: ошибка сброса ({len(self._pending)} записей): {e}")
+            return False
+
+    async def _flush(self):
+        async with self._flush_lock:
+            batch, self._pending = self._pending, []
+            if batch:
+                self._flushing = {e.user_id for e in batch}
+                try:
+                    await run_db(_apply_ledger_entries, batch)
+                except Exception:
+                    self._pending = batch + self._pending
+                    raise
+                finally:
+                    self._flushing = set()
+            if batch or self._wal_stale:
+                self._wal_stale = False
+                await self._rewrite_wal()
+            if batch:
+                self.flushes += 1
+                self.flushed_entries += len(batch)
+                for uid in {e.user_id for e in batch}:
+                    user_cache.invalidate(uid)
+
+            # Копии без несохраненных записей больше не нужны: следующая операция перечитает строку
+            busy = {e.user_id for e in self._pending}
+            for uid in list(self._accounts):
+                if uid not in busy and not user_locks.locked(uid):
+                    del self._accounts[uid]
+
+    @asynccontextmanager
+    async def exclusive(self, uid: int):
+        """
+        Блокировка игрока для действий, пишущих его строки в БД напрямую (без FOR UPDATE):
+        сохраняет его записи журнала и выгружает копию.
+        Если записи сохранить не удалось, поднимает LedgerFlushError, действие не выполняется.
+        """
+        async with self.lock(uid):
+            if uid in self._accounts:
+                try:
+                    await self._flush_user(uid)
+                except Exception as e:
+                    self.flush_failures += 1
+                    logging.error(f"Ledger: ошибка сброса записей игрока {uid}: {e}")
+                    raise LedgerFlushError(str(e)) from e
+                del self._accounts[uid]
+            yield
+
+    async def _flush_user(self, uid: int):
+        """
+        Сохраняет записи одного игрока (под lock(uid), новые записи не появятся).
+        WAL не переписывается: при восстановлении сохраненные записи пропускаются по entry_id,
+        файл очистит ближайший flush().
+        """
+        # Записи игрока уже в пачке flush(): ждем ее завершения (при ошибке они вернутся в очередь)
+        while uid in self._flushing:
+            async with self._flush_lock:
+                pass
+        mine = [e for e in self._pending if e.user_id == uid]
+        if not mine:
+            return
+        self._pending = [e for e in self._pending if e.user_id != uid]
+        try:
+            await run_db(_apply_ledger_entries, mine)
+        except Exception:
+            self._pending = mine + self._pending
+            raise
+        self._wal_stale = True
+        self.flushed_entries += len(mine)
+        user_cache.invalidate(uid)
+
+    def _append_wal(self, entry: LedgerEntry):
+        # Запись доходит до ОС сразу (переживает падение процесса), fsync - при сбросе
+        if self._wal is None:
+            os.makedirs(os.path.dirname(self.wal_path) or ".", exist_ok=True)
+            self._wal = open(self.wal_path, "a", encoding="utf-8")
+        self._wal.write(entry.to_json() + "\n")
+        self._wal.flush()
+
+    async def _rewrite_wal(self):
+        """
+        Оставляет в WAL только несохраненные записи (атомарная замена файла).
+        Новый файл пишется и синхронизируется (fsync) в потоке БД, старый тем временем
+        принимает записи; после замены записи, добавленные за это время, дописываются в новый.
+        """
+        snapshot = list(self._pending)
+        tmp_path = self.wal_path + ".tmp"
+        await run_db(self._write_wal_file, tmp_path, snapshot)
+        # Дальше без await: record() не вклинится между заменой файла и дозаписью
+        os.replace(tmp_path, self.wal_path)
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        # Очередь могла измениться не только в конце (сброс одного игрока), сверяем по entry_id
+        written = {e.entry_id for e in snapshot}
+        for entry in self._pending:
+            if entry.entry_id not in written:
+                self._append_wal(entry)
+
+    @staticmethod
+    def _write_wal_file(path: str, entries: list[LedgerEntry]):
+        with open(path, "w", encoding="utf-8") as f:
+            for entry in entries:
+                f.write(entry.to_json() + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def recover(self) -> int:
+        """Применяет записи WAL, не попавшие в БД до остановки. Вызывается при старте до приема апдейтов."""
+        if not os.path.exists(self.wal_path):
+            return 0
+        entries = []
+        with open(self.wal_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entries.append(LedgerEntry.from_json(line))
+                except ValueError:
+                    # Оборванная последняя строка: запись не была подтверждена игроку
+                    logging.warning(f"Ledger: пропущена поврежденная строка WAL: {line[:80]!r}")
+
+        applied = set()
+        with SessionLocal() as s:
+            for i in range(0, len(entries), 500):
+                ids = [e.entry_id for e in entries[i:i + 500]]
+                applied.update(s.execute(
+                    select(BalanceLedgerEntry.entry_id).where(BalanceLedgerEntry.entry_id.in_(ids))
+                ).scalars())
+        todo = [e for e in entries if e.entry_id not in applied]
+        if todo:
+            _apply_ledger_entries(todo)
+        os.remove(self.wal_path)
+        logging.info(f"Ledger: восстановлено из WAL {len(todo)} записей.")
+        return len(todo)
+
+balance_ledger = BalanceLedger(LEDGER_WAL_PATH, flush_threshold=LEDGER_FLUSH_THRESHOLD)
 
 def update_user_profile(uid: int, username: str):
     """Обновляет профиль пользователя при необходимости (например, в /start)"""
@@ -230,21 +1253,48 @@ def update_user_profile(uid: int, username: str):
         u = s.query(User).filter_by(telegram_id=uid).first()
         if not u:
             # Создаем нового пользователя с начальным балансом
-            election_state = s.query(ElectionState).first()
-            is_president = (election_state and election_state.current_president_id == uid)
+            is_president = economy.current_president_id == uid
             u = User(telegram_id=uid, username=username, is_president=is_president)
             s.add(u)
         else:
             u.username = username
         s.commit()
+        user_cache.put(u)
         # Возвращаем обновленный объект пользователя
         # NOTE: Это функция должна возвращать объект, чтобы get_main_kb мог его использовать, 
         # но в контексте aiogram 3.x, она обычно вызывается в начале хэндлеров.
         return u
 
+def register_chat(chat_id: int):
+    """Сохраняет групповой чат для рассылок (если его еще нет в БД)"""
+    with SessionLocal() as s:
+        if not s.query(Chat).filter_by(chat_id=chat_id).first():
+            s.add(Chat(chat_id=chat_id))
+            s.commit()
+
+def _scan_leaderboard() -> int:
+    """Перестраивает рейтинг потоковым проходом по users (строки читаются пачками, не целиком)."""
+    with SessionLocal() as s:
+        rows = s.execute(
+            select(User.telegram_id, User.balance + User.bank_balance, User.username)
+            .execution_options(yield_per=LEADERBOARD_SCAN_BATCH)
+        )
+        return leaderboard.rebuild(rows)
+
+async def rebuild_leaderboard():
+    count = await run_db(_scan_leaderboard)
+    # Несохраненные изменения журнала новее строк БД
+    for u in balance_ledger.accounts():
+        leaderboard.update(u.telegram_id, u.balance + u.bank_balance, u.username)
+    logging.info(f"Рейтинг перестроен: {count} игроков.")
+
 
 def get_main_kb(is_admin: bool = False, is_president: bool = False) -> ReplyKeyboardMarkup:
-    """Генерирует главное меню"""
+    """Главное меню. Готовые объекты общие для всех ответов - не изменять."""
+    return _main_kb(bool(is_admin), bool(is_president))
+
+@lru_cache(maxsize=4)
+def _main_kb(is_admin: bool, is_president: bool) -> ReplyKeyboardMarkup:
     kb = [
         [KeyboardButton(text=BTN_BIZ_CENTER), KeyboardButton(text=BTN_BANK)],
         [KeyboardButton(text=BTN_MARKET), KeyboardButton(text="🎰 Казино")],
@@ -260,6 +1310,13 @@ def get_main_kb(is_admin: bool = False, is_president: bool = False) -> ReplyKeyb
         
     return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True)
 
+async def get_user_kb(uid: int) -> ReplyKeyboardMarkup:
+    """Главное меню с учетом прав пользователя (один запрос к БД)."""
+    u = await get_user(uid)
+    if not u:
+        return get_main_kb()
+    return get_main_kb(u.is_admin, u.is_president)
+
 def format_cooldown(last_time: datetime, cooldown: timedelta) -> str | None:
     """Форматирует оставшееся время до конца кулдауна."""
     if not last_time: return None
@@ -281,17 +1338,141 @@ def format_cooldown(last_time: datetime, cooldown: timedelta) -> str | None:
         return " ".join(parts)
     return None
 
-def get_current_interest_rate() -> float:
-    """Получает текущую кредитную ставку из ElectionState."""
+class days_between(FunctionElement):
+    """SQL-выражение: количество полных суток между later и earlier (как timedelta.days)."""
+    type = Integer()
+    inherit_cache = True
+    name = "days_between"
+
+@compiles(days_between, "mysql")
+def _days_between_mysql(element, compiler, **kw):
+    later, earlier = list(element.clauses)
+    return f"TIMESTAMPDIFF(DAY, {compiler.process(earlier, **kw)}, {compiler.process(later, **kw)})"
+
+@compiles(days_between, "sqlite")
+def _days_between_sqlite(element, compiler, **kw):
+    later, earlier = list(element.clauses)
+    return f"CAST(julianday({compiler.process(later, **kw)}) - julianday({compiler.process(earlier, **kw)}) AS INTEGER)"
+
+@compiles(days_between, "postgresql")
+def _days_between_postgresql(element, compiler, **kw):
+    later, earlier = list(element.clauses)
+    return f"EXTRACT(DAY FROM ({compiler.process(later, **kw)} - {compiler.process(earlier, **kw)}))::integer"
+
+def bulk_transition(s, table, where: list, values: dict, returning: list) -> list:
+    """
+    Массовый перевод строк в новое состояние без загрузки ORM-объектов.
+    Возвращает колонки returning для измененных строк (первая колонка - первичный ключ).
+    UPDATE ... RETURNING там, где диалект это поддерживает (SQLite, PostgreSQL, MariaDB),
+    иначе (MySQL) SELECT ... FOR UPDATE ключей и UPDATE по ним в той же транзакции.
+    """
+    if s.get_bind().dialect.update_returning:
+        return s.execute(update(table).where(*where).values(**values).returning(*returning)).all()
+
+    rows = s.execute(select(*returning).where(*where).with_for_update()).all()
+    if rows:
+        pk = returning[0]
+        s.execute(update(table).where(pk.in_([row[0] for row in rows])).values(**values))
+    return rows
+
+# --- Наличные игрока ---
+# Наличные игрока пишут не только хэндлеры его воркера: выдача из Госбюджета идет в процессе
+# президента. Поэтому вне журнала балансов users.balance меняется только относительными UPDATE.
+
+def debit_balance(s, uid: int, amount: int) -> bool:
+    """Списывает наличные, если их хватает (проверка в WHERE). False - не хватает."""
+    if not amount:
+        return True
+    users = User.__table__
+    return s.execute(
+        update(users)
+        .where(users.c.telegram_id == uid, users.c.balance >= amount)
+        .values(balance=users.c.balance - amount)
+    ).rowcount == 1
+
+def credit_balance(s, uid: int, amount: int) -> bool:
+    """Зачисляет наличные. False - игрок не найден."""
+    users = User.__table__
+    return s.execute(
+        update(users).where(users.c.telegram_id == uid).values(balance=users.c.balance + amount)
+    ).rowcount == 1
+
+# --- Госбюджет ---
+# Зачисления (налоги, погашения, штрафы) идут относительным UPDATE в случайную строку-шард,
+# поэтому не выстраиваются в очередь за одной блокировкой. Списание блокирует все строки.
+
+def credit_budget(s, amount: int):
+    """Зачисляет сумму в Госбюджет в транзакции s."""
+    budget = PresidentialBudget.__table__
+    s.execute(
+        update(budget)
+        .where(budget.c.shard == random.randrange(BUDGET_SHARDS))
+        .values(budget=budget.c.budget + amount)
+    )
+
+def read_budget(s) -> int:
+    """Текущий Госбюджет (сумма по шардам)."""
+    return int(s.query(func.coalesce(func.sum(PresidentialBudget.budget), 0)).scalar())
+
+def debit_budget(s, amount: int) -> int:
+    """
+    Списывает сумму из Госбюджета, если хватает средств. Возвращает бюджет до списания.
+    Блокирует все строки-шарды до конца транзакции s.
+    """
+    shards = s.query(PresidentialBudget).order_by(PresidentialBudget.shard).with_for_update().all()
+    available = sum(b.budget for b in shards)
+    if available < amount:
+        return available
+    # С самых крупных шардов, ни один не уходит в минус
+    remaining = amount
+    for b in sorted(shards, key=lambda b: b.budget, reverse=True):
+        take = min(b.budget, remaining)
+        b.budget -= take
+        remaining -= take
+        if not remaining:
+            break
+    return available
+
+class EconomySnapshot(NamedTuple):
+    """Неизменяемый снимок экономических параметров из ElectionState."""
+    version: int # ElectionState.version
+    tax_rate: float
+    loan_interest_rate: float
+    current_president_id: int | None
+
+# Текущий снимок заменяется целиком, поэтому читатели всегда видят согласованные значения.
+# Каждый процесс сверяет снимок с БД раз в ECONOMY_SYNC_SECONDS (sync_economy).
+economy = EconomySnapshot(version=-1, tax_rate=DEFAULT_TAX_RATE, loan_interest_rate=DEFAULT_LOAN_RATE, current_president_id=None)
+
+def refresh_economy(est: ElectionState | None) -> EconomySnapshot:
+    """Публикует снимок строки ElectionState, если она не старше текущего. Вызывается после коммита."""
+    global economy
+    if est and est.version >= economy.version:
+        economy = EconomySnapshot(
+            version=est.version,
+            tax_rate=est.tax_rate,
+            loan_interest_rate=est.loan_interest_rate,
+            current_president_id=est.current_president_id,
+        )
+    return economy
+
+def _sync_economy(known_version: int):
     with SessionLocal() as s:
-        est = s.query(ElectionState).first()
-        return est.loan_interest_rate if est else 0.01
+        version = s.query(ElectionState.version).scalar()
+        if version is not None and version != known_version:
+            refresh_economy(s.query(ElectionState).first())
+
+async def sync_economy():
+    """Подхватывает изменения ElectionState, сделанные другими процессами (налог, ставка, президент)."""
+    await run_db(_sync_economy, economy.version)
+
+def get_current_interest_rate() -> float:
+    """Текущая кредитная ставка (из снимка, без запроса к БД)."""
+    return economy.loan_interest_rate
 
 def get_current_tax_rate() -> float:
-    """Получает текущую ставку налога из ElectionState."""
-    with SessionLocal() as s:
-        est = s.query(ElectionState).first()
-        return est.tax_rate if est else 0.10
+    """Текущая ставка налога (из снимка, без запроса к БД)."""
+    return economy.tax_rate
 
 # =========================================================
 # === 6. БАЗОВЫЕ КОМАНДЫ (СТАРТ, ПРОФИЛЬ) ===
@@ -301,14 +1482,11 @@ def get_current_tax_rate() -> float:
 async def cmd_start(message: types.Message):
     """Обработчик команды /start"""
     username = message.from_user.username or message.from_user.full_name
-    u = update_user_profile(message.from_user.id, username)
+    u = await run_db(update_user_profile, message.from_user.id, username)
     
     # Добавление чата в БД для рассылки
     if message.chat.type in ('group', 'supergroup'):
-        with SessionLocal() as s:
-            if not s.query(Chat).filter_by(chat_id=message.chat.id).first():
-                s.add(Chat(chat_id=message.chat.id))
-                s.commit()
+        await run_db(register_chat, message.chat.id)
 
     await message.answer(
         f"👋 Добро пожаловать, *{username}*, в BongoCity – симулятор жизни и бизнеса!\n"
@@ -320,9 +1498,10 @@ async def cmd_start(message: types.Message):
 @router.message(Command("profile"))
 async def cmd_profile(message: types.Message):
     """Обработчик команды /profile"""
-    u = get_user(message.from_user.id)
-    if not u:
+    summary = await run_db(load_player_summary, message.from_user.id)
+    if not summary:
         return await message.answer("Пожалуйста, начните с команды /start.")
+    u = balance_ledger.peek(message.from_user.id) or summary.user
     
     # Расчет чистого капитала (Net Worth)
     net_worth = u.balance + u.bank_balance
@@ -334,28 +1513,28 @@ async def cmd_profile(message: types.Message):
         jail_status = f"В тюрьме (Осталось: {format_cooldown(datetime.now(), remaining)})"
 
     # Инфо о кредитах
-    with SessionLocal() as s:
-        loans = s.query(BankLoan).filter_by(user_id=u.telegram_id, paid=False).all()
-        loan_info = f"❌ Нет активных кредитов."
-        if loans:
-            total_debt = sum(l.amount for l in loans)
-            loan_info = f"✅ Всего долг: {total_debt:,}$"
+    loan_info = f"❌ Нет активных кредитов."
+    if summary.loan_count:
+        loan_info = f"✅ Всего долг: {summary.total_debt:,}$"
 
     # Инфо о бизнесе
-    with SessionLocal() as s:
-        biz_count = s.query(OwnedBusiness).filter_by(user_id=u.telegram_id).count()
-        biz_status = f"✅ {biz_count} шт."
+    biz_status = f"✅ {summary.biz_count} шт."
 
     # Инфо о политике
     pres_status = "Нет"
     if u.is_president:
         pres_status = "ДА (Президент)"
 
+    # Место в рейтинге (load_player_summary уже обновил капитал игрока в нем)
+    place = leaderboard.rank(u.telegram_id)
+    rank_info = f"{place:,} из {len(leaderboard):,}" if place else "—"
+
     await message.answer(
         f"👤 **Профиль {u.username}**\n\n"
         f"💰 **Наличные**: {u.balance:,}$ \n"
         f"🏦 **Банк**: {u.bank_balance:,}$ \n"
-        f"📊 **Чистый капитал**: {net_worth:,}$ \n\n"
+        f"📊 **Чистый капитал**: {net_worth:,}$ \n"
+        f"🏆 **Место в рейтинге**: {rank_info}\n\n"
         f"🏭 **Бизнесы**: {biz_status}\n"
         f"💼 **Уровень работы**: {u.job_level}\n"
         f"🚨 **Статус**: {jail_status}\n\n"
@@ -364,6 +1543,18 @@ async def cmd_profile(message: types.Message):
         reply_markup=get_main_kb(u.is_admin, u.is_president)
     )
 
+@router.message(Command("top"))
+async def cmd_top(message: types.Message):
+    """Топ игроков по чистому капиталу (рейтинг в памяти, без запроса к БД)"""
+    top = leaderboard.top(LEADERBOARD_SIZE)
+    if not top:
+        return await message.answer("🏆 Рейтинг пока пуст.")
+    lines = [f"{i}. {e.name or e.user_id} — {e.net_worth:,}$" for i, e in enumerate(top, 1)]
+    place = leaderboard.rank(message.from_user.id)
+    if place and place > LEADERBOARD_SIZE:
+        lines.append(f"\n📍 Ваше место: {place:,} из {len(leaderboard):,}")
+    await message.answer("🏆 **Самые богатые игроки** (наличные + банк)\n\n" + "\n".join(lines))
+
 # =========================================================
 # === 7. БАНК (ДЕПОЗИТ, СНЯТИЕ, КРЕДИТЫ) ===
 # =========================================================
@@ -371,17 +1562,17 @@ async def cmd_profile(message: types.Message):
 @router.message(F.text == BTN_BANK)
 async def cmd_bank(message: types.Message):
     """Главное меню банка"""
-    u = get_user(message.from_user.id)
+    summary = await run_db(load_player_summary, message.from_user.id)
+    if not summary:
+        return await message.answer("Пожалуйста, начните с команды /start.")
+    u = balance_ledger.peek(message.from_user.id) or summary.user
     rate = get_current_interest_rate()
+    total_debt = summary.total_debt
+    loan_count = summary.loan_count
     
-    with SessionLocal() as s:
-        loans = s.query(BankLoan).filter_by(user_id=u.telegram_id, paid=False).all()
-        total_debt = sum(l.amount for l in loans)
-        loan_count = len(loans)
-        
-        loan_info = ""
-        if loan_count > 0:
-            loan_info = f" (Долг: {total_debt:,}$)"
+    loan_info = ""
+    if loan_count > 0:
+        loan_info = f" (Долг: {total_debt:,}$)"
 
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="📥 Депозит", callback_data="bank_deposit_start")],
@@ -401,7 +1592,7 @@ async def cmd_bank(message: types.Message):
 @router.callback_query(F.data == "bank_deposit_start")
 async def bank_deposit_start(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
-    u = get_user(call.from_user.id)
+    u = await get_user(call.from_user.id)
     await state.set_state(GameStates.bank_deposit)
     await call.message.answer(
         f"📥 **Внести Средства**\n"
@@ -416,33 +1607,30 @@ async def bank_deposit_finish(message: types.Message, state: FSMContext):
     try: amount = int(message.text)
     except: return await message.answer("❌ Введите число.")
     
-    if amount == 0: return await message.answer("Отменено.", reply_markup=get_main_kb(get_user(uid).is_admin, get_user(uid).is_president))
+    if amount == 0: return await message.answer("Отменено.", reply_markup=await get_user_kb(uid))
     if amount <= 0: return await message.answer("❌ Сумма должна быть положительной.")
 
     try:
-        with SessionLocal() as s:
-            u = s.query(User).filter_by(telegram_id=uid).with_for_update().first()
+        async with balance_ledger.lock(uid):
+            u = await balance_ledger.account(uid)
             if u.balance < amount:
                 return await message.answer(f"❌ Не хватает наличных. У вас: {u.balance:,}$")
-            
-            u.balance -= amount
-            u.bank_balance += amount
-            s.commit()
-            
-            await message.answer(
-                f"✅ **Депозит Успешен!**\n"
-                f"Внесено: *+{amount:,} $*\n"
-                f"Банковский баланс: {u.bank_balance:,}$",
-                reply_markup=get_main_kb(u.is_admin, u.is_president)
-            )
+            balance_ledger.record(u, "deposit", balance=-amount, bank=amount)
     except SQLAlchemyError:
-        await message.answer("❌ Ошибка БД.")
+        return await message.answer("❌ Ошибка БД.")
+
+    await message.answer(
+        f"✅ **Депозит Успешен!**\n"
+        f"Внесено: *+{amount:,} $*\n"
+        f"Банковский баланс: {u.bank_balance:,}$",
+        reply_markup=get_main_kb(u.is_admin, u.is_president)
+    )
 
 # --- Логика Снятия ---
 @router.callback_query(F.data == "bank_withdraw_start")
 async def bank_withdraw_start(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
-    u = get_user(call.from_user.id)
+    u = await get_user(call.from_user.id)
     await state.set_state(GameStates.bank_withdraw)
     await call.message.answer(
         f"📤 **Снять Средства**\n"
@@ -457,27 +1645,38 @@ async def bank_withdraw_finish(message: types.Message, state: FSMContext):
     try: amount = int(message.text)
     except: return await message.answer("❌ Введите число.")
     
-    if amount == 0: return await message.answer("Отменено.", reply_markup=get_main_kb(get_user(uid).is_admin, get_user(uid).is_president))
+    if amount == 0: return await message.answer("Отменено.", reply_markup=await get_user_kb(uid))
     if amount <= 0: return await message.answer("❌ Сумма должна быть положительной.")
 
-    try:
+    def _tx():
+        users = User.__table__
         with SessionLocal() as s:
-            u = s.query(User).filter_by(telegram_id=uid).with_for_update().first()
-            if u.bank_balance < amount:
-                return await message.answer(f"❌ Не хватает на банковском счете. У вас: {u.bank_balance:,}$")
-            
-            u.bank_balance -= amount
-            u.balance += amount
+            # Банковский счет также списывают штрафы по кредитам (фоновая задача),
+            # поэтому снятие - относительный UPDATE с проверкой остатка в WHERE
+            withdrawn = s.execute(
+                update(users)
+                .where(users.c.telegram_id == uid, users.c.bank_balance >= amount)
+                .values(bank_balance=users.c.bank_balance - amount, balance=users.c.balance + amount)
+            ).rowcount
             s.commit()
+            u = s.query(User).filter_by(telegram_id=uid).first()
+            user_cache.put(u)
+            if not withdrawn:
+                return f"❌ Не хватает на банковском счете. У вас: {u.bank_balance:,}$", None
             
-            await message.answer(
+            return (
                 f"✅ **Снятие Успешно!**\n"
                 f"Снято: *+{amount:,} $*\n"
                 f"Наличные: {u.balance:,}$",
-                reply_markup=get_main_kb(u.is_admin, u.is_president)
+                get_main_kb(u.is_admin, u.is_president)
             )
+
+    try:
+        async with balance_ledger.exclusive(uid):
+            text, kb = await run_db(_tx)
     except SQLAlchemyError:
-        await message.answer("❌ Ошибка БД.")
+        return await message.answer("❌ Ошибка БД.")
+    await message.answer(text, reply_markup=kb)
 
 # --- Логика Кредитов ---
 @router.callback_query(F.data == "loan_start")
@@ -485,10 +1684,13 @@ async def loan_start(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
     
     # 1. Проверка на максимальное количество активных кредитов (например, 3)
-    with SessionLocal() as s:
-        active_loans = s.query(BankLoan).filter_by(user_id=call.from_user.id, paid=False).count()
-        if active_loans >= 3:
-            return await call.message.answer("❌ Вы не можете взять более 3 активных кредитов одновременно.")
+    def _count_loans():
+        with SessionLocal() as s:
+            return s.query(BankLoan).filter_by(user_id=call.from_user.id, paid=False).count()
+
+    active_loans = await run_db(_count_loans)
+    if active_loans >= 3:
+        return await call.message.answer("❌ Вы не можете взять более 3 активных кредитов одновременно.")
             
     await state.set_state(GameStates.loan_amount)
     await call.message.answer("💸 **Запрос Кредита**\nВведите желаемую сумму кредита:")
@@ -498,11 +1700,11 @@ async def loan_amount_input(message: types.Message, state: FSMContext):
     try: amount = int(message.text)
     except:
         await state.clear()
-        return await message.answer("❌ Введите корректную сумму.", reply_markup=get_main_kb(get_user(message.from_user.id).is_admin, get_user(message.from_user.id).is_president))
+        return await message.answer("❌ Введите корректную сумму.", reply_markup=await get_user_kb(message.from_user.id))
         
     if amount <= 10000:
         await state.clear()
-        return await message.answer("❌ Минимальная сумма кредита: 10,000 $.", reply_markup=get_main_kb(get_user(message.from_user.id).is_admin, get_user(message.from_user.id).is_president))
+        return await message.answer("❌ Минимальная сумма кредита: 10,000 $.", reply_markup=await get_user_kb(message.from_user.id))
 
     await state.update_data(amount=amount)
     await state.set_state(GameStates.loan_days)
@@ -514,11 +1716,11 @@ async def loan_days_input(message: types.Message, state: FSMContext):
     try: days = int(message.text)
     except:
         await state.clear()
-        return await message.answer("❌ Введите корректное количество дней.", reply_markup=get_main_kb(get_user(uid).is_admin, get_user(uid).is_president))
+        return await message.answer("❌ Введите корректное количество дней.", reply_markup=await get_user_kb(uid))
     
     if not (7 <= days <= 30):
         await state.clear()
-        return await message.answer("❌ Срок кредита должен быть от 7 до 30 дней.", reply_markup=get_main_kb(get_user(uid).is_admin, get_user(uid).is_president))
+        return await message.answer("❌ Срок кредита должен быть от 7 до 30 дней.", reply_markup=await get_user_kb(uid))
     
     data = await state.get_data()
     amount = data['amount']
@@ -528,15 +1730,14 @@ async def loan_days_input(message: types.Message, state: FSMContext):
     due_date = datetime.now() + timedelta(days=days)
     
     # Расчет полной суммы к возврату (процент ежедневный, но для инфо посчитаем общую)
-    total_interest = int(amount * rate * days)
-    total_repay = amount + total_interest
+    total_repay = loan_total_due(amount, rate, days)
     
-    try:
+    def _tx():
         with SessionLocal() as s:
-            u = s.query(User).filter_by(telegram_id=uid).with_for_update().first()
+            u = s.query(User).filter_by(telegram_id=uid).first()
             
             # 1. Выдача денег
-            u.balance += amount
+            credit_balance(s, uid, amount)
             
             # 2. Создание записи о кредите
             loan = BankLoan(
@@ -547,18 +1748,24 @@ async def loan_days_input(message: types.Message, state: FSMContext):
             )
             s.add(loan)
             s.commit()
-            
-            await message.answer(
-                f"✅ **Кредит Одобрен!**\n"
-                f"Получено: *+{amount:,} $*\n"
-                f"Ставка: {int(rate*100)}% в день\n"
-                f"Срок: {days} дней (до {due_date.strftime('%d.%m.%Y')})\n"
-                f"~Общая сумма к возврату: {total_repay:,} $~",
-                reply_markup=get_main_kb(u.is_admin, u.is_president)
-            )
-            
+            s.refresh(u)
+            user_cache.put(u)
+            return get_main_kb(u.is_admin, u.is_president)
+
+    try:
+        async with balance_ledger.exclusive(uid):
+            kb = await run_db(_tx)
     except SQLAlchemyError:
-        await message.answer("❌ Ошибка БД при оформлении кредита.", reply_markup=get_main_kb(get_user(uid).is_admin, get_user(uid).is_president))
+        return await message.answer("❌ Ошибка БД при оформлении кредита.", reply_markup=await get_user_kb(uid))
+
+    await message.answer(
+        f"✅ **Кредит Одобрен!**\n"
+        f"Получено: *+{amount:,} $*\n"
+        f"Ставка: {int(rate*100)}% в день\n"
+        f"Срок: {days} дней (до {due_date.strftime('%d.%m.%Y')})\n"
+        f"~Общая сумма к возврату: {total_repay:,} $~",
+        reply_markup=kb
+    )
 
 # --- Меню Погашения Кредитов ---
 @router.callback_query(F.data == "loan_repay_menu")
@@ -566,72 +1773,79 @@ async def loan_repay_menu(call: types.CallbackQuery):
     await call.answer()
     uid = call.from_user.id
     
-    with SessionLocal() as s:
-        loans = s.query(BankLoan).filter_by(user_id=uid, paid=False).all()
+    def _load_loans():
+        with SessionLocal() as s:
+            return s.query(BankLoan).filter_by(user_id=uid, paid=False).all()
+
+    loans = await run_db(_load_loans)
+    if not loans:
+        return await call.message.answer("❌ У вас нет активных кредитов для погашения.")
         
-        if not loans:
-            return await call.message.answer("❌ У вас нет активных кредитов для погашения.")
-            
-        kb = InlineKeyboardMarkup(inline_keyboard=[])
+    kb = InlineKeyboardMarkup(inline_keyboard=[])
+    
+    for loan in loans:
+        # Расчет текущего долга: Сумма + Начисленные проценты до сегодня
+        days_passed = (datetime.now() - loan.issue_date).days
+        total_due = loan_total_due(loan.amount, loan.interest_rate, days_passed)
         
-        for loan in loans:
-            # Расчет текущего долга: Сумма + Начисленные проценты до сегодня
-            days_passed = (datetime.now() - loan.issue_date).days
-            interest_accrued = int(loan.amount * loan.interest_rate * days_passed)
-            total_due = loan.amount + interest_accrued
-            
-            btn_text = (
-                f"💳 Кредит #{loan.id} | Долг: {total_due:,}$ "
-                f"(Начало: {loan.amount:,}$)"
-            )
-            kb.inline_keyboard.append([InlineKeyboardButton(
-                text=btn_text,
-                callback_data=f"loan_repay_do_{loan.id}_{total_due}"
-            )])
-            
-        await call.message.answer("💳 **Погашение Кредитов**\nВыберите кредит для полного погашения:", reply_markup=kb)
+        btn_text = (
+            f"💳 Кредит #{loan.id} | Долг: {total_due:,}$ "
+            f"(Начало: {loan.amount:,}$)"
+        )
+        kb.inline_keyboard.append([InlineKeyboardButton(
+            text=btn_text,
+            callback_data=f"loan_repay_do_{loan.id}_{total_due}"
+        )])
+        
+    await call.message.answer("💳 **Погашение Кредитов**\nВыберите кредит для полного погашения:", reply_markup=kb)
 
 @router.callback_query(F.data.startswith("loan_repay_do_"))
 async def loan_repay_do(call: types.CallbackQuery):
     await call.answer()
     uid = call.from_user.id
     try:
-        _, _, loan_id_str, total_due_str = call.data.split('_')
+        loan_id_str, total_due_str = call.data.removeprefix("loan_repay_do_").split('_')
         loan_id = int(loan_id_str)
         total_due = int(total_due_str)
     except ValueError:
         return await call.message.answer("❌ Ошибка обработки данных.")
 
-    try:
+    def _tx():
         with SessionLocal() as s:
-            u = s.query(User).filter_by(telegram_id=uid).with_for_update().first()
-            loan = s.query(BankLoan).filter_by(id=loan_id, user_id=uid, paid=False).with_for_update().first()
+            u = s.query(User).filter_by(telegram_id=uid).first()
+            loan = s.query(BankLoan).filter_by(id=loan_id, user_id=uid, paid=False).first()
             
             if not loan:
-                return await call.message.answer("❌ Кредит не найден или уже погашен.")
-            if u.balance < total_due:
-                return await call.message.answer(f"❌ Не хватает наличных. Требуется: {total_due:,}$")
-            
+                return "❌ Кредит не найден или уже погашен."
+            # Сумма из кнопки - только подтверждение: долг считается по кредиту
+            if loan_total_due(loan.amount, loan.interest_rate, (datetime.now() - loan.issue_date).days) != total_due:
+                return "❌ Сумма долга изменилась, откройте меню погашения заново."
             # 1. Списание средств
-            u.balance -= total_due
+            if not debit_balance(s, uid, total_due):
+                return f"❌ Не хватает наличных. Требуется: {total_due:,}$"
             
             # 2. Пометка как оплаченный
             loan.paid = True
             
             # 3. Добавление платежа в Госбюджет (как доход банка)
-            budget = s.query(PresidentialBudget).with_for_update().first()
-            budget.budget += total_due # Вся сумма идет в бюджет (симуляция госбанка)
+            credit_budget(s, total_due) # Вся сумма идет в бюджет (симуляция госбанка)
 
             s.commit()
+            s.refresh(u)
+            user_cache.put(u)
             
-            await call.message.answer(
+            return (
                 f"🎉 **Кредит Погашен!**\n"
                 f"Кредит #{loan.id} успешно закрыт. Списано: *-{total_due:,} $*\n"
                 f"Текущие наличные: {u.balance:,}$"
             )
-            
+
+    try:
+        async with balance_ledger.exclusive(uid):
+            text = await run_db(_tx)
     except SQLAlchemyError:
-        await call.message.answer("❌ Ошибка БД при погашении кредита.")
+        return await call.message.answer("❌ Ошибка БД при погашении кредита.")
+    await call.message.answer(text)
 
 # =========================================================
 # === 8. БИЗНЕС-ЦЕНТР (ПОКУПКА, УЛУЧШЕНИЕ, ПРОИЗВОДСТВО) ===
@@ -640,7 +1854,6 @@ async def loan_repay_do(call: types.CallbackQuery):
 @router.message(F.text == BTN_BIZ_CENTER)
 async def cmd_biz_center(message: types.Message):
     """Меню Бизнес-Центра"""
-    u = get_user(message.from_user.id)
     kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="🛒 Купить Новый Бизнес", callback_data="biz_shop")],
         [InlineKeyboardButton(text="🏭 Запустить Производство", callback_data="biz_production_start")],
@@ -660,34 +1873,36 @@ async def biz_production_start(call: types.CallbackQuery):
     await call.answer()
     uid = call.from_user.id
     
-    with SessionLocal() as s:
-        # Бизнесы, которые могут начать производство (статус IDLE)
-        bizs_idle = s.query(OwnedBusiness).filter_by(user_id=uid, production_state="IDLE").all()
+    def _load_idle():
+        with SessionLocal() as s:
+            # Бизнесы, которые могут начать производство (статус IDLE)
+            return s.query(OwnedBusiness).filter_by(user_id=uid, production_state="IDLE").all()
+
+    bizs_idle = await run_db(_load_idle)
+    if not bizs_idle:
+        return await call.message.answer("❌ Нет бизнесов в режиме *Ожидания* для запуска производства.")
         
-        if not bizs_idle:
-            return await call.message.answer("❌ Нет бизнесов в режиме *Ожидания* для запуска производства.")
-            
-        # Группируем по типу бизнеса, чтобы показать один раз
-        biz_options = {}
-        for b in bizs_idle:
-            biz_info = BUSINESSES.get(b.business_id)
-            if b.business_id not in biz_options:
-                biz_options[b.business_id] = {
-                    'name': biz_info['name'],
-                    'count': 0,
-                    'req_resource_id': biz_info['req_resource_id']
-                }
-            biz_options[b.business_id]['count'] += b.count
+    # Группируем по типу бизнеса, чтобы показать один раз
+    biz_options = {}
+    for b in bizs_idle:
+        biz_info = BUSINESSES.get(b.business_id)
+        if b.business_id not in biz_options:
+            biz_options[b.business_id] = {
+                'name': biz_info['name'],
+                'count': 0,
+                'req_resource_id': biz_info['req_resource_id']
+            }
+        biz_options[b.business_id]['count'] += b.count
 
-        kb = InlineKeyboardMarkup(inline_keyboard=[])
-        for bid, info in biz_options.items():
-            res_name = MARKET_ITEMS[info['req_resource_id']]['name']
-            kb.inline_keyboard.append([InlineKeyboardButton(
-                text=f"🏭 {info['name']} ({info['count']} шт.) | Требует {res_name}",
-                callback_data=f"biz_res_select_{bid}"
-            )])
-            
-        await call.message.answer("🏭 **Запуск Производства**\nВыберите тип бизнеса для запуска:", reply_markup=kb)
+    kb = InlineKeyboardMarkup(inline_keyboard=[])
+    for bid, info in biz_options.items():
+        res_name = MARKET_ITEMS[info['req_resource_id']]['name']
+        kb.inline_keyboard.append([InlineKeyboardButton(
+            text=f"🏭 {info['name']} ({info['count']} шт.) | Требует {res_name}",
+            callback_data=f"biz_res_select_{bid}"
+        )])
+        
+    await call.message.answer("🏭 **Запуск Производства**\nВыберите тип бизнеса для запуска:", reply_markup=kb)
 
 @router.callback_query(F.data.startswith("biz_res_select_"))
 async def biz_res_select(call: types.CallbackQuery, state: FSMContext):
@@ -697,10 +1912,14 @@ async def biz_res_select(call: types.CallbackQuery, state: FSMContext):
     res_id = biz_info['req_resource_id']
     res_name = MARKET_ITEMS[res_id]['name']
     
-    # Получаем текущую цену сырья
-    with SessionLocal() as s:
-        price_data = s.query(MarketItemPrice).filter_by(item_id=res_id).first()
-        current_price = price_data.current_price if price_data else MARKET_ITEMS[res_id]['base_price']
+    # Получаем текущую цену сырья и запас на складе
+    def _load_price():
+        with SessionLocal() as s:
+            price_data = s.query(MarketItemPrice).filter_by(item_id=res_id).first()
+            price = price_data.current_price if price_data else MARKET_ITEMS[res_id]['base_price']
+            return price, get_stock(s, call.from_user.id, res_id)
+
+    current_price, stock = await run_db(_load_price)
         
     await state.update_data(business_id=bid, resource_id=res_id, price=current_price)
     await state.set_state(GameStates.biz_res_input)
@@ -708,7 +1927,8 @@ async def biz_res_select(call: types.CallbackQuery, state: FSMContext):
     await call.message.answer(
         f"📦 **Сырье: {res_name}**\n"
         f"Текущая цена: {current_price:,}$ за ед.\n"
-        f"Введите количество единиц *{res_name}* для закупки и начала производства (0 для отмены):"
+        f"На складе: {stock:,} ед. (расходуется в первую очередь)\n"
+        f"Введите количество единиц *{res_name}* для производства (0 для отмены):"
     )
 
 @router.message(GameStates.biz_res_input)
@@ -723,30 +1943,37 @@ async def biz_res_input_finish(message: types.Message, state: FSMContext):
     await state.clear()
     
     if units_to_buy == 0:
-        return await message.answer("Отменено.", reply_markup=get_main_kb(get_user(uid).is_admin, get_user(uid).is_president))
+        return await message.answer("Отменено.", reply_markup=await get_user_kb(uid))
     if units_to_buy <= 0:
         return await message.answer("❌ Количество должно быть положительным.")
 
     bid = data['business_id']
+    res_id = data['resource_id']
     price = data['price']
-    total_cost = units_to_buy * price
     
-    try:
+    def _tx():
         with SessionLocal() as s:
-            u = s.query(User).filter_by(telegram_id=uid).with_for_update().first()
-            if u.balance < total_cost:
-                return await message.answer(f"❌ Не хватает {total_cost - u.balance:,}$ для покупки сырья.")
-            
+            u = s.query(User).filter_by(telegram_id=uid).first()
+            # Сырье со склада (куплено на бирже), недостающее - по цене города
+            from_stock = min(get_stock(s, uid, res_id), units_to_buy)
+            total_cost = (units_to_buy - from_stock) * price
             # 1. Списание средств
-            u.balance -= total_cost
+            if not debit_balance(s, uid, total_cost):
+                return f"❌ Не хватает {total_cost - u.balance:,}$ для покупки сырья.", None
             
             # 2. Поиск первого бизнеса этого типа в режиме IDLE
-            b = s.query(OwnedBusiness).filter_by(user_id=uid, business_id=bid, production_state="IDLE").with_for_update().first()
+            b = s.query(OwnedBusiness).filter_by(user_id=uid, business_id=bid, production_state="IDLE").first()
             
             if not b:
                 s.commit() # Сохраняем списание, даже если не нашли бизнес (на всякий случай)
-                return await message.answer("❌ Не удалось найти свободный бизнес этого типа. Возможно, он был запущен.")
+                s.refresh(u)
+                user_cache.put(u)
+                return "❌ Не удалось найти свободный бизнес этого типа. Возможно, он был запущен.", None
             
+            if from_stock and not take_inventory(s, uid, res_id, from_stock):
+                s.rollback()
+                return "❌ Запас на складе изменился, попробуйте еще раз.", None
+
             # 3. Запуск производства
             b.production_state = "PRODUCING"
             b.production_start_time = datetime.now()
@@ -755,16 +1982,24 @@ async def biz_res_input_finish(message: types.Message, state: FSMContext):
             biz_name = BUSINESSES[bid]['name']
             
             s.commit()
+            s.refresh(u)
+            user_cache.put(u)
             
-            await message.answer(
+            return (
                 f"✅ **Производство Запущено!**\n"
                 f"Бизнес: *{biz_name}*\n"
-                f"Закуплено сырья: {units_to_buy:,} ед. (-{total_cost:,}$)\n"
+                f"Сырье: {units_to_buy:,} ед. (со склада {from_stock:,}, докуплено за {total_cost:,}$)\n"
                 f"⏳ Ожидаемое время завершения: {PRODUCTION_CYCLE_HOURS} часов."
-            )
-            
+            ), (b.id, b.production_start_time)
+
+    try:
+        async with balance_ledger.exclusive(uid):
+            text, run = await run_db(_tx)
     except SQLAlchemyError:
-        await message.answer("❌ Ошибка БД при запуске производства.")
+        return await message.answer("❌ Ошибка БД при запуске производства.")
+    if run:
+        production_scheduler.register(*run)
+    await message.answer(text)
 
 # --- Сбор Продукции ---
 @router.callback_query(F.data == "biz_collect")
@@ -772,13 +2007,13 @@ async def biz_collect(call: types.CallbackQuery):
     await call.answer()
     uid = call.from_user.id
     
-    try:
+    def _tx():
         with SessionLocal() as s:
-            u = s.query(User).filter_by(telegram_id=uid).with_for_update().first()
+            u = s.query(User).filter_by(telegram_id=uid).first()
             tax_rate = get_current_tax_rate()
             
             # Ищем бизнесы со статусом READY
-            bizs_ready = s.query(OwnedBusiness).filter_by(user_id=uid, production_state="READY").with_for_update().all()
+            bizs_ready = s.query(OwnedBusiness).filter_by(user_id=uid, production_state="READY").all()
             
             if bizs_ready:
                 total_income_gross = 0
@@ -788,19 +2023,8 @@ async def biz_collect(call: types.CallbackQuery):
                     biz_info = BUSINESSES.get(b.business_id)
                     if not biz_info: continue
                     
-                    # Расчет текущего дохода (с учетом уровня и количества сырья)
-                    # Выход = Базовый_Выход * (Мультипликатор)^(Уровень-1)
-                    # Учитываем, что каждый бизнес производит 1 ед. продукции за цикл,
-                    # умноженную на количество купленного сырья (единицы = количество циклов)
-                    
-                    # 1. Доход за 1 цикл (1 ед. бизнеса)
-                    payout_per_cycle = biz_info['base_payout'] * (biz_info['payout_mult'] ** (b.upgrade_level - 1))
-                    
-                    # 2. Общий доход = Доход_за_цикл * Кол-во_сырья
-                    # Примечание: тут логика немного изменена, чтобы доход зависел от вложенного сырья
-                    income_for_biz = int(payout_per_cycle * b.resource_units)
-                    
-                    total_income_gross += income_for_biz
+                    # Доход зависит от уровня и количества вложенного сырья
+                    total_income_gross += production_income(b.business_id, b.upgrade_level, b.resource_units)
                     collected_units += b.resource_units
                     
                     # Сброс состояния
@@ -809,43 +2033,47 @@ async def biz_collect(call: types.CallbackQuery):
                     b.resource_units = 0
                 
                 # Расчет налога
-                total_tax = int(total_income_gross * tax_rate)
-                total_income_net = total_income_gross - total_tax
+                total_tax, total_income_net = split_tax(total_income_gross, tax_rate)
                 
-                u.balance += total_income_net
+                credit_balance(s, uid, total_income_net)
                 
                 # Налоговые отчисления идут в госбюджет
-                budget = s.query(PresidentialBudget).with_for_update().first()
-                budget.budget += total_tax 
+                credit_budget(s, total_tax)
 
                 s.commit()
-                await call.message.answer(
+                s.refresh(u)
+                user_cache.put(u)
+                return (
                     f"💸 **Сбор Продукции Успешен!**\n"
                     f"Собрано {collected_units} ед. продукции.\n"
                     f"💰 Налог ({int(tax_rate*100)}%): *-{total_tax:,} $*\n"
                     f"💲 Чистый доход: *+{total_income_net:,} $*\n"
                 )
             else:
-                await call.message.answer("⏳ Нет готовой продукции для сбора.")
-                
+                return "⏳ Нет готовой продукции для сбора."
+
+    try:
+        async with balance_ledger.exclusive(uid):
+            text = await run_db(_tx)
     except SQLAlchemyError as e:
         logging.error(f"Biz Collect DB Error: {e}")
-        await call.message.answer("❌ Ошибка БД при сборе дохода.")
+        return await call.message.answer("❌ Ошибка БД при сборе дохода.")
+    await call.message.answer(text)
 
 # --- Покупка нового бизнеса (Усиленные цены) ---
 @router.callback_query(F.data == "biz_shop")
 async def biz_shop(call: types.CallbackQuery):
     await call.answer()
-    kb = InlineKeyboardMarkup(inline_keyboard=[])
-    
-    for k, v in BUSINESSES.items():
-        res_name = MARKET_ITEMS[v['req_resource_id']]['name']
-        kb.inline_keyboard.append([InlineKeyboardButton(
-            text=f"🛒 {v['name']} | Цена: {v['cost']:,}$ | Требует: {res_name}",
-            callback_data=f"biz_buy_{k}"
-        )])
-        
-    await call.message.edit_text("🛒 *Магазин Бизнесов BongoCity*\nВыберите объект для инвестирования:", reply_markup=kb)
+    await call.message.edit_text("🛒 *Магазин Бизнесов BongoCity*\nВыберите объект для инвестирования:", reply_markup=BIZ_SHOP_KB)
+
+# Каталог бизнесов не меняется во время работы - клавиатура строится один раз
+BIZ_SHOP_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(
+        text=f"🛒 {v['name']} | Цена: {v['cost']:,}$ | Требует: {MARKET_ITEMS[v['req_resource_id']]['name']}",
+        callback_data=f"biz_buy_{k}"
+    )]
+    for k, v in BUSINESSES.items()
+])
 
 @router.callback_query(F.data.startswith("biz_buy_"))
 async def biz_buy(call: types.CallbackQuery):
@@ -854,14 +2082,13 @@ async def biz_buy(call: types.CallbackQuery):
     cost = BUSINESSES[bid]['cost']
     uid = call.from_user.id
     
-    try:
+    def _tx():
         with SessionLocal() as s:
-            u = s.query(User).filter_by(telegram_id=uid).with_for_update().first()
-            if u.balance < cost:
-                return await call.message.answer(f"❌ Не хватает {cost - u.balance:,}$ для покупки.")
+            u = s.query(User).filter_by(telegram_id=uid).first()
+            if not debit_balance(s, uid, cost):
+                return f"❌ Не хватает {cost - u.balance:,}$ для покупки."
             
-            u.balance -= cost
-            exist = s.query(OwnedBusiness).filter_by(user_id=uid, business_id=bid).with_for_update().first()
+            exist = s.query(OwnedBusiness).filter_by(user_id=uid, business_id=bid).first()
             
             if exist:
                 exist.count += 1
@@ -869,10 +2096,17 @@ async def biz_buy(call: types.CallbackQuery):
                 # ВАЖНО: user_id в OwnedBusiness - это BigInteger (telegram_id)
                 s.add(OwnedBusiness(user_id=uid, business_id=bid, count=1))
             s.commit()
+            s.refresh(u)
+            user_cache.put(u)
             
-            await call.message.answer(f"✅ Успешная покупка: {BUSINESSES[bid]['name']} (-{cost:,}$).")
+            return f"✅ Успешная покупка: {BUSINESSES[bid]['name']} (-{cost:,}$)."
+
+    try:
+        async with balance_ledger.exclusive(uid):
+            text = await run_db(_tx)
     except SQLAlchemyError:
-        await call.message.answer("❌ Ошибка БД при покупке.")
+        return await call.message.answer("❌ Ошибка БД при покупке.")
+    await call.message.answer(text)
 
 # --- Улучшение Бизнеса ---
 @router.callback_query(F.data == "biz_upgrade_start")
@@ -880,39 +2114,36 @@ async def biz_upgrade_start(call: types.CallbackQuery):
     await call.answer()
     uid = call.from_user.id
 
-    with SessionLocal() as s:
-        bizs = s.query(OwnedBusiness).filter_by(user_id=uid).all()
-        
-        if not bizs:
-            return await call.message.answer("❌ Нет бизнесов для улучшения.")
+    def _load_bizs():
+        with SessionLocal() as s:
+            return s.query(OwnedBusiness).filter_by(user_id=uid).all()
+
+    bizs = await run_db(_load_bizs)
+    if not bizs:
+        return await call.message.answer("❌ Нет бизнесов для улучшения.")
+    
+    kb = InlineKeyboardMarkup(inline_keyboard=[])
+    
+    for b in bizs:
+        biz_info = BUSINESSES.get(b.business_id)
+        if not biz_info: continue
         
-        kb = InlineKeyboardMarkup(inline_keyboard=[])
+        current_level = b.upgrade_level
+        cost_to_upgrade = upgrade_cost(b.business_id, current_level)
         
-        for b in bizs:
-            biz_info = BUSINESSES.get(b.business_id)
-            if not biz_info: continue
-            
-            current_level = b.upgrade_level
-            max_level = biz_info['max_level']
+        if cost_to_upgrade is None:
+            btn_text = f"⭐ {biz_info['name']} | Уровень {current_level} (MAX)"
+            # ИСПРАВЛЕНО: callback_data должен быть уникальным
+            kb.inline_keyboard.append([InlineKeyboardButton(text=btn_text, callback_data=f"biz_upgrade_max_{b.id}")])
+        else:
+            next_payout = level_payout(b.business_id, current_level + 1)
+            btn_text = (
+                f"⬆️ {biz_info['name']} | Ур. {current_level} -> {current_level + 1} "
+                f"(Новый Выход: {next_payout:,}$) "
+                f"| Цена: {cost_to_upgrade:,}$"
+            )
+            kb.inline_keyboard.append([InlineKeyboardButton(text=btn_text, callback_data=f"biz_upgrade_do_{b.id}_{cost_to_upgrade}")])
             
-            if current_level >= max_level:
-                btn_text = f"⭐ {biz_info['name']} | Уровень {current_level} (MAX)"
-                # ИСПРАВЛЕНО: callback_data должен быть уникальным
-                kb.inline_keyboard.append([InlineKeyboardButton(text=btn_text, callback_data=f"biz_upgrade_max_{b.id}")])
-            else:
-                # Стоимость следующего уровня = Базовая стоимость * (Мультипликатор)^текущий_уровень
-                cost_to_upgrade = int(biz_info['cost'] * (biz_info['upgrade_cost_mult'] ** current_level))
-                
-                # Расчет нового дохода
-                next_payout = int(biz_info['base_payout'] * (biz_info['payout_mult'] ** current_level))
-                
-                btn_text = (
-                    f"⬆️ {biz_info['name']} | Ур. {current_level} -> {current_level + 1} "
-                    f"(Новый Выход: {next_payout:,}$) "
-                    f"| Цена: {cost_to_upgrade:,}$"
-                )
-                kb.inline_keyboard.append([InlineKeyboardButton(text=btn_text, callback_data=f"biz_upgrade_do_{b.id}_{cost_to_upgrade}")])
-                
     await call.message.answer("✨ **Меню Улучшений Бизнеса**\n"
                               "Улучшения повышают выход продукции!", reply_markup=kb)
 
@@ -921,77 +2152,82 @@ async def biz_upgrade_do(call: types.CallbackQuery):
     await call.answer()
     uid = call.from_user.id
     try:
-        _, _, biz_db_id_str, cost_str = call.data.split('_')
+        biz_db_id_str, cost_str = call.data.removeprefix("biz_upgrade_do_").split('_')
         biz_db_id = int(biz_db_id_str)
         cost = int(cost_str)
     except ValueError:
         return await call.message.answer("❌ Ошибка обработки данных улучшения.")
     
-    try:
+    def _tx():
         with SessionLocal() as s:
-            u = s.query(User).filter_by(telegram_id=uid).with_for_update().first()
-            b = s.query(OwnedBusiness).filter_by(id=biz_db_id, user_id=uid).with_for_update().first()
+            u = s.query(User).filter_by(telegram_id=uid).first()
+            b = s.query(OwnedBusiness).filter_by(id=biz_db_id, user_id=uid).first()
             
             if not b or u.balance < cost:
-                return await call.message.answer("❌ Бизнес не найден или недостаточно средств.")
+                return "❌ Бизнес не найден или недостаточно средств."
             
             biz_info = BUSINESSES.get(b.business_id)
-            if b.upgrade_level >= biz_info['max_level']:
-                return await call.message.answer("❌ Достигнут максимальный максимальный уровень улучшения.")
+            # Цена из кнопки - только подтверждение: списывается цена текущего уровня по таблице
+            actual_cost = upgrade_cost(b.business_id, b.upgrade_level)
+            if actual_cost is None:
+                return "❌ Достигнут максимальный максимальный уровень улучшения."
+            if actual_cost != cost:
+                return "❌ Цена улучшения изменилась, откройте меню улучшений заново."
+            if not debit_balance(s, uid, cost):
+                return "❌ Бизнес не найден или недостаточно средств."
                 
-            u.balance -= cost
             b.upgrade_level += 1
-            
-            # Расчет нового дохода: base_payout * multiplier^(level - 1)
-            # Примечание: в предыдущей логике level-1 было для следующего уровня, 
-            # здесь (b.upgrade_level - 1) - это новый, уже увеличенный уровень.
-            new_payout = int(biz_info['base_payout'] * (biz_info['payout_mult'] ** (b.upgrade_level - 1)))
+            new_payout = level_payout(b.business_id, b.upgrade_level)
             
             s.commit()
+            s.refresh(u)
+            user_cache.put(u)
             
-            await call.message.answer(
+            return (
                 f"🎉 **Улучшение Завершено!**\n"
                 f"Апгрейд: {biz_info['name']} до уровня *{b.upgrade_level}* (-{cost:,}$)\n"
                 f"Новый выход продукции: *{new_payout:,} $*"
             )
-            
+
+    try:
+        async with balance_ledger.exclusive(uid):
+            text = await run_db(_tx)
     except SQLAlchemyError as e:
         logging.error(f"Biz Upgrade DB Error: {e}")
-        await call.message.answer("❌ Ошибка БД при улучшении бизнеса.")
+        return await call.message.answer("❌ Ошибка БД при улучшении бизнеса.")
+    await call.message.answer(text)
 
 # --- Карьера (оставлена для начального дохода) ---
 @router.message(F.text == "💼 Устроиться")
 async def cmd_work_menu(message: types.Message):
-    u = get_user(message.from_user.id)
+    u = await get_user(message.from_user.id)
     # ... (логика работы и повышения оставлена без изменений)
     await message.answer("🛠 *Работа (базовый доход)*: логика в этом релизе не менялась. Выполните работу.",
                          reply_markup=get_main_kb(u.is_admin, u.is_president))
 
 @router.message(F.text == "🎁 Бонус")
 async def cmd_daily_bonus(message: types.Message):
-    u = get_user(message.from_user.id)
+    uid = message.from_user.id
     cooldown = timedelta(hours=24)
-    rem = format_cooldown(u.last_daily_bonus, cooldown)
-    
+
+    async with balance_ledger.lock(uid):
+        u = await balance_ledger.account(uid)
+        rem = format_cooldown(u.last_daily_bonus, cooldown)
+        if not rem:
+            balance_ledger.record(u, "daily_bonus", balance=DAILY_BONUS_AMOUNT, last_daily_bonus=datetime.now())
+
     if rem:
         return await message.answer(f"⏳ Следующий бонус можно получить через {rem}.", reply_markup=get_main_kb(u.is_admin, u.is_president))
-
-    with SessionLocal() as s:
-        u_db = s.query(User).filter_by(telegram_id=u.telegram_id).with_for_update().first()
-        u_db.balance += DAILY_BONUS_AMOUNT
-        u_db.last_daily_bonus = datetime.now()
-        s.commit()
-        
-        await message.answer(
-            f"🎉 **Ежедневный Бонус!** Вы получили *{DAILY_BONUS_AMOUNT:,} $*\n"
-            f"Текущий баланс: {u_db.balance:,}$",
-            reply_markup=get_main_kb(u.is_admin, u.is_president)
-        )
+    await message.answer(
+        f"🎉 **Ежедневный Бонус!** Вы получили *{DAILY_BONUS_AMOUNT:,} $*\n"
+        f"Текущий баланс: {u.balance:,}$",
+        reply_markup=get_main_kb(u.is_admin, u.is_president)
+    )
 
 # --- Казино ---
 @router.message(F.text == "🎰 Казино")
 async def cmd_casino(message: types.Message, state: FSMContext):
-    u = get_user(message.from_user.id)
+    u = await get_user(message.from_user.id)
     await state.set_state(GameStates.casino_bet)
     await message.answer(
         f"🎰 **Казино BongoCity**\n"
@@ -1006,235 +2242,922 @@ async def casino_finish(message: types.Message, state: FSMContext):
     try: bet = int(message.text)
     except:
         await state.clear()
-        return await message.answer("❌ Введите число.", reply_markup=get_main_kb(get_user(uid).is_admin, get_user(uid).is_president))
+        return await message.answer("❌ Введите число.", reply_markup=await get_user_kb(uid))
 
     await state.clear()
     
     if bet == 0:
-        return await message.answer("Отменено.", reply_markup=get_main_kb(get_user(uid).is_admin, get_user(uid).is_president))
+        return await message.answer("Отменено.", reply_markup=await get_user_kb(uid))
 
     if bet < CASINO_MIN_BET:
-        return await message.answer(f"❌ Минимальная ставка: {CASINO_MIN_BET:,}$", reply_markup=get_main_kb(get_user(uid).is_admin, get_user(uid).is_president))
-        
-    with SessionLocal() as s:
-        u = s.query(User).filter_by(telegram_id=uid).with_for_update().first()
+        return await message.answer(f"❌ Минимальная ставка: {CASINO_MIN_BET:,}$", reply_markup=await get_user_kb(uid))
         
+    async with balance_ledger.lock(uid):
+        u = await balance_ledger.account(uid)
+        kb = get_main_kb(u.is_admin, u.is_president)
         if u.balance < bet:
-            return await message.answer(f"❌ Не хватает наличных. У вас: {u.balance:,}$", reply_markup=get_main_kb(u.is_admin, u.is_president))
+            return await message.answer(f"❌ Не хватает наличных. У вас: {u.balance:,}$", reply_markup=kb)
         
         # Игра
-        multiplier = random.choice([0, 0, 0, 0, 0, 0.5, 1.5, 2.0, 3.0]) # 6/9 проигрыш или меньший выигрыш
+        multiplier = random.choice(CASINO_MULTIPLIERS)
+        delta = casino_delta(bet, multiplier)
+        balance_ledger.record(u, "casino", balance=delta)
         
         if multiplier == 0:
-            u.balance -= bet
-            msg = f"💔 **ПРОИГРЫШ!** Вы потеряли *-{bet:,} $*. Остаток: {u.balance:,}$"
-        elif multiplier == 0.5:
-            loss = int(bet * 0.5)
-            u.balance -= loss
-            msg = f"📉 **МИНУС!** Вы потеряли *-{loss:,} $*. Остаток: {u.balance:,}$"
+            msg = f"💔 **ПРОИГРЫШ!** Вы потеряли *{delta:,} $*. Остаток: {u.balance:,}$"
+        elif delta < 0:
+            msg = f"📉 **МИНУС!** Вы потеряли *{delta:,} $*. Остаток: {u.balance:,}$"
         else:
-            win = int(bet * multiplier)
-            u.balance += win
-            msg = f"🎉 **ПОБЕДА!** Ваш выигрыш: *+{win:,} $*. Остаток: {u.balance:,}$"
-            
-        s.commit()
-        await message.answer(msg, reply_markup=get_main_kb(u.is_admin, u.is_president))
+            msg = f"🎉 **ПОБЕДА!** Ваш выигрыш: *+{delta:,} $*. Остаток: {u.balance:,}$"
+
+    await message.answer(msg, reply_markup=kb)
 
 # =========================================================
 # === 9. БИРЖА РЕСУРСОВ (ДИНАМИЧЕСКИЕ ЦЕНЫ) ===
 # =========================================================
 
+class MarketEngine:
+    """
+    Цены всех товаров за один векторный шаг (NumPy) и кольцевой буфер истории.
+    Шаг - логнормальный шок с корреляцией между товарами плюс возврат к base_price.
+    История пополняется тиком (record) или из таблицы market_price_ticks (sync) -
+    так ее видят и процессы, где тик не выполнялся. Потокобезопасен.
+    """
+
+    def __init__(self, items: dict, history_size: int, mean_reversion: float, correlation: float):
+        self.item_ids = sorted(items)
+        self._index = {item_id: i for i, item_id in enumerate(self.item_ids)}
+        self.base = np.array([items[i]['base_price'] for i in self.item_ids], dtype=np.float64)
+        self.floor = self.base // 2 # Защита от слишком низких цен
+        # Равномерный шок uniform(1 - v, 1 + v) прежней версии имеет то же стандартное отклонение
+        self.sigma = np.array([items[i]['volatility'] for i in self.item_ids]) / np.sqrt(3)
+        self.mean_reversion = mean_reversion
+        corr = np.full((len(self.item_ids), len(self.item_ids)), correlation)
+        np.fill_diagonal(corr, 1.0)
+        self._chol = np.linalg.cholesky(corr)
+        self._rng = np.random.default_rng()
+
+        self._history = np.zeros((len(self.item_ids), history_size), dtype=np.int64)
+        self._pos = 0
+        self._filled = 0
+        self._last_tick: datetime | None = None
+        self._lock = threading.Lock()
+
+    def step(self, prices: np.ndarray) -> np.ndarray:
+        """Следующие цены для массива текущих (в порядке item_ids)."""
+        shocks = self._chol @ self._rng.standard_normal(len(self.item_ids))
+        log_prices = np.log(np.maximum(prices, 1))
+        log_prices += self.mean_reversion * (np.log(self.base) - log_prices) + self.sigma * shocks
+        return np.maximum(self.floor, np.rint(np.exp(log_prices))).astype(np.int64)
+
+    def record(self, tick_time: datetime, prices: np.ndarray):
+        with self._lock:
+            self._append(tick_time, prices)
+
+    def _append(self, tick_time: datetime, prices: np.ndarray):
+        if self._last_tick is not None and tick_time <= self._last_tick:
+            return
+        self._history[:, self._pos] = prices
+        self._pos = (self._pos + 1) % self._history.shape[1]
+        self._filled = min(self._filled + 1, self._history.shape[1])
+        self._last_tick = tick_time
+
+    def sync(self, s):
+        """Дописывает в историю тики из БД, которых еще нет в памяти (обычно ни одного)."""
+        with self._lock:
+            query = s.query(MarketPriceTick.tick_time, MarketPriceTick.item_id, MarketPriceTick.price)
+            if self._last_tick is not None:
+                query = query.filter(MarketPriceTick.tick_time > self._last_tick)
+            rows = query.order_by(MarketPriceTick.tick_time.desc()).limit(self._history.size).all()
+
+            prices = self._history[:, (self._pos - 1) % self._history.shape[1]].copy()
+            for i, (tick_time, item_id, price) in enumerate(reversed(rows)):
+                if item_id in self._index:
+                    prices[self._index[item_id]] = price
+                if i + 1 == len(rows) or rows[-(i + 2)][0] != tick_time:
+                    self._append(tick_time, prices)
+
+    def trends(self) -> dict[int, float]:
+        """Изменение цены за историю в памяти (доля) по item_id."""
+        with self._lock:
+            if self._filled < 2:
+                return {}
+            newest = self._history[:, (self._pos - 1) % self._history.shape[1]]
+            oldest = self._history[:, (self._pos - self._filled) % self._history.shape[1]]
+            change = (newest - oldest) / np.maximum(oldest, 1)
+        return dict(zip(self.item_ids, change.tolist()))
+
+market_engine = MarketEngine(MARKET_ITEMS, MARKET_HISTORY_TICKS, MARKET_MEAN_REVERSION, MARKET_SHOCK_CORRELATION)
+
+def _trend_label(change: float | None) -> str:
+    if change is None:
+        return ""
+    arrow = "↗️" if change > 0.005 else "↘️" if change < -0.005 else "➡️"
+    return f" {arrow} {change:+.1%}"
+
 @router.message(F.text == BTN_MARKET)
 async def cmd_market(message: types.Message):
-    with SessionLocal() as s:
-        prices = s.query(MarketItemPrice).all()
+    global _market_screen
+    screen = _market_screen
+    if screen is None or time.monotonic() - screen[0] > MARKET_SCREEN_TTL_SECONDS:
+        def _load_prices():
+            with SessionLocal() as s:
+                market_engine.sync(s)
+                return s.query(MarketItemPrice).order_by(MarketItemPrice.item_id).all()
+
+        version = _market_screen_version
+        prices = await run_db(_load_prices)
+        trends = market_engine.trends()
         
-        info = "📈 **Биржа Ресурсов BongoCity**\n(Цены меняются каждый час)\n\n"
+        info = f"📈 **Биржа Ресурсов BongoCity**\n(Цены города меняются каждый час, динамика - за {MARKET_HISTORY_TICKS} ч)\n"
+        info += "Игроки торгуют сырьем между собой через стакан заявок.\n\n"
         kb = InlineKeyboardMarkup(inline_keyboard=[])
         
         for p in prices:
             item = MARKET_ITEMS.get(p.item_id)
-            info += f"{item['name']} | Текущая Цена: *{p.current_price:,} $*\n"
-            kb.inline_keyboard.append([InlineKeyboardButton(text=f"🛒 Купить {item['name']}", callback_data=f"market_buy_{p.item_id}")])
-            
-    await message.answer(info, reply_markup=kb)
+            info += f"{item['name']} | Текущая Цена: *{p.current_price:,} $*{_trend_label(trends.get(p.item_id))}\n"
+            kb.inline_keyboard.append([InlineKeyboardButton(text=f"🛒 {item['name']}: стакан и заявки", callback_data=f"market_item_{p.item_id}")])
+        kb.inline_keyboard.append([InlineKeyboardButton(text="📋 Мои заявки", callback_data="market_orders")])
+
+        screen = (time.monotonic(), info, kb)
+        # Цены могли смениться, пока шла загрузка - тогда не кэшируем
+        if version == _market_screen_version:
+            _market_screen = screen
+        
+    await message.answer(screen[1], reply_markup=screen[2])
 
-# --- FSM для покупки на бирже (логика FSM уже встроена в biz_res_input_start/finish)
-@router.callback_query(F.data.startswith("market_buy_"))
-async def market_buy_start(call: types.CallbackQuery, state: FSMContext):
-    await call.answer("✅ Для покупки сырья, перейдите в *Бизнес-Центр* и выберите 'Запустить Производство'.")
-    # Логика FSM для покупки сырья реализована в секции бизнеса.
+# Экран биржи (время сборки, текст, клавиатура). Сбрасывается после изменения цен (_market_tick);
+# в webhook-режиме воркеры, где тик не выполнялся, обновляют его по MARKET_SCREEN_TTL_SECONDS.
+_market_screen: tuple[float, str, InlineKeyboardMarkup] | None = None
+_market_screen_version = 0
 
-# =========================================================
-# === 10. КРИМИНАЛЬНЫЕ АКТИВНОСТИ (ОГРАБЛЕНИЕ БАНКА) ===
-# =========================================================
+def invalidate_market_screen():
+    global _market_screen, _market_screen_version
+    _market_screen_version += 1
+    _market_screen = None
 
-@router.message(F.text == BTN_CRIME)
-async def cmd_crime(message: types.Message):
-    u = get_user(message.from_user.id)
-    if u.arrest_expires and u.arrest_expires > datetime.now():
-        # ИСПРАВЛЕНО: format_cooldown принимает datetime.now() как last_time для jail
-        left_time = u.arrest_expires - datetime.now()
-        left = format_cooldown(datetime.now(), left_time)
-        return await message.answer(f"🔒 Вы в тюрьме. Осталось: {left}")
-    
-    cooldown = timedelta(hours=6)
-    rem = format_cooldown(u.last_crime_time, cooldown)
-    if rem:
-        return await message.answer(f"⏳ Следующая попытка ограбления через {rem}.")
+# --- Склад сырья ---
+def add_inventory(s, deltas: dict[tuple[int, int], int]):
+    """Относительно меняет склад {(user_id, item_id): количество}, создавая недостающие строки."""
+    deltas = {key: qty for key, qty in deltas.items() if qty}
+    if not deltas:
+        return
+    inventory = InventoryItem.__table__
+    existing = set(
+        s.query(InventoryItem.user_id, InventoryItem.item_id)
+        .filter(InventoryItem.user_id.in_({uid for uid, _ in deltas}))
+    )
+    missing = [key for key in deltas if key not in existing]
+    if missing:
+        s.execute(inventory.insert(), [{'user_id': uid, 'item_id': item_id, 'quantity': 0} for uid, item_id in missing])
+    s.execute(
+        update(inventory)
+        .where(inventory.c.user_id == bindparam("uid"), inventory.c.item_id == bindparam("iid"))
+        .values(quantity=inventory.c.quantity + bindparam("delta")),
+        [{'uid': uid, 'iid': item_id, 'delta': qty} for (uid, item_id), qty in sorted(deltas.items())],
+    )
 
-    # Шанс успеха зависит от уровня работы (чем выше уровень, тем умнее игрок)
-    success_chance = 0.35 + (u.job_level * 0.02) # 35% базовый шанс + 2% за уровень работы
-    
-    # Ставка (минимальная сумма, которую можно потерять)
-    bet = u.balance / 10 # 10% от наличного баланса
-    if bet < CASINO_MIN_BET: bet = CASINO_MIN_BET
-    
-    # Защита от нулевого баланса
-    if u.balance < CASINO_MIN_BET:
-        return await message.answer("❌ У вас слишком мало наличных для ограбления. Нужно хотя бы 10,000$ (Минимальная ставка).")
-    
-    try:
-        with SessionLocal() as s:
-            u_db = s.query(User).filter_by(telegram_id=u.telegram_id).with_for_update().first()
-            u_db.last_crime_time = datetime.now()
-            
-            if random.random() < success_chance:
-                # Успех
-                win_amount = int(bet * random.uniform(2.5, 4.0)) # Выигрыш от 250% до 400%
-                u_db.balance += win_amount
-                msg = f"🎉 **ОГРАБЛЕНИЕ УСПЕШНО!** Вы сорвали куш: *+{win_amount:,.0f} $*. Вам удалось скрыться от полиции."
-            else:
-                # Провал
-                # Штраф и тюрьма
-                fine_amount = int(bet * CRIME_FINE_MULTIPLIER)
-                
-                # Защита от отрицательного баланса (если штраф больше нал.)
-                if u_db.balance < fine_amount:
-                    fine_amount = u_db.balance # Списываем все, что есть
-                    
-                u_db.balance -= fine_amount
-                u_db.arrest_expires = datetime.now() + timedelta(minutes=CRIME_JAIL_TIME_MINUTES)
-                
-                msg = (
-                    f"❌ **ОГРАБЛЕНИЕ ПРОВАЛЕНО!** Вас поймали.\n"
-                    f"💸 Штраф: *-{fine_amount:,.0f} $*\n"
-                    f"🚨 Вы отправлены в тюрьму на {CRIME_JAIL_TIME_MINUTES} минут."
-                )
-                
-            s.commit()
-            await message.answer(msg, reply_markup=get_main_kb(u.is_admin, u.is_president))
-            
-    except SQLAlchemyError:
-        await message.answer("❌ Ошибка БД при попытке преступления.")
+def take_inventory(s, uid: int, item_id: int, qty: int) -> bool:
+    """Списывает сырье со склада, если его хватает (относительный UPDATE с проверкой в WHERE)."""
+    inventory = InventoryItem.__table__
+    return s.execute(
+        update(inventory)
+        .where(inventory.c.user_id == uid, inventory.c.item_id == item_id, inventory.c.quantity >= qty)
+        .values(quantity=inventory.c.quantity - qty)
+    ).rowcount == 1
 
-# =========================================================
-# === 11. ПОЛИТИКА И ОФИС ПРЕЗИДЕНТА ===
-# =========================================================
+def get_stock(s, uid: int, item_id: int) -> int:
+    return s.query(InventoryItem.quantity).filter_by(user_id=uid, item_id=item_id).scalar() or 0
 
-@router.message(F.text == "🏛 Политика")
-async def cmd_politics(message: types.Message):
-    # (логика выборов оставлена в базовом виде, но добавлена кнопка офиса)
-    u = get_user(message.from_user.id)
-    if u.is_president:
-        return await message.answer("Вы Президент! Вам доступен 'Офис Президента'.", reply_markup=get_main_kb(u.is_admin, True))
-    
-    await message.answer("🏛 Капитолий. Подробности выборов в меню.", reply_markup=get_main_kb(u.is_admin, False))
+# --- Биржевой стакан: сведение заявок ---
+class ExchangeBatch(NamedTuple):
+    """Результат сведения пачки заявок, сохраняется одной транзакцией."""
+    orders: dict[int, tuple[int, str]] # id заявки -> (остаток, статус)
+    payouts: dict[int, int] # id заявки -> деньги к выплате владельцу
+    inventory: dict[tuple[int, int], int] # (игрок, товар) -> поступление на склад
+    fills: list
 
+def _load_exchange_requests(limit: int) -> list[tuple]:
+    """Новые заявки и запросы отмены в порядке подачи."""
+    with SessionLocal() as s:
+        return s.query(
+            MarketOrder.id, MarketOrder.user_id, MarketOrder.item_id, MarketOrder.side, MarketOrder.price,
+            MarketOrder.remaining, MarketOrder.status, MarketOrder.cancel_requested,
+        ).filter(or_(
+            MarketOrder.status == "NEW",
+            and_(MarketOrder.status == "OPEN", MarketOrder.cancel_requested.is_(True)),
+        )).order_by(MarketOrder.id).limit(limit).all()
 
-@router.message(F.text == BTN_GOV_OFFICE)
-async def cmd_pres_office(message: types.Message):
-    u = get_user(message.from_user.id)
-    if not u.is_president: return await message.answer("❌ Вы не Президент.")
+def _load_open_orders() -> list[Order]:
+    with SessionLocal() as s:
+        return [
+            Order(o.id, o.user_id, o.item_id, o.side, o.price, o.remaining)
+            for o in s.query(MarketOrder).filter_by(status="OPEN")
+        ]
 
+def _save_exchange_batch(batch: ExchangeBatch):
+    orders = MarketOrder.__table__
     with SessionLocal() as s:
-        budget = s.query(PresidentialBudget).first()
-        est = s.query(ElectionState).first()
-        
-        info = (
-            f"🦅 **Офис Президента BongoCity**\n\n"
-            f"💰 **Госбюджет**: *{budget.budget:,} $*\n"
-            f"🏛 **Налог (от доходов)**: {int(est.tax_rate*100)}%\n"
-            f"💸 **Ставка по Кредитам**: {int(est.loan_interest_rate*100)}%\n"
+        s.execute(
+            update(orders).where(orders.c.id == bindparam("oid"))
+            .values(remaining=bindparam("rem"), status=bindparam("st")),
+            [{'oid': oid, 'rem': rem, 'st': st} for oid, (rem, st) in sorted(batch.orders.items())],
         )
-        
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Изменить Гос. Налог", callback_data="pres_tax_start")],
-            [InlineKeyboardButton(text="Изменить Кредитную Ставку", callback_data="pres_loan_rate_start")],
-            [InlineKeyboardButton(text="Выдать из Госбюджета", callback_data="pres_give_budget_start")]
-        ])
+        if batch.payouts:
+            s.execute(
+                update(orders).where(orders.c.id == bindparam("oid"))
+                .values(payout=orders.c.payout + bindparam("amount")),
+                [{'oid': oid, 'amount': amount} for oid, amount in sorted(batch.payouts.items())],
+            )
+        if batch.fills:
+            now = datetime.now()
+            s.execute(MarketFill.__table__.insert(), [
+                {'item_id': f.item_id, 'buy_order_id': f.buy_order_id, 'sell_order_id': f.sell_order_id,
+                 'buyer_id': f.buyer_id, 'seller_id': f.seller_id, 'price': f.price, 'quantity': f.qty,
+                 'created_at': now}
+                for f in batch.fills
+            ])
+        add_inventory(s, batch.inventory)
+        s.commit()
 
-    await message.answer(info, reply_markup=kb)
+class ExchangeService:
+    """
+    Сведение заявок игроков (orderbook.Exchange) в ведущем процессе.
+    Хэндлеры любого процесса только пишут заявки (NEW) и запросы отмены в market_orders;
+    сервис раз в EXCHANGE_POLL_SECONDS (или сразу после wake() в своем процессе) забирает их
+    пачкой, сводит в памяти и сохраняет остатки, сделки, выплаты и склад одной транзакцией.
+    Стакан в памяти восстанавливается из открытых заявок при старте и после ошибки сохранения.
+    Балансы игроков сервис не пишет: деньги копятся в MarketOrder.payout до claim_market_payouts.
+    """
 
-# --- FSM для изменения налога ---
-@router.callback_query(F.data == "pres_tax_start")
-async def pres_tax_start(call: types.CallbackQuery, state: FSMContext):
-    await call.answer()
-    if not get_user(call.from_user.id).is_president: return
-    
-    await state.set_state(GameStates.pres_tax_input)
-    await call.message.answer(f"Введите новый Налог в % (0 до {int(TAX_MAX_RATE*100)}):")
+    def __init__(self, item_ids):
+        self.exchange = Exchange(item_ids)
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._restored = False
+        # Метрики
+        self.batches = 0
+        self.fills = 0
+        self.failures = 0
 
-@router.message(GameStates.pres_tax_input)
-async def pres_tax_finish(message: types.Message, state: FSMContext):
-    await state.clear()
-    
-    try: tax_perc = float(message.text)
-    except: return await message.answer("❌ Введите число.", reply_markup=get_main_kb(get_user(message.from_user.id).is_admin, get_user(message.from_user.id).is_president))
+    def start(self):
+        if self._task is None or self._task.done():
+            self._restored = False
+            self._task = asyncio.create_task(self._run())
 
-    if not 0 <= tax_perc <= (TAX_MAX_RATE * 100):
-        return await message.answer(f"❌ Налог должен быть от 0 до {int(TAX_MAX_RATE*100)}%.", reply_markup=get_main_kb(get_user(message.from_user.id).is_admin, get_user(message.from_user.id).is_president))
-    
-    u = get_user(message.from_user.id)
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def wake(self):
+        """Сводит новые заявки сразу, если сервис работает в этом процессе."""
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), EXCHANGE_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                if not self._restored:
+                    self.exchange.restore(await run_db(_load_open_orders))
+                    self._restored = True
+                    logging.info(f"Exchange: стакан восстановлен, открытых заявок {self.exchange.open_orders()}.")
+                notifications = await self.process()
+            except Exception as e:
+                # Стакан в памяти мог уйти вперед БД: перечитываем открытые заявки
+                self.failures += 1
+                self._restored = False
+                logging.error(f"Exchange Error: {e}")
+                continue
+            await send_notifications(notifications)
+
+    async def process(self) -> list[tuple[int, str]]:
+        """Сводит все накопившиеся заявки и отмены (пачками по EXCHANGE_BATCH_SIZE)."""
+        notifications = []
+        while True:
+            rows = await run_db(_load_exchange_requests, EXCHANGE_BATCH_SIZE)
+            if not rows:
+                break
+            batch, batch_notifications = self.match(rows)
+            await run_db(_save_exchange_batch, batch)
+            self.batches += 1
+            self.fills += len(batch.fills)
+            notifications += batch_notifications
+            if len(rows) < EXCHANGE_BATCH_SIZE:
+                break
+        return notifications
+
+    def match(self, rows: list[tuple]) -> tuple[ExchangeBatch, list[tuple[int, str]]]:
+        batch = ExchangeBatch({}, {}, {}, [])
+        filled: dict[int, list] = {} # id заявки -> [владелец, сторона, товар, количество, сумма]
+
+        def pay(order_id: int, amount: int):
+            if amount:
+                batch.payouts[order_id] = batch.payouts.get(order_id, 0) + amount
+
+        def deliver(uid: int, item_id: int, qty: int):
+            batch.inventory[(uid, item_id)] = batch.inventory.get((uid, item_id), 0) + qty
+
+        for oid, uid, item_id, side, price, remaining, status, cancel_requested in rows:
+            if cancel_requested:
+                if status == "OPEN":
+                    order = self.exchange.cancel(item_id, oid)
+                    if order is None:
+                        continue # Исполнена раньше в этой же пачке
+                    remaining = order.remaining
+                batch.orders[oid] = (remaining, "CANCELLED")
+                if side == "BUY":
+                    pay(oid, price * remaining)
+                else:
+                    deliver(uid, item_id, remaining)
+                continue
+
+            order = Order(oid, uid, item_id, side, price, remaining)
+            fills = self.exchange.submit(order)
+            batch.orders[oid] = (order.remaining, "OPEN" if order.remaining else "FILLED")
+            book = self.exchange.books[item_id]
+            for f in fills:
+                maker_id = f.sell_order_id if side == "BUY" else f.buy_order_id
+                maker = book.orders.get(maker_id)
+                batch.orders[maker_id] = (maker.remaining, "OPEN") if maker else (0, "FILLED")
+                deliver(f.buyer_id, item_id, f.qty)
+                pay(f.sell_order_id, f.price * f.qty)
+                # Покупатель-инициатор платит цену продавца, разница с его лимитом возвращается
+                if side == "BUY":
+                    pay(oid, (price - f.price) * f.qty)
+                for order_id, owner, order_side in ((f.buy_order_id, f.buyer_id, "BUY"), (f.sell_order_id, f.seller_id, "SELL")):
+                    totals = filled.setdefault(order_id, [owner, order_side, item_id, 0, 0])
+                    totals[3] += f.qty
+                    totals[4] += f.price * f.qty
+            batch.fills.extend(fills)
+
+        notifications = []
+        for order_id, (owner, order_side, item_id, qty, total) in filled.items():
+            rem, _ = batch.orders[order_id]
+            action = "Куплено" if order_side == "BUY" else "Продано"
+            notifications.append((owner,
+                f"📈 **Биржа: заявка #{order_id}**\n"
+                f"{action}: {qty:,} ед. *{MARKET_ITEMS[item_id]['name']}* по {total // qty:,}$ (всего {total:,}$)\n"
+                + (f"Осталось в заявке: {rem:,} ед.\n" if rem else "Заявка исполнена полностью.\n")
+                + ("Сырье поступило на склад." if order_side == "BUY" else "Выручка зачислится при входе на биржу.")
+            ))
+        return batch, notifications
+
+exchange_service = ExchangeService(MARKET_ITEMS)
+
+# --- Выплаты биржи ---
+def _claim_market_payouts(uid: int) -> int:
+    orders, users = MarketOrder.__table__, User.__table__
     with SessionLocal() as s:
-        est = s.query(ElectionState).with_for_update().first()
-        est.tax_rate = tax_perc / 100.0
+        rows = s.query(MarketOrder.id, MarketOrder.payout).filter(MarketOrder.user_id == uid, MarketOrder.payout > 0).all()
+        if not rows:
+            return 0
+        # Относительно: ExchangeService может в это же время начислять выплаты по тем же заявкам
+        s.execute(
+            update(orders).where(orders.c.id == bindparam("oid")).values(payout=orders.c.payout - bindparam("amount")),
+            [{'oid': oid, 'amount': amount} for oid, amount in rows],
+        )
+        total = sum(amount for _, amount in rows)
+        s.execute(update(users).where(users.c.telegram_id == uid).values(balance=users.c.balance + total))
         s.commit()
-        await message.answer(f"✅ Налог установлен на {tax_perc}%.", reply_markup=get_main_kb(u.is_admin, u.is_president))
+    user_cache.invalidate(uid)
+    leaderboard.adjust(uid, total)
+    return total
 
-# --- FSM для изменения кредитной ставки ---
-@router.callback_query(F.data == "pres_loan_rate_start")
-async def pres_loan_rate_start(call: types.CallbackQuery, state: FSMContext):
+async def claim_market_payouts(uid: int) -> int:
+    """
+    Зачисляет игроку выручку и возвраты биржи. Пишет баланс напрямую, поэтому внутри exclusive(uid).
+    При ошибке БД выплаты остаются на заявках до следующего открытия биржи.
+    """
+    try:
+        async with balance_ledger.exclusive(uid):
+            return await run_db(_claim_market_payouts, uid)
+    except SQLAlchemyError as e:
+        logging.error(f"Market payouts Error: {e}")
+        return 0
+
+def _book_levels(s, item_id: int, side: str) -> list[tuple[int, int]]:
+    """Лучшие уровни цены стороны стакана: [(цена, количество)]."""
+    price = MarketOrder.price
+    return s.query(price, func.sum(MarketOrder.remaining)).filter(
+        MarketOrder.item_id == item_id, MarketOrder.status == "OPEN", MarketOrder.side == side,
+    ).group_by(price).order_by(price.desc() if side == "BUY" else price).limit(EXCHANGE_DEPTH_LEVELS).all()
+
+def _order_side_label(side: str) -> str:
+    return "📥 Покупка" if side == "BUY" else "📤 Продажа"
+
+@router.callback_query(F.data.startswith("market_item_"))
+async def market_item(call: types.CallbackQuery):
     await call.answer()
-    if not get_user(call.from_user.id).is_president: return
-    
-    await state.set_state(GameStates.pres_loan_rate_input)
-    await call.message.answer(f"Введите новую Кредитную Ставку в % (ежедневный %):")
+    uid = call.from_user.id
+    item_id = int(call.data.split("_")[2])
+    item = MARKET_ITEMS.get(item_id)
+    if item is None:
+        return
 
-@router.message(GameStates.pres_loan_rate_input)
-async def pres_loan_rate_finish(message: types.Message, state: FSMContext):
-    await state.clear()
-    
-    try: rate_perc = float(message.text)
-    except: return await message.answer("❌ Введите число.", reply_markup=get_main_kb(get_user(message.from_user.id).is_admin, get_user(message.from_user.id).is_president))
+    claimed = await claim_market_payouts(uid)
 
-    if not 0 <= rate_perc <= 100:
-        return await message.answer(f"❌ Ставка должна быть от 0% до 100%.", reply_markup=get_main_kb(get_user(message.from_user.id).is_admin, get_user(message.from_user.id).is_president))
-    
-    u = get_user(message.from_user.id)
-    with SessionLocal() as s:
-        est = s.query(ElectionState).with_for_update().first()
-        est.loan_interest_rate = rate_perc / 100.0
-        s.commit()
-        await message.answer(f"✅ Кредитная ставка установлена на {rate_perc}%.", reply_markup=get_main_kb(u.is_admin, u.is_president))
+    def _load():
+        with SessionLocal() as s:
+            price = s.query(MarketItemPrice.current_price).filter_by(item_id=item_id).scalar()
+            return price, get_stock(s, uid, item_id), _book_levels(s, item_id, "SELL"), _book_levels(s, item_id, "BUY")
 
-# --- FSM для выдачи средств из госбюджета ---
-@router.callback_query(F.data == "pres_give_budget_start")
-async def pres_give_budget_start(call: types.CallbackQuery, state: FSMContext):
+    price, stock, asks, bids = await run_db(_load)
+
+    info = f"💰 Зачислена выручка биржи: *+{claimed:,} $*\n\n" if claimed else ""
+    info += (
+        f"📦 **{item['name']}**\n"
+        f"Цена города: *{price:,} $* | На складе: {stock:,} ед.\n\n"
+        f"📤 *Продают:*\n"
+    )
+    info += "".join(f"  {p:,}$ × {q:,}\n" for p, q in reversed(asks)) or "  —\n"
+    info += "📥 *Покупают:*\n"
+    info += "".join(f"  {p:,}$ × {q:,}\n" for p, q in bids) or "  —\n"
+
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="🏙 Купить у города", callback_data=f"market_city_{item_id}")],
+        [InlineKeyboardButton(text="📥 Заявка на покупку", callback_data=f"market_bid_{item_id}"),
+         InlineKeyboardButton(text="📤 Заявка на продажу", callback_data=f"market_ask_{item_id}")],
+        [InlineKeyboardButton(text="📋 Мои заявки", callback_data="market_orders")],
+    ])
+    await call.message.answer(info, reply_markup=kb)
+
+# --- Покупка у города на склад ---
+@router.callback_query(F.data.startswith("market_city_"))
+async def market_city_start(call: types.CallbackQuery, state: FSMContext):
     await call.answer()
-    if not get_user(call.from_user.id).is_president: return
-    
-    with SessionLocal() as s:
-        budget = s.query(PresidentialBudget).first()
-    
-    await state.set_state(GameStates.pres_give_budget)
+    item_id = int(call.data.split("_")[2])
+    if item_id not in MARKET_ITEMS:
+        return
+
+    def _load_price():
+        with SessionLocal() as s:
+            return s.query(MarketItemPrice.current_price).filter_by(item_id=item_id).scalar()
+
+    price = await run_db(_load_price)
+    await state.update_data(item_id=item_id, price=price)
+    await state.set_state(GameStates.market_city_qty)
     await call.message.answer(
-        f"💰 Госбюджет: {budget.budget:,}$ \n"
-        f"Введите ID игрока и сумму (ID сумма - на наличный баланс):"
+        f"🏙 **{MARKET_ITEMS[item_id]['name']}** по цене города: {price:,}$ за ед.\n"
+        f"Введите количество для покупки на склад (0 для отмены):"
     )
 
-@router.message(GameStates.pres_give_budget)
-async def pres_give_budget_finish(message: types.Message, state: FSMContext):
+@router.message(GameStates.market_city_qty)
+async def market_city_finish(message: types.Message, state: FSMContext):
+    uid = message.from_user.id
+    data = await state.get_data()
+    await state.clear()
+    try: units = int(message.text)
+    except: return await message.answer("❌ Введите корректное число.")
+
+    if units == 0: return await message.answer("Отменено.", reply_markup=await get_user_kb(uid))
+    if units < 0: return await message.answer("❌ Количество должно быть положительным.")
+
+    item_id, price = data['item_id'], data['price']
+    total_cost = units * price
+
+    def _tx():
+        with SessionLocal() as s:
+            u = s.query(User).filter_by(telegram_id=uid).first()
+            if not debit_balance(s, uid, total_cost):
+                return f"❌ Не хватает {total_cost - u.balance:,}$ для покупки."
+            add_inventory(s, {(uid, item_id): units})
+            s.commit()
+            s.refresh(u)
+            user_cache.put(u)
+            return (
+                f"✅ Куплено {units:,} ед. *{MARKET_ITEMS[item_id]['name']}* за {total_cost:,}$.\n"
+                f"На складе: {get_stock(s, uid, item_id):,} ед."
+            )
+
+    try:
+        async with balance_ledger.exclusive(uid):
+            text = await run_db(_tx)
+    except SQLAlchemyError:
+        return await message.answer("❌ Ошибка БД при покупке.")
+    await message.answer(text)
+
+# --- Лимитные заявки ---
+@router.callback_query(F.data.startswith("market_bid_") | F.data.startswith("market_ask_"))
+async def market_order_start(call: types.CallbackQuery, state: FSMContext):
+    await call.answer()
+    _, kind, item_id = call.data.split("_")
+    item_id = int(item_id)
+    if item_id not in MARKET_ITEMS:
+        return
+    side = "BUY" if kind == "bid" else "SELL"
+    await state.update_data(item_id=item_id, side=side)
+    await state.set_state(GameStates.market_order_input)
+    await call.message.answer(
+        f"{_order_side_label(side)} *{MARKET_ITEMS[item_id]['name']}*\n"
+        f"Введите цену за единицу и количество через пробел, например `{MARKET_ITEMS[item_id]['base_price']} 10` "
+        f"(0 для отмены).\n"
+        + ("Сумма заявки списывается сразу, неиспользованное вернется." if side == "BUY"
+           else "Сырье списывается со склада сразу, непроданное вернется.")
+    )
+
+@router.message(GameStates.market_order_input)
+async def market_order_finish(message: types.Message, state: FSMContext):
+    uid = message.from_user.id
+    data = await state.get_data()
+    await state.clear()
+    if (message.text or "").strip() == "0":
+        return await message.answer("Отменено.", reply_markup=await get_user_kb(uid))
+    try: price, qty = map(int, message.text.split())
+    except: return await message.answer("❌ Введите цену и количество через пробел.")
+
+    item_id, side = data['item_id'], data['side']
+    max_price = MARKET_ITEMS[item_id]['base_price'] * EXCHANGE_PRICE_LIMIT_MULT
+    if price <= 0 or qty <= 0:
+        return await message.answer("❌ Цена и количество должны быть положительными.")
+    if price > max_price:
+        return await message.answer(f"❌ Цена не может быть выше {max_price:,}$.")
+
+    def _tx():
+        with SessionLocal() as s:
+            open_orders = s.query(func.count(MarketOrder.id)).filter(
+                MarketOrder.user_id == uid, MarketOrder.status.in_(("NEW", "OPEN"))
+            ).scalar()
+            if open_orders >= EXCHANGE_MAX_OPEN_ORDERS:
+                return f"❌ У вас уже {open_orders} открытых заявок (максимум {EXCHANGE_MAX_OPEN_ORDERS})."
+
+            if side == "BUY":
+                u = s.query(User).filter_by(telegram_id=uid).first()
+                if not debit_balance(s, uid, price * qty):
+                    return f"❌ Не хватает {price * qty - u.balance:,}$ для заявки."
+            elif not take_inventory(s, uid, item_id, qty):
+                return f"❌ На складе только {get_stock(s, uid, item_id):,} ед."
+
+            order = MarketOrder(user_id=uid, item_id=item_id, side=side, price=price, quantity=qty, remaining=qty)
+            s.add(order)
+            s.commit()
+            if side == "BUY":
+                s.refresh(u)
+                user_cache.put(u)
+            return (
+                f"✅ **Заявка #{order.id} принята**\n"
+                f"{_order_side_label(side)} *{MARKET_ITEMS[item_id]['name']}*: {qty:,} ед. по {price:,}$\n"
+                f"Сделки придут уведомлением."
+            )
+
+    try:
+        async with balance_ledger.exclusive(uid):
+            text = await run_db(_tx)
+    except SQLAlchemyError:
+        return await message.answer("❌ Ошибка БД при подаче заявки.")
+    exchange_service.wake()
+    await message.answer(text)
+
+@router.callback_query(F.data == "market_orders")
+async def market_orders(call: types.CallbackQuery):
+    await call.answer()
+    uid = call.from_user.id
+    claimed = await claim_market_payouts(uid)
+
+    def _load():
+        with SessionLocal() as s:
+            return s.query(MarketOrder).filter(
+                MarketOrder.user_id == uid, MarketOrder.status.in_(("NEW", "OPEN"))
+            ).order_by(MarketOrder.id).all()
+
+    orders = await run_db(_load)
+    info = f"💰 Зачислена выручка биржи: *+{claimed:,} $*\n\n" if claimed else ""
+    if not orders:
+        return await call.message.answer(info + "📋 У вас нет открытых заявок.")
+
+    info += "📋 **Ваши заявки:**\n"
+    kb = InlineKeyboardMarkup(inline_keyboard=[])
+    for o in orders:
+        info += (
+            f"#{o.id} {_order_side_label(o.side)} *{MARKET_ITEMS[o.item_id]['name']}*: "
+            f"{o.remaining:,}/{o.quantity:,} ед. по {o.price:,}$" + (" (снимается)" if o.cancel_requested else "") + "\n"
+        )
+        if not o.cancel_requested:
+            kb.inline_keyboard.append([InlineKeyboardButton(text=f"❌ Снять #{o.id}", callback_data=f"market_cancel_{o.id}")])
+    await call.message.answer(info, reply_markup=kb)
+
+@router.callback_query(F.data.startswith("market_cancel_"))
+async def market_cancel(call: types.CallbackQuery):
+    uid = call.from_user.id
+    order_id = int(call.data.split("_")[2])
+
+    def _tx():
+        orders = MarketOrder.__table__
+        with SessionLocal() as s:
+            # Снимает заявку ExchangeService; здесь только запрос (заявку могут исполнять прямо сейчас)
+            requested = s.execute(
+                update(orders)
+                .where(orders.c.id == order_id, orders.c.user_id == uid, orders.c.status.in_(("NEW", "OPEN")))
+                .values(cancel_requested=True)
+            ).rowcount
+            s.commit()
+            return requested
+
+    if not await run_db(_tx):
+        return await call.answer("Заявка уже исполнена или снята.", show_alert=True)
+    exchange_service.wake()
+    await call.answer()
+    await call.message.answer(f"⏳ Заявка #{order_id} снимается. Остаток вернется на склад или в выручку биржи.")
+
+# =========================================================
+# === 10. КРИМИНАЛЬНЫЕ АКТИВНОСТИ (ОГРАБЛЕНИЕ БАНКА) ===
+# =========================================================
+
+@router.message(F.text == BTN_CRIME)
+async def cmd_crime(message: types.Message):
+    uid = message.from_user.id
+    try:
+        async with balance_ledger.lock(uid):
+            u = await balance_ledger.account(uid)
+            msg = _attempt_crime(u)
+    except SQLAlchemyError:
+        return await message.answer("❌ Ошибка БД при попытке преступления.")
+    await message.answer(msg, reply_markup=get_main_kb(u.is_admin, u.is_president))
+
+def _attempt_crime(u: User) -> str:
+    """Проверки и исход ограбления. Изменения записываются в журнал балансов (вызывается под его блокировкой)."""
+    if u.arrest_expires and u.arrest_expires > datetime.now():
+        # ИСПРАВЛЕНО: format_cooldown принимает datetime.now() как last_time для jail
+        left_time = u.arrest_expires - datetime.now()
+        left = format_cooldown(datetime.now(), left_time)
+        return f"🔒 Вы в тюрьме. Осталось: {left}"
+    
+    cooldown = timedelta(hours=CRIME_COOLDOWN_HOURS)
+    rem = format_cooldown(u.last_crime_time, cooldown)
+    if rem:
+        return f"⏳ Следующая попытка ограбления через {rem}."
+
+    # Защита от нулевого баланса
+    if u.balance < CASINO_MIN_BET:
+        return "❌ У вас слишком мало наличных для ограбления. Нужно хотя бы 10,000$ (Минимальная ставка)."
+    
+    # Шанс успеха зависит от уровня работы, штраф не больше наличных
+    delta = crime_delta(u.balance, u.job_level, random.random(), random.uniform(*CRIME_WIN_RANGE))
+    if delta > 0:
+        balance_ledger.record(u, "crime", balance=delta, last_crime_time=datetime.now())
+        return f"🎉 **ОГРАБЛЕНИЕ УСПЕШНО!** Вы сорвали куш: *+{delta:,.0f} $*. Вам удалось скрыться от полиции."
+
+    # Провал: штраф и тюрьма
+    fine_amount = -delta
+    balance_ledger.record(
+        u, "crime", balance=-fine_amount, last_crime_time=datetime.now(),
+        arrest_expires=datetime.now() + timedelta(minutes=CRIME_JAIL_TIME_MINUTES),
+    )
+    return (
+        f"❌ **ОГРАБЛЕНИЕ ПРОВАЛЕНО!** Вас поймали.\n"
+        f"💸 Штраф: *-{fine_amount:,.0f} $*\n"
+        f"🚨 Вы отправлены в тюрьму на {CRIME_JAIL_TIME_MINUTES} минут."
+    )
+
+# =========================================================
+# === 11. ПОЛИТИКА И ОФИС ПРЕЗИДЕНТА ===
+# =========================================================
+
+# --- Выборы (голоса считает ElectionService в ведущем процессе) ---
+class ElectionView(NamedTuple):
+    election: Election | None # Текущие выборы (не CLOSED)
+    candidates: list[tuple[int, str | None, int]] # (id, имя, учтенные голоса)
+    president_name: str | None
+    last_election_time: datetime
+
+def _load_candidates(s, election_id: int) -> list[tuple[int, str | None, int]]:
+    """Кандидаты в порядке регистрации (он же решает ничью) с сохраненными итогами подсчета."""
+    return s.query(ElectionCandidate.user_id, User.username, ElectionCandidate.votes).join(
+        User, User.telegram_id == ElectionCandidate.user_id
+    ).filter(ElectionCandidate.election_id == election_id).order_by(
+        ElectionCandidate.registered_at, ElectionCandidate.user_id
+    ).all()
+
+def _load_election_view() -> ElectionView:
+    with SessionLocal() as s:
+        est = s.query(ElectionState).first()
+        president_name = None
+        if est.current_president_id:
+            president_name = s.query(User.username).filter_by(telegram_id=est.current_president_id).scalar()
+        election = s.query(Election).filter(Election.status != "CLOSED").order_by(Election.id).first()
+        candidates = _load_candidates(s, election.id) if election else []
+        return ElectionView(election, candidates, president_name, est.last_election_time)
+
+@router.message(F.text == "🏛 Политика")
+async def cmd_politics(message: types.Message):
+    u = await get_user(message.from_user.id)
+    if not u:
+        return await message.answer("Пожалуйста, начните с команды /start.")
+    view = await run_db(_load_election_view)
+    e = view.election
+
+    lines = ["🏛 **Капитолий**\n", f"🦅 Президент: {view.president_name or 'не избран'}"]
+    kb = None
+    if e is None:
+        next_at = max(view.last_election_time + timedelta(days=ELECTION_INTERVAL_DAYS), datetime.now())
+        lines.append(f"🗳 Следующие выборы: {next_at:%d.%m %H:%M}")
+    elif e.status == "REGISTRATION":
+        lines.append(
+            f"📝 Выборы #{e.id}: регистрация кандидатов до {e.registration_ends:%d.%m %H:%M}, "
+            f"голосование до {e.voting_ends:%d.%m %H:%M}. Взнос кандидата: {ELECTION_CANDIDATE_FEE:,}$."
+        )
+        lines += [f"• {name or cid}" for cid, name, _ in view.candidates]
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="📝 Выдвинуть свою кандидатуру", callback_data=f"elect_register_{e.id}")]
+        ])
+    else:
+        lines.append(f"🗳 Выборы #{e.id}: голосование до {e.voting_ends:%d.%m %H:%M} (итоги обновляются каждые несколько секунд).")
+        lines += [f"• {name or cid} — {votes:,} гол." for cid, name, votes in view.candidates]
+        kb = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text=f"🗳 {name or cid}", callback_data=f"elect_vote_{e.id}_{cid}")]
+            for cid, name, _ in view.candidates
+        ])
+    if u.is_president:
+        lines.append("\nВы Президент! Вам доступен 'Офис Президента'.")
+
+    await message.answer("\n".join(lines), reply_markup=kb or get_main_kb(u.is_admin, u.is_president))
+
+@router.callback_query(F.data.startswith("elect_register_"))
+async def elect_register(call: types.CallbackQuery):
+    await call.answer()
+    uid = call.from_user.id
+    election_id = int(call.data.removeprefix("elect_register_"))
+
+    def _tx():
+        with SessionLocal() as s:
+            now = datetime.now()
+            e = s.query(Election).filter_by(id=election_id).first()
+            if not e or e.status != "REGISTRATION" or now >= e.registration_ends:
+                return "❌ Регистрация кандидатов закрыта."
+            if s.query(ElectionCandidate).filter_by(election_id=election_id, user_id=uid).first():
+                return "ℹ️ Вы уже зарегистрированы кандидатом."
+            if s.query(func.count(ElectionCandidate.user_id)).filter_by(election_id=election_id).scalar() >= ELECTION_MAX_CANDIDATES:
+                return f"❌ Кандидатов уже {ELECTION_MAX_CANDIDATES} - регистрация заполнена."
+            if not debit_balance(s, uid, ELECTION_CANDIDATE_FEE):
+                return f"❌ Взнос кандидата - {ELECTION_CANDIDATE_FEE:,}$ наличными."
+
+            # Взнос идет в Госбюджет
+            credit_budget(s, ELECTION_CANDIDATE_FEE)
+            s.add(ElectionCandidate(election_id=election_id, user_id=uid, votes=0, registered_at=now))
+            s.commit()
+            u = s.query(User).filter_by(telegram_id=uid).first()
+            user_cache.put(u)
+            return (
+                f"✅ Вы зарегистрированы кандидатом на выборах #{election_id} (-{ELECTION_CANDIDATE_FEE:,}$).\n"
+                f"Голосование начнется {e.registration_ends:%d.%m %H:%M}."
+            )
+
+    try:
+        async with balance_ledger.exclusive(uid):
+            text = await run_db(_tx)
+    except SQLAlchemyError:
+        return await call.message.answer("❌ Ошибка БД при регистрации кандидата.")
+    await call.message.answer(text)
+
+def _cast_vote(uid: int, election_id: int, candidate_id: int) -> str:
+    """Записывает голос (уникальный индекс - один голос на выборы). Считает его ElectionService."""
+    with SessionLocal() as s:
+        e = s.query(Election.status, Election.voting_ends).filter_by(id=election_id).first()
+        if not e or e.status != "VOTING" or datetime.now() >= e.voting_ends:
+            return "❌ Голосование закрыто."
+        if not s.query(ElectionCandidate.user_id).filter_by(election_id=election_id, user_id=candidate_id).first():
+            return "❌ Кандидат не найден."
+        s.add(ElectionVote(election_id=election_id, voter_id=uid, candidate_id=candidate_id))
+        try:
+            s.commit()
+        except IntegrityError:
+            return "ℹ️ Вы уже проголосовали на этих выборах."
+        return "✅ Ваш голос принят!"
+
+@router.callback_query(F.data.startswith("elect_vote_"))
+async def elect_vote(call: types.CallbackQuery):
+    await call.answer()
+    uid = call.from_user.id
+    try:
+        election_id_str, candidate_id_str = call.data.removeprefix("elect_vote_").split('_')
+        election_id, candidate_id = int(election_id_str), int(candidate_id_str)
+    except ValueError:
+        return await call.message.answer("❌ Ошибка обработки данных.")
+    if not await get_user(uid):
+        return await call.message.answer("Пожалуйста, начните с команды /start.")
+
+    try:
+        text = await run_db(_cast_vote, uid, election_id, candidate_id)
+    except SQLAlchemyError:
+        return await call.message.answer("❌ Ошибка БД при голосовании.")
+    await call.message.answer(text)
+
+
+@router.message(F.text == BTN_GOV_OFFICE)
+async def cmd_pres_office(message: types.Message):
+    u = await get_user(message.from_user.id)
+    if not u.is_president: return await message.answer("❌ Вы не Президент.")
+
+    def _load_budget():
+        with SessionLocal() as s:
+            return read_budget(s)
+
+    budget = await run_db(_load_budget)
+    est = economy
+    
+    info = (
+        f"🦅 **Офис Президента BongoCity**\n\n"
+        f"💰 **Госбюджет**: *{budget:,} $*\n"
+        f"🏛 **Налог (от доходов)**: {int(est.tax_rate*100)}%\n"
+        f"💸 **Ставка по Кредитам**: {int(est.loan_interest_rate*100)}%\n"
+    )
+    
+    kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Изменить Гос. Налог", callback_data="pres_tax_start")],
+        [InlineKeyboardButton(text="Изменить Кредитную Ставку", callback_data="pres_loan_rate_start")],
+        [InlineKeyboardButton(text="Выдать из Госбюджета", callback_data="pres_give_budget_start")]
+    ])
+
+    await message.answer(info, reply_markup=kb)
+
+# --- FSM для изменения налога ---
+@router.callback_query(F.data == "pres_tax_start")
+async def pres_tax_start(call: types.CallbackQuery, state: FSMContext):
+    await call.answer()
+    if not (await get_user(call.from_user.id)).is_president: return
+    
+    await state.set_state(GameStates.pres_tax_input)
+    await call.message.answer(f"Введите новый Налог в % (0 до {int(TAX_MAX_RATE*100)}):")
+
+@router.message(GameStates.pres_tax_input)
+async def pres_tax_finish(message: types.Message, state: FSMContext):
+    await state.clear()
+    
+    try: tax_perc = float(message.text)
+    except: return await message.answer("❌ Введите число.", reply_markup=await get_user_kb(message.from_user.id))
+
+    if not 0 <= tax_perc <= (TAX_MAX_RATE * 100):
+        return await message.answer(f"❌ Налог должен быть от 0 до {int(TAX_MAX_RATE*100)}%.", reply_markup=await get_user_kb(message.from_user.id))
+    
+    u = await get_user(message.from_user.id)
+
+    def _tx():
+        with SessionLocal() as s:
+            est = s.query(ElectionState).with_for_update().first()
+            est.tax_rate = tax_perc / 100.0
+            est.version += 1
+            s.commit()
+            refresh_economy(est)
+
+    await run_db(_tx)
+    await message.answer(f"✅ Налог установлен на {tax_perc}%.", reply_markup=get_main_kb(u.is_admin, u.is_president))
+
+# --- FSM для изменения кредитной ставки ---
+@router.callback_query(F.data == "pres_loan_rate_start")
+async def pres_loan_rate_start(call: types.CallbackQuery, state: FSMContext):
+    await call.answer()
+    if not (await get_user(call.from_user.id)).is_president: return
+    
+    await state.set_state(GameStates.pres_loan_rate_input)
+    await call.message.answer(f"Введите новую Кредитную Ставку в % (ежедневный %):")
+
+@router.message(GameStates.pres_loan_rate_input)
+async def pres_loan_rate_finish(message: types.Message, state: FSMContext):
+    await state.clear()
+    
+    try: rate_perc = float(message.text)
+    except: return await message.answer("❌ Введите число.", reply_markup=await get_user_kb(message.from_user.id))
+
+    if not 0 <= rate_perc <= 100:
+        return await message.answer(f"❌ Ставка должна быть от 0% до 100%.", reply_markup=await get_user_kb(message.from_user.id))
+    
+    u = await get_user(message.from_user.id)
+
+    def _tx():
+        with SessionLocal() as s:
+            est = s.query(ElectionState).with_for_update().first()
+            est.loan_interest_rate = rate_perc / 100.0
+            est.version += 1
+            s.commit()
+            refresh_economy(est)
+
+    await run_db(_tx)
+    await message.answer(f"✅ Кредитная ставка установлена на {rate_perc}%.", reply_markup=get_main_kb(u.is_admin, u.is_president))
+
+# --- FSM для выдачи средств из госбюджета ---
+@router.callback_query(F.data == "pres_give_budget_start")
+async def pres_give_budget_start(call: types.CallbackQuery, state: FSMContext):
+    await call.answer()
+    if not (await get_user(call.from_user.id)).is_president: return
+    
+    def _load_budget():
+        with SessionLocal() as s:
+            return read_budget(s)
+
+    budget = await run_db(_load_budget)
+    
+    await state.set_state(GameStates.pres_give_budget)
+    await call.message.answer(
+        f"💰 Госбюджет: {budget:,}$ \n"
+        f"Введите ID игрока и сумму (ID сумма - на наличный баланс):"
+    )
+
+@router.message(GameStates.pres_give_budget)
+async def pres_give_budget_finish(message: types.Message, state: FSMContext):
     await state.clear()
     pres_id = message.from_user.id
     
@@ -1245,32 +3168,36 @@ async def pres_give_budget_finish(message: types.Message, state: FSMContext):
     except:
         return await message.answer("❌ Неверный формат ввода (ожидался: ID сумма).", reply_markup=get_main_kb(is_president=True))
         
-    try:
-        u_pres = get_user(pres_id)
-        if not u_pres.is_president: raise PermissionError("Not president")
-        
+    def _tx():
         with SessionLocal() as s:
             
-            budget = s.query(PresidentialBudget).with_for_update().first()
-            u_target = s.query(User).filter_by(telegram_id=target_id).with_for_update().first()
-            
-            if not u_target: return await message.answer("❌ Целевой игрок не найден.")
-            if budget.budget < amount: return await message.answer(f"❌ В бюджете не хватает средств. Доступно: {budget.budget:,}$")
-            if amount <= 0: return await message.answer("❌ Сумма должна быть положительной.")
+            if amount <= 0: return "❌ Сумма должна быть положительной.", False
+            if not s.query(User.telegram_id).filter_by(telegram_id=target_id).first():
+                return "❌ Целевой игрок не найден.", False
+
+            available = debit_budget(s, amount)
+            if available < amount: return f"❌ В бюджете не хватает средств. Доступно: {available:,}$", False
             
-            budget.budget -= amount
-            u_target.balance += amount
+            # Игрок может в это же время тратить наличные в своем воркере - только относительно
+            credit_balance(s, target_id, amount)
             s.commit()
-            
-            await message.answer(f"✅ Игроку `{target_id}` успешно выдано {amount:,}$ из Госбюджета.")
-            # Использование глобального объекта bot для отправки уведомления
-            await bot.send_message(target_id, f"🚨 Президент выдал вам {amount:,}$ из Государственного Бюджета.")
+            user_cache.invalidate(target_id)
+            leaderboard.adjust(target_id, amount)
+            return f"✅ Игроку `{target_id}` успешно выдано {amount:,}$ из Госбюджета.", True
+
+    try:
+        u_pres = await get_user(pres_id)
+        if not u_pres.is_president: raise PermissionError("Not president")
+        
+        # Без exclusive(target_id): зачисление относительное, а апдейты игрока может обрабатывать другой воркер
+        text, paid = await run_db(_tx)
+        await message.answer(text)
+        if paid:
+            notifier.enqueue(target_id, f"🚨 Президент выдал вам {amount:,}$ из Государственного Бюджета.")
 
     except Exception as e:
         # Проверка, если сообщение было от президента, чтобы вернуть ему клавиатуру
-        is_pres = get_user(pres_id).is_president
-        is_admin = get_user(pres_id).is_admin
-        await message.answer(f"❌ Ошибка: Внутренняя ошибка или недостаточно прав.", reply_markup=get_main_kb(is_admin, is_pres))
+        await message.answer(f"❌ Ошибка: Внутренняя ошибка или недостаточно прав.", reply_markup=await get_user_kb(pres_id))
         logging.error(f"Pres Budget FSM Error: {e}")
         
     finally:
@@ -1281,102 +3208,938 @@ async def pres_give_budget_finish(message: types.Message, state: FSMContext):
 # === 12. ФОНОВЫЕ ЗАДАЧИ (SCHEDULER) ===
 # =========================================================
 
-async def check_elections_and_payouts():
-    """Фоновая проверка: выборы, производство, кредиты, динамика рынка."""
-    logging.info("Scheduler: Checking all background timers...")
-    now = datetime.now() # Определяем время один раз
-    
-    # --- A. Динамика Рынка ---
+# --- Очередь исходящих уведомлений ---
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, запас не больше capacity."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Останавливает выдачу токенов (например, после RetryAfter от Telegram)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class NotificationQueue:
+    """
+    Очередь исходящих сообщений с пулом воркеров.
+    Соблюдает общий лимит Telegram (TokenBucket) и интервал для каждого чата,
+    повторяет отправку после RetryAfter/сетевых ошибок и отбрасывает дубликаты,
+    которые еще ждут отправки. Результат каждой отправки доступен через Future:
+    "sent", "dead" (бот заблокирован/чат не найден), "failed" или "duplicate".
+    Ошибки различаются по типу исключения, а не по тексту ответа Telegram. Группа,
+    ставшая супергруппой, получает сообщение по новому ID; замена пишется в migrations.
+    """
+
+    def __init__(self, workers: int, global_rate: float):
+        self.workers = workers
+        self.bucket = TokenBucket(global_rate)
+        self._queue: asyncio.Queue | None = None
+        self._pending: set = set()
+        self._next_send: dict[int, float] = {}
+        self._tasks: list[asyncio.Task] = []
+        self.migrations: dict[int, int] = {} # старый ID чата -> новый (забирает рассылка)
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def enqueue(self, chat_id: int, text: str, dedupe_key=None, bot_: Bot | None = None) -> asyncio.Future:
+        """Ставит сообщение в очередь. Не ждет отправки."""
+        done = asyncio.get_running_loop().create_future()
+        key = dedupe_key if dedupe_key is not None else (chat_id, text)
+        if key in self._pending:
+            done.set_result("duplicate")
+            return done
+        self._pending.add(key)
+        self._queue.put_nowait((chat_id, text, key, bot_, done))
+        return done
+
+    async def join(self):
+        """Ждет, пока очередь опустеет."""
+        await self._queue.join()
+
+    def _chat_interval(self, chat_id: int) -> float:
+        # Отрицательные ID - группы и каналы
+        return NOTIFY_GROUP_INTERVAL if chat_id < 0 else NOTIFY_PRIVATE_INTERVAL
+
+    async def _wait_chat_slot(self, chat_id: int):
+        now = time.monotonic()
+        next_send = self._next_send.get(chat_id, 0.0)
+        self._next_send[chat_id] = max(now, next_send) + self._chat_interval(chat_id)
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+        if len(self._next_send) > 10000:
+            # Забываем чаты, для которых интервал уже истек
+            self._next_send = {cid: t for cid, t in self._next_send.items() if t > now}
+
+    async def _send(self, chat_id: int, text: str, bot_: Bot | None) -> str:
+        origin = chat_id
+        for attempt in range(NOTIFY_MAX_RETRIES + 1):
+            await self._wait_chat_slot(chat_id)
+            await self.bucket.acquire()
+            try:
+                # Использование глобального объекта bot
+                await (bot_ or bot).send_message(chat_id, text)
+                return "sent"
+            except TelegramRetryAfter as e:
+                # Telegram просит подождать: притормаживаем всю очередь
+                self.bucket.pause(e.retry_after)
+                await asyncio.sleep(e.retry_after)
+            except TelegramMigrateToChat as e:
+                # Группа стала супергруппой: повторяем по новому ID
+                chat_id = self.migrations[origin] = e.migrate_to_chat_id
+            except (TelegramForbiddenError, TelegramNotFound):
+                return "dead" # Бот заблокирован / исключен из чата / чат удален
+            except TelegramBadRequest as e:
+                # "chat not found" тоже приходит как 400: такие чаты отсеивает счетчик Chat.failures
+                logging.warning(f"Уведомление {chat_id} отклонено: {e.message}")
+                return "failed"
+            except (TelegramNetworkError, TelegramServerError) as e:
+                logging.warning(f"Уведомление {chat_id}: попытка {attempt + 1} не удалась ({e})")
+                await asyncio.sleep(2 ** attempt)
+            except TelegramAPIError as e:
+                logging.warning(f"Уведомление {chat_id} не отправлено: {e}")
+                return "failed"
+        return "failed"
+
+    async def _worker(self):
+        while True:
+            chat_id, text, key, bot_, done = await self._queue.get()
+            try:
+                status = await self._send(chat_id, text, bot_)
+            except Exception as e:
+                logging.error(f"Notification worker error: {e}")
+                status = "failed"
+            finally:
+                self._pending.discard(key)
+                self._queue.task_done()
+            if not done.done():
+                done.set_result(status)
+
+notifier = NotificationQueue(workers=NOTIFY_WORKERS, global_rate=NOTIFY_GLOBAL_RATE)
+
+# --- Фоновые этапы: у каждого своя транзакция, расписание, таймаут и метрики ---
+def _market_tick(now: datetime) -> list[tuple[int, str]]:
+    """A. Динамика Рынка"""
     with SessionLocal() as s:
-        prices = s.query(MarketItemPrice).with_for_update().all()
-        for p in prices:
-            item_info = MARKET_ITEMS[p.item_id]
-            volatility = item_info['volatility']
-            
-            # Изменение цены (до 2*волатильности)
-            change_factor = random.uniform(1 - volatility, 1 + volatility)
-            p.current_price = int(p.current_price * change_factor)
-            p.current_price = max(item_info['base_price'] // 2, p.current_price) # Защита от слишком низких цен
-        
-        # --- B. Проверка Производства ---
-        bizs_in_prod = s.query(OwnedBusiness).filter_by(production_state="PRODUCING").with_for_update().all()
-        for b in bizs_in_prod:
-            if b.production_start_time and now - b.production_start_time >= timedelta(hours=PRODUCTION_CYCLE_HOURS):
-                b.production_state = "READY"
-                # Отправка уведомления пользователю
-                biz_name = BUSINESSES.get(b.business_id)['name']
-                try:
-                    # Использование глобального объекта bot
-                    await bot.send_message(b.user_id, f"✅ **ПРОИЗВОДСТВО ЗАВЕРШЕНО!** Ваш бизнес *{biz_name}* готов к сбору продукции.")
-                except TelegramAPIError:
-                    pass # Игнорируем ошибки, если бот заблокирован
-        
-        # --- C. Проверка Кредитов (Начисление процентов и Просрочки) ---
-        loans = s.query(BankLoan).filter_by(paid=False).with_for_update().all()
-        for loan in loans:
-            # Проверка на просрочку
-            if now > loan.due_date:
-                # Если просрочено, штрафуем (переводим налог в Госбюджет)
-                loan_days_overdue = (now - loan.due_date).days
-                # Начисляем штраф каждый LOAN_CYCLE_DAYS дней после просрочки
-                if loan_days_overdue > 0 and loan_days_overdue % LOAN_CYCLE_DAYS == 0:
-                    budget = s.query(PresidentialBudget).with_for_update().first()
-                    fine_amount = int(loan.amount * loan.interest_rate * 2) # Двойной процент за просрочку
-                    
-                    u = s.query(User).filter_by(telegram_id=loan.user_id).with_for_update().first()
-                    
-                    if u and u.bank_balance >= fine_amount:
-                        u.bank_balance -= fine_amount
-                        budget.budget += fine_amount
-                        try:
-                            await bot.send_message(loan.user_id, f"🚨 **ШТРАФ ЗА ПРОСРОЧКУ!** Со счета списано {fine_amount:,}$ ({int(loan.interest_rate*200)}% штрафа).")
-                        except TelegramAPIError: pass
-                    else:
-                        # Если денег нет, ничего не делаем, ждем, пока накопятся.
-                        pass
-                        
-        # --- D. Проверка Тюрьмы ---
-        # NOTE: Фильтр должен быть `User.arrest_expires > now`
-        jailed_users = s.query(User).filter(User.arrest_expires.isnot(None), User.arrest_expires <= now).with_for_update().all()
-        for u in jailed_users:
-            if u.arrest_expires and u.arrest_expires <= now:
-                u.arrest_expires = None
+        market_engine.sync(s)
+        rows = {p.item_id: p for p in s.query(MarketItemPrice).with_for_update().all()}
+        current = np.array([rows[item_id].current_price for item_id in market_engine.item_ids])
+        new_prices = market_engine.step(current)
+        for item_id, price in zip(market_engine.item_ids, new_prices.tolist()):
+            rows[item_id].current_price = price
+        s.execute(MarketPriceTick.__table__.insert(), [
+            {'tick_time': now, 'item_id': item_id, 'price': price}
+            for item_id, price in zip(market_engine.item_ids, new_prices.tolist())
+        ])
+        s.commit()
+    market_engine.record(now, new_prices)
+    invalidate_market_screen()
+    return []
+
+# B. Завершение производства выполняет production_scheduler точно ко времени готовности.
+
+def _pending_fine_times(s, now: datetime) -> list[datetime]:
+    """
+    Моменты начисления штрафов (LOAN_FINE_HOUR каждого дня) после отметки в stage_checkpoints
+    до now включительно - в том числе пропущенные, пока процесс или ведущий не работал.
+    Отметка сдвигается в той же транзакции, что и списания.
+    """
+    last = datetime(now.year, now.month, now.day, LOAN_FINE_HOUR)
+    if now < last:
+        last -= timedelta(days=1)
+    checkpoint = s.query(StageCheckpoint).filter_by(name="loans").with_for_update().first()
+    if checkpoint is None:
+        # Первый запуск: прошедшие дни уже обработал прежний ежедневный запуск
+        s.add(StageCheckpoint(name="loans", processed_through=last.date()))
+        return []
+
+    done = checkpoint.processed_through
+    fine_time = datetime(done.year, done.month, done.day, LOAN_FINE_HOUR) + timedelta(days=1)
+    times = []
+    while fine_time <= last:
+        times.append(fine_time)
+        fine_time += timedelta(days=1)
+    checkpoint.processed_through = last.date()
+    return times
+
+def _apply_loan_fines(now: datetime) -> list[tuple[int, str]]:
+    """
+    C. Проверка Кредитов (Штрафы за просрочку). Запускается каждый час, штрафы за день
+    начисляются один раз (см. _pending_fine_times). Кредиты, погашенные до запуска,
+    за пропущенные дни не штрафуются.
+    Подходящие кредиты выбираются одним запросом на день вместе с банковским балансом владельца,
+    списания и зачисление в Госбюджет выполняются пакетными UPDATE.
+    """
+    notifications = []
+    balances = {}
+    fines_by_user = {}
+    with SessionLocal() as s:
+        for fine_time in _pending_fine_times(s, now):
+            days_overdue = days_between(bindparam("now", fine_time, type_=DateTime), BankLoan.due_date)
+            # Начисляем штраф каждый LOAN_CYCLE_DAYS дней после просрочки
+            rows = s.query(BankLoan.user_id, BankLoan.amount, BankLoan.interest_rate, User.bank_balance).join(
+                User, User.telegram_id == BankLoan.user_id
+            ).filter(
+                BankLoan.paid == False,
+                BankLoan.due_date < fine_time,
+                days_overdue > 0,
+                days_overdue % LOAN_CYCLE_DAYS == 0,
+            ).order_by(BankLoan.id).with_for_update(of=User).all()
+
+            for user_id, amount, interest_rate, bank_balance in rows:
+                balances.setdefault(user_id, bank_balance)
+                fine_amount = loan_overdue_fine(amount, interest_rate)
+                # Если денег нет, ничего не делаем, ждем, пока накопятся.
+                if balances[user_id] >= fine_amount:
+                    balances[user_id] -= fine_amount
+                    fines_by_user[user_id] = fines_by_user.get(user_id, 0) + fine_amount
+                    notifications.append((user_id, f"🚨 **ШТРАФ ЗА ПРОСРОЧКУ!** Со счета списано {fine_amount:,}$ ({int(interest_rate * LOAN_OVERDUE_FINE_MULT * 100)}% штрафа)."))
+
+        if fines_by_user:
+            users = User.__table__
+            s.execute(
+                update(users).where(users.c.telegram_id == bindparam("b_uid"))
+                .values(bank_balance=users.c.bank_balance - bindparam("b_fine")),
+                [{"b_uid": uid, "b_fine": fine} for uid, fine in fines_by_user.items()],
+            )
+            # Штрафы идут в Госбюджет
+            credit_budget(s, sum(fines_by_user.values()))
+        s.commit()
+
+    for uid, fine in fines_by_user.items():
+        user_cache.invalidate(uid)
+        leaderboard.adjust(uid, -fine)
+    return notifications
+
+def _release_prisoners(now: datetime) -> list[tuple[int, str]]:
+    """D. Проверка Тюрьмы"""
+    users = User.__table__
+    with SessionLocal() as s:
+        released = bulk_transition(
+            s, users,
+            where=[users.c.arrest_expires.isnot(None), users.c.arrest_expires <= now],
+            values={'arrest_expires': None},
+            returning=[users.c.telegram_id],
+        )
+        s.commit()
+
+    notifications = []
+    for (uid,) in released:
+        user_cache.invalidate(uid)
+        notifications.append((uid, "🎉 **ВЫ СВОБОДНЫ!** Тюремный срок окончен."))
+    return notifications
+
+# E. Проверка и Запуск Выборов
+def _load_active_election() -> tuple | None:
+    with SessionLocal() as s:
+        return s.query(Election.id, Election.status, Election.registration_ends, Election.voting_ends).filter(
+            Election.status != "CLOSED"
+        ).order_by(Election.id).first()
+
+def _open_election(now: datetime) -> Election | None:
+    """Объявляет выборы, если с прошлых прошло ELECTION_INTERVAL_DAYS."""
+    with SessionLocal() as s:
+        est = s.query(ElectionState).first()
+        if now < est.last_election_time + timedelta(days=ELECTION_INTERVAL_DAYS):
+            return None
+        registration_ends = now + timedelta(hours=ELECTION_REGISTRATION_HOURS)
+        e = Election(
+            status="REGISTRATION", registration_ends=registration_ends,
+            voting_ends=registration_ends + timedelta(hours=ELECTION_VOTING_HOURS), total_votes=0, created_at=now,
+        )
+        s.add(e)
+        s.commit()
+        return e
+
+def _load_election_candidates(election_id: int) -> list[tuple[int, str | None, int]]:
+    with SessionLocal() as s:
+        return _load_candidates(s, election_id)
+
+def _start_voting(election_id: int):
+    with SessionLocal() as s:
+        s.query(Election).filter_by(id=election_id, status="REGISTRATION").update({'status': "VOTING"})
+        s.commit()
+
+def _count_votes(election_id: int, limit: int) -> dict[int, int]:
+    """
+    Учитывает пачку новых голосов одной транзакцией: помечает их counted и прибавляет
+    к итогам кандидатов. Возвращает прибавку по кандидатам.
+    """
+    votes, candidates, elections = ElectionVote.__table__, ElectionCandidate.__table__, Election.__table__
+    with SessionLocal() as s:
+        rows = s.query(ElectionVote.id, ElectionVote.candidate_id).filter(
+            ElectionVote.counted.is_(False), ElectionVote.election_id == election_id
+        ).order_by(ElectionVote.id).limit(limit).all()
+        if not rows:
+            return {}
+        deltas: dict[int, int] = {}
+        for _, candidate_id in rows:
+            deltas[candidate_id] = deltas.get(candidate_id, 0) + 1
+        s.execute(update(votes).where(votes.c.id.in_([vote_id for vote_id, _ in rows])).values(counted=True))
+        s.execute(
+            update(candidates)
+            .where(candidates.c.election_id == election_id, candidates.c.user_id == bindparam("cid"))
+            .values(votes=candidates.c.votes + bindparam("n")),
+            [{'cid': cid, 'n': n} for cid, n in sorted(deltas.items())],
+        )
+        s.execute(update(elections).where(elections.c.id == election_id).values(total_votes=elections.c.total_votes + len(rows)))
+        s.commit()
+        return deltas
+
+def _close_election(election_id: int, winner_id: int | None, now: datetime) -> list[int]:
+    """
+    Закрывает выборы. С победителем - переключает is_president одним UPDATE
+    (прежний президент и победитель) и записывает его в ElectionState.
+    Возвращает игроков, у которых изменился is_president.
+    """
+    users = User.__table__
+    with SessionLocal() as s:
+        changed = []
+        if winner_id is not None:
+            changed = [uid for uid, in bulk_transition(
+                s, users,
+                where=[or_(users.c.is_president.is_(True), users.c.telegram_id == winner_id)],
+                values={'is_president': users.c.telegram_id == winner_id},
+                returning=[users.c.telegram_id],
+            )]
+        s.query(Election).filter_by(id=election_id).update({'status': "CLOSED", 'winner_id': winner_id})
+        est = s.query(ElectionState).with_for_update().first()
+        if winner_id is not None:
+            est.current_president_id = winner_id
+        est.last_election_time = now
+        est.version += 1
+        s.commit()
+        refresh_economy(est)
+    return changed
+
+class ElectionService:
+    """
+    Выборы президента в ведущем процессе: объявление, переход к голосованию и итоги.
+    Хэндлеры любого процесса пишут кандидатов и голоса (election_votes, один на игрока);
+    сервис раз в ELECTION_TALLY_SECONDS учитывает новые голоса пачками и держит итог в памяти,
+    сохраняя его в ElectionCandidate.votes той же транзакцией, что помечает голоса учтенными.
+    К концу голосования итог уже посчитан: закрытие не сканирует голоса.
+    Итог в памяти восстанавливается из ElectionCandidate.votes при старте и после ошибки.
+    """
+
+    def __init__(self):
+        self.election_id: int | None = None
+        self.tally: dict[int, int] = {} # кандидат -> голоса, в порядке регистрации
+        self.names: dict[int, str | None] = {}
+        self._task: asyncio.Task | None = None
+        # Метрики
+        self.counted_votes = 0
+        self.failures = 0
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self.election_id = None
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                announcements, notifications = await self.step(datetime.now())
+            except Exception as e:
+                # Итог в памяти мог разойтись с БД: перечитываем его на следующем шаге
+                self.failures += 1
+                self.election_id = None
+                logging.error(f"Elections Error: {e}")
+            else:
+                await send_notifications(notifications)
+                for text in announcements:
+                    self.announce(text)
+            await asyncio.sleep(ELECTION_TALLY_SECONDS)
+
+    def announce(self, text: str):
+        # Рассылка по всем чатам долгая - подсчет голосов ее не ждет
+        broadcast_service.submit(text)
+
+    async def _restore(self, election_id: int):
+        candidates = await run_db(_load_election_candidates, election_id)
+        self.tally = {cid: votes for cid, _, votes in candidates}
+        self.names = {cid: name for cid, name, _ in candidates}
+        self.election_id = election_id
+
+    def _name(self, uid: int) -> str:
+        return self.names.get(uid) or str(uid)
+
+    async def count(self) -> int:
+        """Учитывает все новые голоса текущих выборов (пачками по ELECTION_TALLY_BATCH)."""
+        counted = 0
+        while True:
+            deltas = await run_db(_count_votes, self.election_id, ELECTION_TALLY_BATCH)
+            for cid, n in deltas.items():
+                self.tally[cid] = self.tally.get(cid, 0) + n
+            batch = sum(deltas.values())
+            counted += batch
+            if batch < ELECTION_TALLY_BATCH:
+                break
+        self.counted_votes += counted
+        return counted
+
+    async def step(self, now: datetime) -> tuple[list[str], list[tuple[int, str]]]:
+        """Один шаг: объявления для всех чатов и личные уведомления."""
+        election = await run_db(_load_active_election)
+        if election is None:
+            e = await run_db(_open_election, now)
+            if e is None:
+                return [], []
+            return [
+                f"🗳 **Объявлены выборы президента #{e.id}!**\n"
+                f"Регистрация кандидатов до {e.registration_ends:%d.%m %H:%M} (взнос {ELECTION_CANDIDATE_FEE:,}$), "
+                f"голосование до {e.voting_ends:%d.%m %H:%M}. Подробности - в меню «🏛 Политика»."
+            ], []
+
+        election_id, status, registration_ends, voting_ends = election
+        if election_id != self.election_id:
+            await self._restore(election_id)
+
+        if status == "REGISTRATION":
+            if now < registration_ends:
+                return [], []
+            # Кандидаты регистрировались в других процессах
+            await self._restore(election_id)
+            if not self.tally:
+                await run_db(_close_election, election_id, None, now)
+                self.election_id = None
+                return [f"🗳 Выборы #{election_id} не состоялись: нет кандидатов."], []
+            await run_db(_start_voting, election_id)
+            return [
+                f"🗳 **Выборы #{election_id}: началось голосование!**\n"
+                f"Кандидаты: {', '.join(self._name(cid) for cid in self.tally)}.\n"
+                f"Голосуйте до {voting_ends:%d.%m %H:%M} в меню «🏛 Политика»."
+            ], []
+
+        await self.count()
+        # Голоса, принятые хэндлерами перед самым концом, успевают записаться
+        if now < voting_ends + timedelta(seconds=ELECTION_CLOSE_GRACE_SECONDS):
+            return [], []
+        await self.count()
+        return await self.close(election_id, now)
+
+    async def close(self, election_id: int, now: datetime) -> tuple[list[str], list[tuple[int, str]]]:
+        total = sum(self.tally.values())
+        # При равенстве голосов побеждает зарегистрировавшийся раньше (порядок tally)
+        winner_id = max(self.tally, key=self.tally.get) if total else None
+        changed = await run_db(_close_election, election_id, winner_id, now)
+        self.election_id = None
+
+        # Права президента: сбрасываем кэш и копии журнала этого процесса (другие процессы
+        # увидят изменение по истечении USER_CACHE_TTL_SECONDS)
+        for uid in changed:
+            user_cache.invalidate(uid)
+            acct = balance_ledger.peek(uid)
+            if acct is not None:
+                acct.is_president = uid == winner_id
+
+        if winner_id is None:
+            return [f"🗳 Выборы #{election_id} не состоялись: ни одного голоса. Президент остается прежним."], []
+        results = "\n".join(
+            f"• {self._name(cid)} — {votes:,} ({votes / total:.0%})"
+            for cid, votes in sorted(self.tally.items(), key=lambda kv: kv[1], reverse=True)
+        )
+        notifications = [(winner_id, "🦅 **Вы избраны Президентом BongoCity!** Вам доступен «Офис Президента».")]
+        notifications += [
+            (uid, "🏛 Ваш президентский срок окончен.") for uid in changed if uid != winner_id
+        ]
+        return [
+            f"🦅 **Итоги выборов #{election_id}**\n"
+            f"Новый президент: *{self._name(winner_id)}* ({self.tally[winner_id]:,} из {total:,} голосов)\n\n{results}"
+        ], notifications
+
+election_service = ElectionService()
+
+# Блокировки таблиц: этапы с пересекающимися таблицами выполняются по очереди,
+# с непересекающимися - параллельно.
+_table_locks: dict[str, asyncio.Lock] = {}
+
+class BackgroundStage:
+    """Фоновый этап планировщика с отдельной транзакцией, таймаутом и метриками."""
+
+    def __init__(self, name: str, func, tables: tuple[str, ...], timeout: float, trigger: dict):
+        self.name = name
+        self.func = func
+        self.tables = tuple(sorted(tables))
+        self.timeout = timeout
+        self.trigger = trigger
+        # Метрики
+        self.runs = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        self.last_run: datetime | None = None
+
+    async def __call__(self):
+        locks = [_table_locks.setdefault(table, asyncio.Lock()) for table in self.tables]
+        for lock in locks:
+            await lock.acquire()
+        started = time.monotonic()
+        self.last_run = datetime.now()
+        try:
+            task = asyncio.ensure_future(run_db(self.func, self.last_run))
+            done, _ = await asyncio.wait({task}, timeout=self.timeout)
+            if not done:
+                # Поток БД нельзя прервать: фиксируем превышение и дожидаемся транзакции,
+                # чтобы следующий запуск не пересекся с ней.
+                self.timeouts += 1
+                logging.warning(f"Scheduler [{self.name}]: превышен таймаут {self.timeout}с.")
+            notifications = await task
+        except Exception as e:
+            self.failures += 1
+            logging.error(f"Scheduler [{self.name}] Error: {e}")
+            return
+        finally:
+            self.last_duration = time.monotonic() - started
+            self.total_duration += self.last_duration
+            self.runs += 1
+            for lock in reversed(locks):
+                lock.release()
+
+        logging.info(f"Scheduler [{self.name}]: {self.last_duration:.3f}с, уведомлений: {len(notifications)}.")
+        await send_notifications(notifications)
+
+BACKGROUND_STAGES = [
+    # Цены меняются каждый час (как указано на экране биржи)
+    BackgroundStage("market", _market_tick, ("market_item_prices", "market_price_ticks"), timeout=30,
+                    trigger={'trigger': 'interval', 'hours': 1}),
+    # Штраф начисляется в дни просрочки, кратные LOAN_CYCLE_DAYS, - один раз в такой день.
+    # Ежечасный запуск догоняет дни, пропущенные, пока процесс или ведущий не работал.
+    BackgroundStage("loans", _apply_loan_fines, ("bank_loans", "stage_checkpoints", "users", "presidential_budget"),
+                    timeout=300, trigger={'trigger': 'cron', 'minute': 0}),
+    BackgroundStage("jail", _release_prisoners, ("users",), timeout=30,
+                    trigger={'trigger': 'interval', 'minutes': 1}),
+]
+
+async def send_notifications(notifications: list[tuple[int, str]]):
+    """Ставит уведомления (chat_id, текст) в очередь. Вызывается после коммита, блокировки строк уже сняты."""
+    for chat_id, text in notifications:
+        notifier.enqueue(chat_id, text)
+
+# --- Завершение производства по времени готовности ---
+def _complete_production(biz_ids: list[int], now: datetime) -> list[tuple[int, str]]:
+    """Переводит в READY бизнесы из списка, у которых истек цикл производства."""
+    cycle_start_limit = now - timedelta(hours=PRODUCTION_CYCLE_HOURS)
+    bizs = OwnedBusiness.__table__
+    with SessionLocal() as s:
+        completed = bulk_transition(
+            s, bizs,
+            where=[
+                bizs.c.id.in_(biz_ids),
+                bizs.c.production_state == "PRODUCING",
+                bizs.c.production_start_time <= cycle_start_limit,
+            ],
+            values={'production_state': "READY"},
+            returning=[bizs.c.id, bizs.c.user_id, bizs.c.business_id],
+        )
+        s.commit()
+
+    notifications = []
+    for _, user_id, business_id in completed:
+        biz_name = BUSINESSES.get(business_id)['name']
+        notifications.append((user_id, f"✅ **ПРОИЗВОДСТВО ЗАВЕРШЕНО!** Ваш бизнес *{biz_name}* готов к сбору продукции."))
+    return notifications
+
+def _load_production_runs(worker: tuple[int, int] | None = None) -> list[tuple[int, datetime]]:
+    """Циклы в производстве; для воркера (номер, всего) - только его игроков (см. worker_for)."""
+    with SessionLocal() as s:
+        query = s.query(OwnedBusiness.id, OwnedBusiness.production_start_time).filter_by(production_state="PRODUCING")
+        if worker:
+            index, workers = worker
+            query = query.filter(OwnedBusiness.user_id % workers == index)
+        return [(biz_id, start) for biz_id, start in query.all() if start]
+
+class ProductionScheduler:
+    """
+    Планировщик завершения производства.
+    Min-куча (время готовности, id бизнеса): задача спит до ближайшего срока
+    и завершает только те циклы, которые истекли, без обхода всей таблицы.
+    """
+    RETRY_DELAY = timedelta(minutes=1)
+
+    def __init__(self):
+        self._heap: list[tuple[datetime, int]] = []
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def register(self, biz_id: int, start_time: datetime):
+        """Регистрирует запуск производства (вызывается после коммита)."""
+        heapq.heappush(self._heap, (start_time + timedelta(hours=PRODUCTION_CYCLE_HOURS), biz_id))
+        self._wakeup.set()
+
+    async def restore(self, worker: tuple[int, int] | None = None):
+        """Восстанавливает очередь из БД при старте (в т.ч. уже просроченные циклы)."""
+        for biz_id, start_time in await run_db(_load_production_runs, worker):
+            self.register(biz_id, start_time)
+        logging.info(f"ProductionScheduler: восстановлено {len(self._heap)} циклов производства.")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+
+            delay = (self._heap[0][0] - datetime.now()).total_seconds()
+            if delay > 0:
+                # Ждем ближайший срок или регистрацию нового (возможно, более раннего) цикла
                 try:
-                    await bot.send_message(u.telegram_id, "🎉 **ВЫ СВОБОДНЫ!** Тюремный срок окончен.")
-                except TelegramAPIError: pass
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            now = datetime.now()
+            due = []
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+
+            try:
+                notifications = await run_db(_complete_production, [biz_id for _, biz_id in due], now)
+            except Exception as e:
+                # Любая ошибка не должна останавливать задачу: сроки из кучи уже вынуты, возвращаем их
+                logging.error(f"ProductionScheduler Error: {e}")
+                for _, biz_id in due:
+                    heapq.heappush(self._heap, (now + self.RETRY_DELAY, biz_id))
+                continue
+            await send_notifications(notifications)
 
-        # --- E. Проверка и Запуск Выборов ---
-        # (Логика выборов: не предоставлена, но место зарезервировано)
-        # ...
+production_scheduler = ProductionScheduler()
 
+# --- Выбор ведущего процесса ---
+def _try_acquire_lease(name: str, holder: str, ttl_seconds: float) -> bool:
+    """Берет или продлевает аренду, если она свободна, истекла или уже принадлежит holder."""
+    now = datetime.now()
+    lease = SchedulerLease.__table__
+    with SessionLocal() as s:
+        taken = s.execute(
+            update(lease)
+            .where(lease.c.name == name, (lease.c.holder == holder) | (lease.c.expires_at < now))
+            .values(holder=holder, expires_at=now + timedelta(seconds=ttl_seconds))
+        ).rowcount
+        if not taken:
+            try:
+                s.execute(lease.insert().values(name=name, holder=holder, expires_at=now + timedelta(seconds=ttl_seconds)))
+            except IntegrityError:
+                # Строка уже есть и аренда занята другим процессом
+                return False
         s.commit()
-    
+        return True
+
+def _release_lease(name: str, holder: str):
+    lease = SchedulerLease.__table__
+    with SessionLocal() as s:
+        s.execute(update(lease).where(lease.c.name == name, lease.c.holder == holder).values(expires_at=datetime.now()))
+        s.commit()
+
+class LeaderElection:
+    """
+    Выбор ведущего процесса через аренду в БД (таблица scheduler_lease).
+    Ведущий продлевает аренду каждые ttl/3 секунд; остальные забирают ее, когда она истекла.
+    При ошибке БД процесс слагает полномочия: аренду за это время может забрать другой.
+    Часы процессов должны быть синхронизированы.
+    """
+
+    def __init__(self, name: str, ttl_seconds: float, on_elected, on_demoted):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.holder = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+
+    async def run(self):
+        while True:
+            try:
+                leader = await run_db(_try_acquire_lease, self.name, self.holder, self.ttl_seconds)
+            except SQLAlchemyError as e:
+                logging.error(f"LeaderElection DB Error: {e}")
+                leader = False
+            if leader != self.is_leader:
+                self.is_leader = leader
+                logging.info(f"LeaderElection [{self.name}]: {self.holder} - {'ведущий' if leader else 'ведомый'}.")
+                (self.on_elected if leader else self.on_demoted)()
+            await asyncio.sleep(self.ttl_seconds / 3)
+
+    async def release(self):
+        """Освобождает аренду при остановке, чтобы другой процесс забрал ее сразу."""
+        if self.is_leader:
+            self.is_leader = False
+            self.on_demoted()
+            await run_db(_release_lease, self.name, self.holder)
+
+def schedule_background_stages():
+    for stage in BACKGROUND_STAGES:
+        scheduler.add_job(stage, id=stage.name, max_instances=1, coalesce=True, replace_existing=True, **stage.trigger)
+    # Стакан заявок один на все процессы - сводит его тот же ведущий
+    exchange_service.start()
+    # Выборы и подсчет голосов - тоже, как и рассылки по чатам (незавершенные продолжаются)
+    election_service.start()
+    broadcast_service.start()
+
+def unschedule_background_stages():
+    for stage in BACKGROUND_STAGES:
+        if scheduler.get_job(stage.name):
+            scheduler.remove_job(stage.name)
+    exchange_service.stop()
+    election_service.stop()
+    broadcast_service.stop()
+
 # --- Отправка сообщений в чаты (для событий выборов) ---
-async def broadcast_message_to_chats(bot: Bot, message_text: str):
-    logging.info("Начало рассылки.")
+class BroadcastPage(NamedTuple):
+    """Итог отправки страницы чатов, сохраняется одной транзакцией вместе с прогрессом."""
+    last_chat_id: int
+    statuses: dict[int, str] # чат -> результат NotificationQueue
+    failures: dict[int, int] # чат -> Chat.failures до отправки
+    migrations: dict[int, int] # старый ID -> новый
+
+def _create_broadcast(message_text: str) -> int:
     with SessionLocal() as s:
-        chat_ids = [chat.chat_id for chat in s.query(Chat).all()]
-    
-    for chat_id in chat_ids:
-        try:
-            await bot.send_message(chat_id, message_text)
-            await asyncio.sleep(0.05)
-        except TelegramAPIError as e:
-            if e.message.lower() in ("bot was blocked by the user", "chat not found"):
-                logging.warning(f"Чат {chat_id} удален/заблокирован. Удаляю из БД.")
-                with SessionLocal() as s_delete:
-                    chat_to_delete = s_delete.query(Chat).filter_by(chat_id=chat_id).first()
-                    if chat_to_delete:
-                        s_delete.delete(chat_to_delete)
-                        s_delete.commit()
-            pass
-        except Exception:
-            pass
+        b = Broadcast(text=message_text, status="RUNNING", sent=0, dead=0, failed=0, created_at=datetime.now())
+        s.add(b)
+        s.commit()
+        return b.id
+
+def _load_unfinished_broadcasts() -> list[tuple[int, str, int | None]]:
+    with SessionLocal() as s:
+        return s.query(Broadcast.id, Broadcast.text, Broadcast.last_chat_id).filter_by(status="RUNNING").order_by(Broadcast.id).all()
+
+def _load_chat_page(after: int | None, limit: int) -> list[tuple[int, int]]:
+    """Следующая страница чатов по первичному ключу (keyset): без OFFSET и без курсора, держащего соединение."""
+    with SessionLocal() as s:
+        query = s.query(Chat.chat_id, Chat.failures)
+        if after is not None:
+            query = query.filter(Chat.chat_id > after)
+        return query.order_by(Chat.chat_id).limit(limit).all()
+
+def _save_broadcast_page(broadcast_id: int, page: BroadcastPage):
+    """Прогресс рассылки, удаление мертвых чатов и счетчики ошибок - одной транзакцией."""
+    chats, broadcasts = Chat.__table__, Broadcast.__table__
+    by_status: dict[str, list[int]] = {}
+    for chat_id, status in page.statuses.items():
+        by_status.setdefault(status, []).append(chat_id)
+    failed = by_status.get("failed", [])
+    # Чат, где рассылка не прошла BROADCAST_MAX_FAILURES раз подряд, считается мертвым
+    hopeless = [chat_id for chat_id in failed if page.failures[chat_id] + 1 >= BROADCAST_MAX_FAILURES]
+    retry = [chat_id for chat_id in failed if page.failures[chat_id] + 1 < BROADCAST_MAX_FAILURES]
+    dead = by_status.get("dead", []) + hopeless + list(page.migrations)
+    recovered = [chat_id for chat_id in by_status.get("sent", []) if page.failures[chat_id]]
+
+    with SessionLocal() as s:
+        if dead:
+            s.execute(delete(chats).where(chats.c.chat_id.in_(dead)))
+        if retry:
+            s.execute(update(chats).where(chats.c.chat_id.in_(retry)).values(failures=chats.c.failures + 1))
+        if recovered:
+            s.execute(update(chats).where(chats.c.chat_id.in_(recovered)).values(failures=0))
+        if page.migrations:
+            # Сообщение уже ушло по новому ID; если он попадет в оставшиеся страницы, чат получит его повторно
+            new_ids = set(page.migrations.values())
+            new_ids -= set(s.execute(select(chats.c.chat_id).where(chats.c.chat_id.in_(new_ids))).scalars())
+            if new_ids:
+                s.execute(chats.insert(), [{'chat_id': chat_id, 'failures': 0} for chat_id in sorted(new_ids)])
+        s.execute(
+            update(broadcasts).where(broadcasts.c.id == broadcast_id).values(
+                last_chat_id=page.last_chat_id,
+                sent=broadcasts.c.sent + len(by_status.get("sent", [])) + len(by_status.get("duplicate", [])),
+                dead=broadcasts.c.dead + len(by_status.get("dead", [])) + len(hopeless),
+                failed=broadcasts.c.failed + len(retry),
+            )
+        )
+        s.commit()
+
+def _finish_broadcast(broadcast_id: int) -> tuple[int, int, int]:
+    with SessionLocal() as s:
+        b = s.query(Broadcast).filter_by(id=broadcast_id).first()
+        b.status = "DONE"
+        b.finished_at = datetime.now()
+        s.commit()
+        return b.sent, b.dead, b.failed
+
+async def _run_broadcast(bot_: Bot, broadcast_id: int, message_text: str, after: int | None):
+    """
+    Отправляет рассылку постранично, начиная после чата after. В очереди уведомлений
+    одновременно не больше страницы (скорость ограничивает ее TokenBucket), следующая
+    страница читается, пока отправляется текущая. После перезапуска рассылка продолжается
+    с сохраненного last_chat_id: повторно могут уйти только сообщения незавершенной страницы.
+    """
+    page = await run_db(_load_chat_page, after, BROADCAST_PAGE_SIZE)
+    while page:
+        futures = [notifier.enqueue(chat_id, message_text, bot_=bot_) for chat_id, _ in page]
+        next_page = asyncio.ensure_future(run_db(_load_chat_page, page[-1][0], BROADCAST_PAGE_SIZE))
+        statuses = await asyncio.gather(*futures)
+        migrations = {chat_id: notifier.migrations.pop(chat_id) for chat_id, _ in page if chat_id in notifier.migrations}
+        await run_db(_save_broadcast_page, broadcast_id, BroadcastPage(
+            page[-1][0], {chat_id: status for (chat_id, _), status in zip(page, statuses)}, dict(page), migrations,
+        ))
+        page = await next_page
+
+    sent, dead, failed = await run_db(_finish_broadcast, broadcast_id)
+    logging.info(f"Рассылка #{broadcast_id} завершена: доставлено {sent}, удалено чатов {dead}, ошибок {failed}.")
+
+async def broadcast_message_to_chats(bot: Bot, message_text: str):
+    broadcast_id = await run_db(_create_broadcast, message_text)
+    logging.info(f"Начало рассылки #{broadcast_id}.")
+    await _run_broadcast(bot, broadcast_id, message_text, None)
+
+class BroadcastService:
+    """
+    Рассылки в ведущем процессе: запускаются фоном (объявления не ждут отправки в тысячи чатов)
+    и при смене ведущего или перезапуске продолжаются новым ведущим с сохраненного места.
+    """
+
+    def __init__(self):
+        self._tasks: set[asyncio.Task] = set()
+        self.failures = 0
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    def _done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            # Рассылка осталась RUNNING и продолжится при следующем запуске сервиса
+            self.failures += 1
+            logging.error(f"Broadcast Error: {task.exception()}")
+
+    def start(self):
+        self._spawn(self._resume())
+
+    def stop(self):
+        # Незавершенные рассылки продолжит новый ведущий
+        for task in list(self._tasks):
+            task.cancel()
+
+    def submit(self, message_text: str):
+        self._spawn(broadcast_message_to_chats(bot, message_text))
+
+    async def _resume(self):
+        for broadcast_id, message_text, last_chat_id in await run_db(_load_unfinished_broadcasts):
+            logging.info(f"Продолжение рассылки #{broadcast_id} после чата {last_chat_id}.")
+            self._spawn(_run_broadcast(bot, broadcast_id, message_text, last_chat_id))
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks)
+
+broadcast_service = BroadcastService()
+
+# --- Экспорт метрик ---
+def render_metrics() -> str:
+    """Метрики хэндлеров и фоновых этапов в текстовом формате Prometheus."""
+    lines = []
+    handler_families = [
+        ("bongo_handler_calls_total", "counter", "Вызовы хэндлера", lambda st: st.calls),
+        ("bongo_handler_errors_total", "counter", "Необработанные исключения в хэндлере", lambda st: st.errors),
+        ("bongo_handler_seconds_total", "counter", "Суммарное время хэндлера", lambda st: st.seconds),
+        ("bongo_handler_seconds_max", "gauge", "Максимальное время хэндлера", lambda st: st.max_seconds),
+        ("bongo_handler_sql_statements_total", "counter", "SQL-запросы хэндлера", lambda st: st.sql),
+        ("bongo_handler_lock_wait_seconds_total", "counter", "Время запросов SELECT ... FOR UPDATE", lambda st: st.lock_wait),
+        ("bongo_handler_telegram_seconds_total", "counter", "Время запросов к Bot API", lambda st: st.telegram_seconds),
+    ]
+    for name, mtype, help_text, value in handler_families:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {mtype}"]
+        for handler_name, stats in sorted(handler_stats.items()):
+            lines.append(f'{name}{{handler="{handler_name}"}} {value(stats)}')
+
+    stage_families = [
+        ("bongo_stage_runs_total", "counter", "Запуски фонового этапа", lambda st: st.runs),
+        ("bongo_stage_failures_total", "counter", "Ошибки фонового этапа", lambda st: st.failures),
+        ("bongo_stage_timeouts_total", "counter", "Превышения таймаута фонового этапа", lambda st: st.timeouts),
+        ("bongo_stage_seconds_total", "counter", "Суммарное время фонового этапа", lambda st: st.total_duration),
+        ("bongo_stage_last_seconds", "gauge", "Время последнего запуска этапа", lambda st: st.last_duration),
+    ]
+    for name, mtype, help_text, value in stage_families:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {mtype}"]
+        for stage in BACKGROUND_STAGES:
+            lines.append(f'{name}{{stage="{stage.name}"}} {value(stage)}')
+
+    ledger_families = [
+        ("bongo_ledger_pending_entries", "gauge", "Записи журнала балансов, ожидающие сброса", balance_ledger.pending),
+        ("bongo_ledger_flushes_total", "counter", "Сбросы журнала балансов в БД", balance_ledger.flushes),
+        ("bongo_ledger_flushed_entries_total", "counter", "Записи журнала, сброшенные в БД", balance_ledger.flushed_entries),
+        ("bongo_ledger_flush_failures_total", "counter", "Ошибки сброса журнала балансов", balance_ledger.flush_failures),
+    ]
+    exchange_families = [
+        ("bongo_exchange_open_orders", "gauge", "Заявки в стакане (в ведущем процессе)", exchange_service.exchange.open_orders()),
+        ("bongo_exchange_batches_total", "counter", "Сохраненные пачки сведения заявок", exchange_service.batches),
+        ("bongo_exchange_fills_total", "counter", "Сделки биржевого стакана", exchange_service.fills),
+        ("bongo_exchange_failures_total", "counter", "Ошибки сведения заявок", exchange_service.failures),
+    ]
+    leaderboard_families = [
+        ("bongo_leaderboard_players", "gauge", "Игроки в рейтинге по капиталу", len(leaderboard)),
+    ]
+    election_families = [
+        ("bongo_election_counted_votes_total", "counter", "Учтенные голоса выборов (в ведущем процессе)", election_service.counted_votes),
+        ("bongo_election_failures_total", "counter", "Ошибки подсчета голосов и смены этапов выборов", election_service.failures),
+    ]
+    broadcast_families = [
+        ("bongo_broadcasts_running", "gauge", "Рассылки по чатам в работе (в ведущем процессе)", broadcast_service.running),
+        ("bongo_broadcast_failures_total", "counter", "Рассылки, прерванные ошибкой", broadcast_service.failures),
+    ]
+    families = ledger_families + exchange_families + leaderboard_families + election_families + broadcast_families
+    for name, mtype, help_text, value in families:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {mtype}", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+async def start_metrics_server(port: int):
+    """Локальный HTTP-эндпоинт /metrics для Prometheus."""
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    logging.info(f"Метрики доступны на http://127.0.0.1:{port}/metrics")
+
+async def log_metrics_summary():
+    """Периодическая сводка: самые дорогие хэндлеры по суммарному времени."""
+    top = sorted(handler_stats.items(), key=lambda item: item[1].seconds, reverse=True)[:10]
+    for name, st in top:
+        logging.info(
+            f"Metrics [{name}]: вызовов {st.calls}, среднее {st.seconds / st.calls * 1000:.1f}мс, "
+            f"макс {st.max_seconds * 1000:.1f}мс, SQL/вызов {st.sql / st.calls:.1f}, "
+            f"блокировки {st.lock_wait:.2f}с, Bot API {st.telegram_seconds:.2f}с"
+        )
 
 async def set_bot_commands(bot: Bot):
     commands = [
         BotCommand(command="start", description="▶️ Запуск бота"),
         BotCommand(command="profile", description="👤 Ваш игровой профиль"),
+        BotCommand(command="top", description="🏆 Самые богатые игроки"),
         BotCommand(command="help", description="ℹ️ Список команд и помощь"),
     ]
     await bot.set_my_commands(commands, scope=BotCommandScopeDefault())
@@ -1397,7 +4160,7 @@ async def unhandled_message(message: types.Message, state: FSMContext):
         # Если находились в FSM, сбрасываем его
         await state.clear()
         
-    u = get_user(message.from_user.id)
+    u = await get_user(message.from_user.id)
     await message.answer(
         "🤔 *Неизвестная команда или некорректный ввод.*\n"
         "Ваше состояние было сброшено. Пожалуйста, воспользуйтесь кнопками ниже.",
@@ -1408,7 +4171,7 @@ async def unhandled_message(message: types.Message, state: FSMContext):
 @router.callback_query()
 async def unhandled_callback(call: types.CallbackQuery):
     await call.answer("❌ Эта кнопка устарела или не существует.", show_alert=True)
-    u = get_user(call.from_user.id)
+    u = await get_user(call.from_user.id)
     # Возвращаем главное меню на всякий случай
     # Проверка на наличие message, так как колбэк может быть вызван из-за устаревшего сообщения
     if call.message:
@@ -1418,25 +4181,184 @@ async def unhandled_callback(call: types.CallbackQuery):
 # === 14. ЗАПУСК БОТА ===
 # =========================================================
 
-async def main():
-    if not init_db():
+async def start_services(worker: tuple[int, int] | None = None) -> bool:
+    """Общий запуск процесса с хэндлерами: БД, журнал балансов, очереди и периодические задачи процесса."""
+    if not await run_db(init_db):
         logging.error("Не удалось запустить из-за ошибки БД.")
+        return False
+    # Изменения балансов, не сброшенные в БД до остановки
+    await run_db(balance_ledger.recover)
+    # Рейтинг по капиталу: полный проход по users, дальше - обновления из записей балансов
+    await rebuild_leaderboard()
+
+    # Очередь исходящих уведомлений
+    notifier.start()
+
+    # Завершение производства по времени готовности (очередь восстанавливается из БД)
+    await production_scheduler.restore(worker)
+    production_scheduler.start()
+    
+    scheduler.add_job(balance_ledger.flush, 'interval', seconds=LEDGER_FLUSH_SECONDS, max_instances=1, coalesce=True)
+    if isinstance(fsm_storage, (TTLMemoryStorage, SqlFsmStorage)):
+        scheduler.add_job(fsm_storage.expire, 'interval', minutes=FSM_STATE_TTL_MINUTES)
+    scheduler.add_job(sync_economy, 'interval', seconds=ECONOMY_SYNC_SECONDS, max_instances=1, coalesce=True)
+    scheduler.add_job(rebuild_leaderboard, 'interval', minutes=LEADERBOARD_REBUILD_MINUTES, max_instances=1, coalesce=True)
+    scheduler.add_job(log_metrics_summary, 'interval', minutes=METRICS_LOG_MINUTES)
+    scheduler.start()
+    return True
+
+async def main():
+    if not await start_services():
         return
 
     await set_bot_commands(bot)
+
+    # Фоновые задачи: рынок, кредиты, тюрьма - каждая по своему расписанию
+    schedule_background_stages()
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT)
     
-    # Добавление фоновых задач:
-    # 1. Проверка всех таймеров (производство, рынок, кредиты, тюрьма) - каждые 15 минут
-    scheduler.add_job(check_elections_and_payouts, 'interval', minutes=15)
-    
-    scheduler.start()
     logging.info("Бот запущен. Сложная симуляция активна.")
+    # Polling не работает, пока установлен webhook (после запуска в webhook-режиме)
+    await bot.delete_webhook()
     # ИСПОЛЬЗУЕМ dp.start_polling(bot) - это правильно для aiogram 3.x
     await dp.start_polling(bot)
+    await balance_ledger.flush()
+
+# --- Webhook-режим ---
+# Telegram присылает апдейты балансировщику (run_webhook), тот пересылает каждый апдейт
+# воркеру (run_worker) по ID игрока. Все апдейты игрока обрабатывает один процесс, поэтому
+# блокировки игроков, журнал балансов и кэш пользователей остаются внутрипроцессными.
+# Фоновые этапы и сведение биржевых заявок выполняет только ведущий воркер (LeaderElection).
+
+def worker_for(uid: int, workers: int) -> int:
+    return uid % workers
+
+def _update_user_id(data: dict) -> int:
+    """ID игрока из апдейта Telegram (для групп без отправителя - ID чата)."""
+    for value in data.values():
+        if isinstance(value, dict):
+            sender = value.get("from") or value.get("user") or value.get("chat") or {}
+            if "id" in sender:
+                return sender["id"]
+    return 0
+
+def _stop_event() -> asyncio.Event:
+    """Событие, которое выставляется по SIGTERM/SIGINT."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+async def run_worker(index: int):
+    """Воркер webhook-режима: обрабатывает апдейты своих игроков на 127.0.0.1:WORKER_BASE_PORT+index."""
+    stop = _stop_event()
+    balance_ledger.wal_path = f"{LEDGER_WAL_PATH}.{index}"
+    # Общий лимит Telegram делится между воркерами
+    notifier.bucket = TokenBucket(NOTIFY_GLOBAL_RATE / WEB_WORKERS)
+    if not await start_services((index, WEB_WORKERS)):
+        return
+
+    election = LeaderElection("scheduler", LEADER_LEASE_SECONDS, schedule_background_stages, unschedule_background_stages)
+    election_task = asyncio.create_task(election.run())
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_PORT + index)
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path="/update")
+    setup_application(app, dp, bot=bot)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", WORKER_BASE_PORT + index).start()
+    logging.info(f"Воркер {index} запущен на порту {WORKER_BASE_PORT + index}.")
+
+    await stop.wait()
+    election_task.cancel()
+    await runner.cleanup()
+    await balance_ledger.flush()
+    await election.release()
+    logging.info(f"Воркер {index} остановлен.")
+
+async def _supervise_worker(index: int, stop: asyncio.Event):
+    """Держит процесс воркера запущенным: перезапускает его после падения."""
+    while not stop.is_set():
+        proc = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), "worker", str(index))
+        wait_task = asyncio.ensure_future(proc.wait())
+        stop_task = asyncio.ensure_future(stop.wait())
+        await asyncio.wait({wait_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        if stop.is_set():
+            if proc.returncode is None:
+                proc.terminate()
+            await wait_task
+            return
+        stop_task.cancel()
+        logging.error(f"Воркер {index} завершился с кодом {proc.returncode}, перезапуск.")
+        await asyncio.sleep(1)
+
+async def run_webhook():
+    """Webhook-режим: балансировщик на PORT и WEB_WORKERS процессов-воркеров."""
+    stop = _stop_event()
+    if not WEBHOOK_URL:
+        logging.error("Для webhook-режима нужен WEBHOOK_URL.")
+        return
+    if not await run_db(init_db):
+        logging.error("Не удалось запустить из-за ошибки БД.")
+        return
+    # WAL воркеров прошлого запуска (в т.ч. с другим числом воркеров)
+    for path in glob.glob(f"{LEDGER_WAL_PATH}.*"):
+        if not path.endswith(".tmp"):
+            await run_db(BalanceLedger(path, LEDGER_FLUSH_THRESHOLD).recover)
+
+    supervisors = [asyncio.create_task(_supervise_worker(i, stop)) for i in range(WEB_WORKERS)]
+    http = ClientSession()
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        body = await request.read()
+        try:
+            index = worker_for(_update_user_id(json.loads(body)), WEB_WORKERS)
+        except ValueError:
+            return web.Response(status=400)
+        try:
+            async with http.post(
+                f"http://127.0.0.1:{WORKER_BASE_PORT + index}/update", data=body,
+                headers={"Content-Type": "application/json",
+                         "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET or ""},
+            ) as resp:
+                return web.Response(status=resp.status)
+        except ClientError:
+            # Воркер недоступен (перезапускается): Telegram повторит доставку
+            return web.Response(status=502)
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", WEB_PORT).start()
+
+    await set_bot_commands(bot)
+    await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    logging.info(f"Webhook-режим: порт {WEB_PORT}, воркеров {WEB_WORKERS}.")
+
+    await stop.wait()
+    await runner.cleanup()
+    await asyncio.gather(*supervisors)
+    await http.close()
+    await bot.session.close()
+    logging.info("Webhook-режим остановлен.")
 
 if __name__ == "__main__":
+    # python main.py - polling; python main.py webhook - балансировщик и воркеры
+    mode = sys.argv[1] if len(sys.argv) > 1 else "polling"
     try:
-        asyncio.run(main())
+        if mode == "webhook":
+            asyncio.run(run_webhook())
+        elif mode == "worker":
+            asyncio.run(run_worker(int(sys.argv[2])))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         logging.info("Бот остановлен вручную.")
     except Exception as e:
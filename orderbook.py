@@ -0,0 +1,141 @@
+"""
+Биржевой стакан BongoCity: лимитные заявки игроков с приоритетом цена-время.
+
+Чистый модуль без БД и Telegram: main.py (ExchangeService) подает в него заявки
+и отмены, сохраняет сделки пачками и восстанавливает стакан из открытых заявок.
+Для каждой стороны - куча (heapq): вставка O(log n), лучшая цена O(1).
+Отмена ленивая: заявка удаляется из словаря за O(1), а ее запись в куче
+выбрасывается, когда поднимется на вершину.
+"""
+import heapq
+import itertools
+from dataclasses import dataclass
+from typing import NamedTuple
+
+BUY = "BUY"
+SELL = "SELL"
+
+
+@dataclass(slots=True)
+class Order:
+    id: int
+    user_id: int
+    item_id: int
+    side: str
+    price: int
+    remaining: int
+
+
+class Fill(NamedTuple):
+    """Сделка по цене стоящей в стакане (maker) заявки."""
+    item_id: int
+    buy_order_id: int
+    sell_order_id: int
+    buyer_id: int
+    seller_id: int
+    price: int
+    qty: int
+
+
+class OrderBook:
+    """Стакан одного товара."""
+
+    def __init__(self, item_id: int):
+        self.item_id = item_id
+        self.orders: dict[int, Order] = {}
+        # (ключ цены, порядковый номер, id заявки): для покупок ключ -price, чтобы лучшая была наверху
+        self._bids: list[tuple[int, int, int]] = []
+        self._asks: list[tuple[int, int, int]] = []
+        self._seq = itertools.count()
+
+    def _heap(self, side: str) -> list:
+        return self._bids if side == BUY else self._asks
+
+    def _top(self, side: str) -> Order | None:
+        heap = self._heap(side)
+        while heap:
+            order = self.orders.get(heap[0][2])
+            if order is not None:
+                return order
+            heapq.heappop(heap) # Отмененная или исполненная заявка
+        return None
+
+    def best_bid(self) -> Order | None:
+        return self._top(BUY)
+
+    def best_ask(self) -> Order | None:
+        return self._top(SELL)
+
+    def _rest(self, order: Order):
+        self.orders[order.id] = order
+        key = -order.price if order.side == BUY else order.price
+        heapq.heappush(self._heap(order.side), (key, next(self._seq), order.id))
+
+    def submit(self, order: Order) -> list[Fill]:
+        """Сводит заявку со встречными; неисполненный остаток встает в стакан."""
+        fills = []
+        opposite = SELL if order.side == BUY else BUY
+        while order.remaining:
+            maker = self._top(opposite)
+            if maker is None:
+                break
+            if order.side == BUY and maker.price > order.price:
+                break
+            if order.side == SELL and maker.price < order.price:
+                break
+            qty = min(order.remaining, maker.remaining)
+            buy, sell = (order, maker) if order.side == BUY else (maker, order)
+            fills.append(Fill(self.item_id, buy.id, sell.id, buy.user_id, sell.user_id, maker.price, qty))
+            order.remaining -= qty
+            maker.remaining -= qty
+            if not maker.remaining:
+                del self.orders[maker.id]
+        if order.remaining:
+            self._rest(order)
+        return fills
+
+    def cancel(self, order_id: int) -> Order | None:
+        """Снимает заявку. None, если ее нет в стакане (уже исполнена или снята)."""
+        return self.orders.pop(order_id, None)
+
+    def compact(self):
+        """Перестраивает кучи без снятых заявок (если их накопилось много)."""
+        for side in (BUY, SELL):
+            heap = [entry for entry in self._heap(side) if entry[2] in self.orders]
+            heapq.heapify(heap)
+            if side == BUY:
+                self._bids = heap
+            else:
+                self._asks = heap
+
+    def stale_entries(self) -> int:
+        return len(self._bids) + len(self._asks) - len(self.orders)
+
+
+class Exchange:
+    """Стаканы всех товаров."""
+
+    def __init__(self, item_ids):
+        self.books = {item_id: OrderBook(item_id) for item_id in item_ids}
+
+    def submit(self, order: Order) -> list[Fill]:
+        book = self.books[order.item_id]
+        fills = book.submit(order)
+        if book.stale_entries() > 2 * len(book.orders) + 1000:
+            book.compact()
+        return fills
+
+    def cancel(self, item_id: int, order_id: int) -> Order | None:
+        return self.books[item_id].cancel(order_id)
+
+    def restore(self, orders):
+        """Восстанавливает стаканы из открытых заявок (в порядке id - это и есть порядок времени)."""
+        for book in self.books.values():
+            book.orders.clear()
+            book._bids.clear()
+            book._asks.clear()
+        for order in sorted(orders, key=lambda o: o.id):
+            self.books[order.item_id]._rest(order)
+
+    def open_orders(self) -> int:
+        return sum(len(book.orders) for book in self.books.values())